@@ -11,8 +11,8 @@
 # %%
 
 import ee
-import pendulum
 from helpers import *
+from gee_tasks import ExportTaskManager
 
 # from ipygee import *
 
@@ -20,37 +20,39 @@ from helpers import *
 # ee.Authenticate("4/1AeaYSHAD-7pUTo0xPOA7wMn7RjSHaiqpWZsy5BP-PGhgWl6j1eYp7JF5KHc")
 ee.Initialize()
 # import geetools
-import geopandas as gpd
-from shapely.geometry import Polygon
-
-
-# split fc_south into 2 tiles
-south = gpd.read_file("./data/south_adm2.geojson")
-minx, miny, maxx, maxy = south.total_bounds
-y_range = south.bounds.maxy.max() - south.bounds.miny.min()
-y_mid = south.bounds.miny.min() + y_range / 2
-bbox = Polygon([(minx, y_mid), (maxx, y_mid), (maxx, maxy), (minx, maxy)])
-south_part1 = gpd.GeoDataFrame(geometry=[bbox], crs="EPSG:4326")
-south_part1.to_file("./data/south_adm2_part1.geojson")
-south_part1.explore()
-bbox = Polygon([(minx, miny), (maxx, miny), (maxx, y_mid), (minx, y_mid)])
-south_part2 = gpd.GeoDataFrame(geometry=[bbox], crs="EPSG:4326")
-south_part2.to_file("./data/south_adm2_part2.geojson")
-south_part2.explore()
+from shapely.geometry import mapping
+from tiling import plan_tiles, write_tiles
 
-# %%
-# Create and return the Earth Engine Polygon Geometry
-f_north = open("./data/north_adm2.geojson")
-fc_north = create_ee_polygon_from_geojson(f_north)
 
-f_south = open("./data/south_adm2.geojson")
-fc_south = create_ee_polygon_from_geojson(f_south)
+# split fc_south into tiles that fit the pixel budget (2 tiles at 10m)
+SCALE = 10
+MAX_TILE_PIXELS = 5e8
+south_tiles = plan_tiles(
+    "./data/south_adm2.geojson", resolution=SCALE, max_pixels=MAX_TILE_PIXELS
+)
+write_tiles(south_tiles, "./data/south_adm2_tiles.geojson")
+south_tiles.explore()
 
-# break fc_south into 2 tiles
-f_south1 = open("./data/south_adm2_part1.geojson")
-f_south1 = create_ee_polygon_from_geojson(f_south1)
-f_south2 = open("./data/south_adm2_part2.geojson")
-f_south2 = create_ee_polygon_from_geojson(f_south2)
+# %%
+# Create and return the Earth Engine Polygon Geometry
+# simplified to SCALE and cached in ./data/geometry_cache
+north_region = prepare_geometry("./data/north_adm2.geojson", SCALE=SCALE)
+fc_north = ee.Geometry(north_region, opt_geodesic=False)
+
+south_region = prepare_geometry("./data/south_adm2.geojson", SCALE=SCALE)
+fc_south = ee.Geometry(south_region, opt_geodesic=False)
+
+# one ee geometry per south tile, named south1, south2, ...
+south_regions = {
+    f"south{tile_id}": mapping(geometry)
+    for tile_id, geometry in zip(
+        south_tiles["tile_id"], south_tiles.to_crs("EPSG:4326").geometry
+    )
+}
+south_sites = {
+    name: ee.Geometry(region, opt_geodesic=False)
+    for name, region in south_regions.items()
+}
 
 #################################################################
 #  %% get time series bands of interest SINGLE BAND
@@ -83,96 +85,46 @@ SCALE = 10
 
 
 # %% QUARTERLY COMPOSITES  Cloud mask
-for band in bands:
-    for site, name in zip(
-        [f_south1, f_south2, fc_north], ["south1", "south2", "north"]
-    ):
-        q_finished = []
-        for year in list(range(2020, 2025)):  #  2021-2023
-            for month in list(range(1, 13)):  #
-
-                dt = pendulum.datetime(year, month, 1)
-                # avoid repeating same quarter
-                yq = f"{year}_{dt.quarter}"
-                if yq in q_finished:
-                    # print('skipping')
-                    continue
-                else:
-                    # print(f"appending {year}_{dt.quarter}")
-                    q_finished.append(f"{year}_{dt.quarter}")
-
-                print(f"Year: {year} Quarter: {dt.quarter}")
-
-                # filter by date and cloud cover
-                collection = get_s2A_SR_sr_cld_collection(
-                    site,
-                    dt.first_of("quarter").strftime(r"%Y-%m-%d"),
-                    dt.last_of("quarter").strftime(r"%Y-%m-%d"),
-                    CLOUD_FILTER=CLOUD_FILTER,
-                )
-
-                # add cloud and shadow mask
-                s2_sr = (
-                    collection.map(
-                        lambda image: add_cld_shdw_mask(
-                            image,
-                            CLD_PRB_THRESH=CLD_PRB_THRESH,
-                            NIR_DRK_THRESH=NIR_DRK_THRESH,
-                            CLD_PRJ_DIST=CLD_PRJ_DIST,
-                            SCALE=SCALE,
-                            BUFFER=BUFFER,
-                        )
-                    )
-                    .map(apply_cld_shdw_mask)
-                    .map(convert_to_float)
-                    .select(bands)
-                    .median()
-                )
-
-                # Mask AOI  DONT MASK AOI FOR SPFEAS
-                # Create a mask from the AOI: 1 inside the geometry, 0 outside.
-                # aoi_mask = ee.Image.constant(1).clip(site.buffer(300)).mask()
-                # s2_sr = s2_sr.updateMask(aoi_mask)
-                s2_sr = s2_sr.select(band)
-
-                # # export clipped result in Tiff
-                img_name = f"{band}_S2_SR_{year}_Q{str(dt.quarter).zfill(2)}_{name}"
-                export_config = {
-                    "scale": SCALE,
-                    "maxPixels": 500000000000,
-                    "driveFolder": folder,
-                    "region": site,
-                }
-                task = ee.batch.Export.image(s2_sr, img_name, export_config)
-                task.start()
-
-                # for a single band get the cloud mask as a binary
-                if band == "B2":
-                    # Create no-data mask where 1 = missing data, 0 = valid data
-                    no_data_mask = s2_sr.mask().Not().toUint8()
-
-                    # directly compute the valid data mask and invert it
-                    valid_data_mask = s2_sr.reduce(ee.Reducer.allNonZero())
-                    # no_data_mask = valid_data_mask.Not().toUint8()
-
-                    mask_name = f"NoDataMask_{year}_Q{str(dt.quarter).zfill(2)}_{name}"
-
-                    mask_task = ee.batch.Export.image.toDrive(
-                        image=no_data_mask,
-                        description=mask_name,
-                        folder="cloud_mask",
-                        fileNamePrefix=mask_name,
-                        scale=SCALE,
-                        maxPixels=500000000000,
-                        region=site.getInfo()["coordinates"],
-                        fileFormat="GeoTIFF",
-                    )
-                    mask_task.start()
-# %% sync using rclone to local once all gee tasks are complete -
+# each (site, quarter) composite is built once and every band plus the
+# NoDataMask are exported from it
+plan = plan_composite_exports(
+    {**south_sites, "north": fc_north},
+    range(2020, 2025),  #  2021-2023
+    regions={**south_regions, "north": north_region},
+    bands=bands,
+    mask_band="B2",
+    folder=folder,
+    mask_folder="cloud_mask",
+    composite_params={
+        "CLOUD_FILTER": CLOUD_FILTER,
+        "CLD_PRB_THRESH": CLD_PRB_THRESH,
+        "NIR_DRK_THRESH": NIR_DRK_THRESH,
+        "CLD_PRJ_DIST": CLD_PRJ_DIST,
+        "SCALE": SCALE,
+        "BUFFER": BUFFER,
+    },
+)
+# keeps at most max_in_flight exports running, retries failures and records
+# finished exports so a rerun only submits what is missing
+task_manager = ExportTaskManager(f"./data/{folder}_tasks.json", max_in_flight=20)
+
+# check the number of composites and tasks before submitting
+submit_composite_exports(plan, scale=SCALE, dry_run=True, task_manager=task_manager)
+submit_composite_exports(plan, scale=SCALE, task_manager=task_manager)
+task_manager.run()
+
+# Mask AOI  DONT MASK AOI FOR SPFEAS
+# Create a mask from the AOI: 1 inside the geometry, 0 outside.
+# aoi_mask = ee.Image.constant(1).clip(site.buffer(300)).mask()
+# s2_sr = s2_sr.updateMask(aoi_mask)
+
+# %% sync using rclone to local once all gee tasks are complete (task_manager.run returns) -
 # from terminal run
 # rclone sync mygdrive:/malawi_imagery_new /home/mmann1123/Downloads/malawi_imagery_new
 # if not working run:
 # rclone config and edit mygdrive remote to reestablish connection
+# then pack the NoDataMask exports for each site into a mask store, e.g.
+# python mask_store.py ./mask_store/north --masks "cloud_mask/NoDataMask_*_north.tif"
 
 #######################################################################
 # %% Multi-band imagery downloads
@@ -192,67 +144,32 @@ SCALE = 10
 
 
 # %% QUARTERLY COMPOSITES
-for site, name in zip([fc_north, fc_south], ["north", "south"]):
-
-    q_finished = []
-    for year in list(range(2021, 2024)):  # 2024
-        for month in list(range(1, 13)):
-
-            dt = pendulum.datetime(year, month, 1)
-            # avoid repeating same quarter
-            yq = f"{year}_{dt.quarter}"
-            if yq in q_finished:
-                # print('skipping')
-                continue
-            else:
-                # print(f"appending {year}_{dt.quarter}")
-                q_finished.append(f"{year}_{dt.quarter}")
-
-            print(f"Year: {year} Quarter: {dt.quarter}")
-
-            # filter by date and cloud cover
-            collection = get_s2A_SR_sr_cld_collection(
-                site,
-                dt.first_of("quarter").strftime(r"%Y-%m-%d"),
-                dt.last_of("quarter").strftime(r"%Y-%m-%d"),
-                CLOUD_FILTER=CLOUD_FILTER,
-            )
-
-            # add cloud and shadow mask
-            s2_sr = (
-                collection.map(
-                    lambda image: add_cld_shdw_mask(
-                        image,
-                        CLD_PRB_THRESH=CLD_PRB_THRESH,
-                        NIR_DRK_THRESH=NIR_DRK_THRESH,
-                        CLD_PRJ_DIST=CLD_PRJ_DIST,
-                        SCALE=SCALE,
-                        BUFFER=BUFFER,
-                    )
-                )
-                .map(apply_cld_shdw_mask)
-                .select(bands)
-                .median()
-            )
-
-            # DONT MASK AOI FOR SPFEAS
-            # Create a mask from the AOI: 1 inside the geometry, 0 outside.
-            # aoi_mask = ee.Image.constant(1).clip(site.buffer(300)).mask()
-            # s2_sr = s2_sr.updateMask(aoi_mask)
-            s2_sr = s2_sr.select(bands)
-            # Convert to float32
-            s2_sr = s2_sr.toFloat()
-
-            # # export clipped result in Tiff
-            img_name = f"S2_SR_{year}_Q{str(dt.quarter).zfill(2)}_{name}"
-            export_config = {
-                "scale": SCALE,
-                "maxPixels": 50000000000,
-                "driveFolder": folder,
-                "region": site,
-            }
-            task = ee.batch.Export.image(s2_sr, img_name, export_config)
-            task.start()
+plan = plan_composite_exports(
+    {"north": fc_north, "south": fc_south},
+    range(2021, 2024),  # 2024
+    regions={"north": north_region, "south": south_region},
+    multiband=bands,
+    folder=folder,
+    composite_params={
+        "CLOUD_FILTER": CLOUD_FILTER,
+        "CLD_PRB_THRESH": CLD_PRB_THRESH,
+        "NIR_DRK_THRESH": NIR_DRK_THRESH,
+        "CLD_PRJ_DIST": CLD_PRJ_DIST,
+        "SCALE": SCALE,
+        "BUFFER": BUFFER,
+        "float_scenes": False,
+    },
+    max_pixels=50000000000,
+)
+task_manager = ExportTaskManager(f"./data/{folder}_tasks.json", max_in_flight=20)
+submit_composite_exports(plan, scale=SCALE, dry_run=True, task_manager=task_manager)
+submit_composite_exports(plan, scale=SCALE, task_manager=task_manager)
+task_manager.run()
+
+# DONT MASK AOI FOR SPFEAS
+# Create a mask from the AOI: 1 inside the geometry, 0 outside.
+# aoi_mask = ee.Image.constant(1).clip(site.buffer(300)).mask()
+# s2_sr = s2_sr.updateMask(aoi_mask)
 
 
 # %% sync using rclone to local once all gee tasks are complete -
@@ -15,12 +15,18 @@
 # │   ├── ....
 
 
-from xr_fresh.interpolate_series import interpolate_nan
 from numpy import nan
+import argparse
 import os
 from glob import glob
 import re
-import geowombat as gw
+from interpolation import (
+    build_interpolation_tasks,
+    check_serial_outputs,
+    group_by_grid,
+    run_tasks,
+    size_task_windows,
+)
 
 # interpolate missing values in the time series
 missing_data = nan
@@ -34,36 +40,51 @@ bands = [
     "B12",
 ]
 
-os.chdir(
-    "/mnt/bigdrive/Dropbox/wb_malawi/malawi_imagery_new"
-)  # "/mnt/bigdrive/Dropbox/wb_malawi")
 output_dir = "interpolated"
-os.makedirs(os.path.join(os.getcwd(), output_dir), exist_ok=True)
 
 # set interpolation method
 interp_type = "linear"
+# "xr_fresh" for interpolate_nan or "numba" for interpolation.fill_gaps
+kernel = "xr_fresh"
 
-south_tiles = sorted(glob("./**/*S2_SR_*_south*.tif"))
-south_tiles
+# the defaults write the same stacks as the serial loop, byte for byte, only
+# several (band, grid) tasks run at once, check with --check_serial
+# extend existing stacks by the newly exported quarters instead of rebuilding
+# them, only trailing gaps closed by a new quarter are interpolated again
+append = False
+# read all bands of a grid together, one window at a time, instead of one pass per band
+multiband = False
+# only interpolate pixels that have a missing quarter
+skip_complete = False
+# stack codec, e.g. "zstd" for tiled stacks (see python cog.py benchmark), None
+# writes with the serial loop's options
+codec = None
+# size the windows from the memory budget instead of [512, 512]
+size_windows = False
 
-# Get unique grid codes
 
-pattern = r"((north|south)-\d+-\d+)(?=\.tif)"
-unique_grids = list(
-    set(
-        [
-            re.search(pattern, file_path).group()
-            for file_path in south_tiles
-            if re.search(pattern, file_path)
-        ]
+def main():
+    # e.g. python 1_interpolate_missing_values.py --mem 32GB --workers 4
+    parser = argparse.ArgumentParser(description="interpolate missing quarters")
+    parser.add_argument("--mem", type=str, default="200GB", help="memory budget")
+    parser.add_argument("--workers", type=int, default=12, help="concurrent tasks")
+    parser.add_argument(
+        "--check_serial",
+        action="store_true",
+        help="rerun the tasks serially and compare the stacks byte for byte",
     )
-)
-unique_grids
+    args, _ = parser.parse_known_args()
+
+    os.chdir(
+        "/mnt/bigdrive/Dropbox/wb_malawi/malawi_imagery_new"
+    )  # "/mnt/bigdrive/Dropbox/wb_malawi")
+    os.makedirs(os.path.join(os.getcwd(), output_dir), exist_ok=True)
+
+    south_tiles = sorted(glob("./**/*S2_SR_*_south*.tif"))
 
-# get unique year and quarter
-pattern = r"\d{4}_Q\d{2}"
-unique_quarters = sorted(
-    list(
+    # Get unique grid codes
+    pattern = r"((north|south)-\d+-\d+)(?=\.tif)"
+    unique_grids = list(
         set(
             [
                 re.search(pattern, file_path).group()
@@ -72,47 +93,68 @@ unique_quarters = sorted(
             ]
         )
     )
-)
-unique_quarters
-
-# add north tiles to the unique grids
-north_tiles = ["north"]
-unique_grids += north_tiles
-unique_grids
-################################################
-# %% interpolate missing values in the time series
-for band_name in bands:
-    files = f"./{band_name}"
-    file_glob = f"{files}/*.tif"
-
-    f_list = sorted(glob(file_glob))
-    print(f_list)
-
-    for grid in unique_grids:
-        print("working on grid", grid)
-        a_grid = sorted([f for f in f_list if grid in f])
-        print("files:", a_grid)
-        with gw.config.update(bigtiff="yes"):
-            with gw.series(
-                a_grid,
-                transfer_lib="jax",  # use jax takes longer to start but faster
-                window_size=[512, 512],
-            ) as src:
-                src.apply(
-                    func=interpolate_nan(
-                        interp_type=interp_type,
-                        missing_value=missing_data,
-                        count=len(src.filenames),
-                    ),
-                    outfile=os.path.join(
-                        os.getcwd(),
-                        output_dir,
-                        f"{band_name}_S2_SR_interp_{interp_type}_{grid}.tif",
-                    ),
-                    num_workers=1,  # src.nchunks,
-                    bands=1,
-                    kwargs={"BIGTIFF": "YES"},
-                )
+
+    # get unique year and quarter
+    pattern = r"\d{4}_Q\d{2}"
+    unique_quarters = sorted(
+        list(
+            set(
+                [
+                    re.search(pattern, file_path).group()
+                    for file_path in south_tiles
+                    if re.search(pattern, file_path)
+                ]
+            )
+        )
+    )
+    print("quarters:", unique_quarters)
+
+    # add north tiles to the unique grids
+    north_tiles = ["north"]
+    unique_grids += north_tiles
+    ################################################
+    # interpolate missing values in the time series
+    # one task per (band, grid), run in parallel as long as the tasks fit in memory
+    max_workers = args.workers  # concurrent (band, grid) tasks
+    mem_budget = args.mem  # memory shared by all running tasks
+
+    tasks = build_interpolation_tasks(
+        bands,
+        unique_grids,
+        input_dir=".",
+        output_dir=os.path.join(os.getcwd(), output_dir),
+        interp_type=interp_type,
+        missing_value=missing_data,
+        transfer_lib="jax",  # use jax takes longer to start but faster
+        kernel=kernel,
+        skip_complete=skip_complete,
+        append=append,
+        codec=codec,
+    )
+    if multiband:
+        tasks = group_by_grid(tasks)
+    if size_windows:
+        # windows sized to the budget and aligned to the GeoTIFF tiles
+        tasks = size_task_windows(
+            tasks, mem_budget=mem_budget, max_workers=max_workers
+        )
+    for task in tasks:
+        print(task["band"], task["grid"], task["mode"], "files:", task["files"])
+
+    run_tasks(
+        tasks,
+        max_workers=max_workers,
+        mem_budget=mem_budget,
+        log_file=os.path.join(output_dir, "interpolation_timings.csv"),
+    )
+    if args.check_serial:
+        check_serial_outputs(tasks, os.path.join(output_dir, "serial_check"))
+
+
+# guard so spawned workers that import this script do not glob the inputs,
+# size the windows and rerun the tasks
+if __name__ == "__main__":
+    main()
 
 # switch to geowombat env
 # NOTE use 1a_create_mosaics.py next
@@ -18,26 +18,35 @@
 
 # tifs should be in floating point 32 or 64
 
+# or run 2b_build_stacks.py to write these together with the single band
+# products from one read of the interpolated stacks
+
 
 def main():
     import argparse
-    import geowombat as gw
     import os
     from helpers import list_files_pattern
+    from execution import ExecutionContext
+    from mosaic import OVERLAP_RULES, TileIndex, layer_means, tile_grid, write_mosaics
     from numpy import nan
     from glob import glob
-    from geowombat.backends.rasterio_ import get_file_bounds
-    from xarray import concat
-    import dask.array as da
-
-    # get arguments from the command line
-    parser = argparse.ArgumentParser(description="stack bgrn bands into a mosaic")
-    parser.add_argument("north_or_south", type=str, help="type 'north' or 'south'")
-    args = parser.parse_args()
 
     # get command line arguments
     parser = argparse.ArgumentParser(description="stack bgrn bands into a mosaic")
     parser.add_argument("north_or_south", type=str, help="type 'north' or 'south'")
+    parser.add_argument(
+        "--rule",
+        type=str,
+        default="max",
+        choices=OVERLAP_RULES,
+        help="how overlapping tiles combine, see mosaic.TileIndex.read",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="defaults to the node's cpus"
+    )
+    parser.add_argument(
+        "--distributed", action="store_true", help="local dask cluster with dashboard"
+    )
     args = parser.parse_args()
 
     # location of the interpolated image stacks
@@ -98,159 +107,63 @@ def main():
     north_south = grid  # re.search(r"(north|south)", grid, re.IGNORECASE).group(0)
 
     # isolate the grid
-    a_grid = sorted([f for f in images if grid in f])
+    # skip the {stack}_last.tif sidecars of incremental interpolation
+    a_grid = sorted([f for f in images if grid in f and not f.endswith("_last.tif")])
 
     # pattern = r"linear_*_(.+?)\.tif"
     pattern = r"linear_([^_]+?)\.tif"
     grid_code = list_files_pattern(a_grid, pattern)
 
     # get list of files for each band in order B2, B3, B4, B8
-    bgrn = [sorted([f for f in a_grid if f"{band}" in f]) for band in band_order]
-    bounds = get_file_bounds(
-        bgrn[0],
-        bounds_by="union",
-        return_bounds=True,
-    )
-
-    for quarter in unique_quarters:
-
-        # skip unnecessary quarters
-        if quarter in skip_quarters:
-            print("skipping quarter:", quarter)
-            continue
-        print("working on quarter:", quarter, "north_south:", north_south)
-
-        if north_south == "south":
-            with gw.config.update(bigtiff="YES", ref_bounds=bounds):
-
-                # open each band seperately and interate over quarters
-                with gw.open(
-                    bgrn[0][0], band_names=unique_quarters, mosaic=True, overlap="max"
-                ) as B2a:
-                    B2a = B2a.sel(band=quarter)
-                    with gw.open(
-                        bgrn[0][1],
-                        band_names=unique_quarters,
-                        mosaic=True,
-                        overlap="max",
-                    ) as B2b:
-                        B2b = B2b.sel(band=quarter)
-                        B2 = da.maximum(
-                            B2a, B2b
-                        )  # mosaic not working w very large files use instead
-                        B2 = B2.fillna(B2.mean(skipna=True))
-
-                with gw.open(
-                    bgrn[1][0],
-                    band_names=unique_quarters,
-                    mosaic=True,
-                    overlap="max",
-                ) as B3a:
-                    B3a = B3a.sel(band=quarter)
-                    with gw.open(
-                        bgrn[1][1],
-                        band_names=unique_quarters,
-                        mosaic=True,
-                        overlap="max",
-                    ) as B3b:
-                        B3b = B3b.sel(band=quarter)
-                        B3 = da.maximum(B3a, B3b)
-                        B3 = B3.fillna(B3.mean(skipna=True))
-
-                with gw.open(
-                    bgrn[2][0],
-                    band_names=unique_quarters,
-                    mosaic=True,
-                    overlap="max",
-                ) as B4a:
-                    B4a = B4a.sel(band=quarter)
-                    with gw.open(
-                        bgrn[2][1],
-                        band_names=unique_quarters,
-                        mosaic=True,
-                        overlap="max",
-                    ) as B4b:
-                        B4b = B4b.sel(band=quarter)
-                        B4 = da.maximum(B4a, B4b)
-                        B4 = B4.fillna(B4.mean(skipna=True))
-
-                with gw.open(
-                    bgrn[3][0],
-                    band_names=unique_quarters,
-                    mosaic=True,
-                    overlap="max",
-                ) as B8a:
-                    B8a = B8a.sel(band=quarter)
-                    with gw.open(
-                        bgrn[3][1],
-                        band_names=unique_quarters,
-                        mosaic=True,
-                        overlap="max",
-                    ) as B8b:
-                        B8b = B8b.sel(band=quarter)
-                        B8 = da.maximum(B8a, B8b)
-                        B8 = B8.fillna(B8.mean(skipna=True))
-
-                bands = [B2, B3, B4, B8]
-                out = concat(bands, dim="band")
-                out.attrs = B2.attrs
-
-                print("files:", bgrn)
-                out = out.astype("float32")
-
-                out_name = f"{output_dir}/S2_SR_{quarter}_{north_south}.tif"
-                out.gw.save(
-                    filename=out_name,
-                    nodata=nan,
-                    overwrite=True,
-                    num_workers=19,
-                    compress="lzw",
-                )
-        else:
-            with gw.open(
-                bgrn[0][0],
-                band_names=unique_quarters,
-            ) as B2:
-
-                B2 = B2.sel(band=quarter)
-                B2 = B2.fillna(B2.mean(skipna=True))
-
-            with gw.open(
-                bgrn[1][0],
-                band_names=unique_quarters,
-            ) as B3:
-                B3 = B3.sel(band=quarter)
-                B3 = B3.fillna(B3.mean(skipna=True))
-
-            with gw.open(
-                bgrn[2][0],
-                band_names=unique_quarters,
-            ) as B4:
-                B4 = B4.sel(band=quarter)
-                B4 = B4.fillna(B4.mean(skipna=True))
+    # match the band prefix so B2 does not pick up the B12 stacks
+    bgrn = [
+        sorted([f for f in a_grid if f.startswith(f"{band}_")]) for band in band_order
+    ]
 
-            with gw.open(
-                bgrn[3][0],
-                band_names=unique_quarters,
-            ) as B8:
-                B8 = B8.sel(band=quarter)
-                B8 = B8.fillna(B8.mean(skipna=True))  # stack the bands
+    # one tile index per band on a shared grid, any number of tiles per band
+    out_grid = tile_grid([f for band_files in bgrn for f in band_files])
+    indexes = [TileIndex(band_files, out_grid) for band_files in bgrn]
 
-            bands = [B2, B3, B4, B8]
-            out = concat(bands, dim="band")
-            out.attrs = B2.attrs
+    # skip unnecessary quarters
+    quarters = [q for q in unique_quarters if q not in skip_quarters]
+    print("skipping quarters:", skip_quarters)
+    print("working on quarters:", quarters, "north_south:", north_south)
 
-            print("files:", bgrn)
-            out = out.astype("float32")
+    # each stack holds one band per quarter
+    quarter_bands = [unique_quarters.index(quarter) + 1 for quarter in quarters]
+    out_names = [
+        f"{output_dir}/S2_SR_{quarter}_{north_south}.tif" for quarter in quarters
+    ]
+    # gaps take the band mean from the interpolation statistics sidecars
+    fill = [
+        layer_means([(index, band) for index in indexes], rule=args.rule)
+        for band in quarter_bands
+    ]
 
-            out_name = f"{output_dir}/S2_SR_{quarter}_{north_south}.tif"
-            out.gw.save(
-                filename=out_name,
-                nodata=nan,
-                overwrite=True,
-                num_workers=19,
-                compress="lzw",
-            )
+    print("files:", bgrn)
+    # read each window once for all quarters and write every quarter's mosaic,
+    # the --rule (max, like da.maximum, by default) only runs where tiles overlap
+    # workers sized to the node's cpus, cgroup quota and memory limit instead of
+    # num_workers=19, per window timings are saved with the mosaics
+    with ExecutionContext(
+        n_workers=args.workers,
+        distributed=args.distributed,
+        timings_path=f"{output_dir}/timings_{north_south}.csv",
+    ) as context:
+        write_mosaics(
+            indexes,
+            quarter_bands,
+            out_names,
+            rule=args.rule,
+            fill=fill,
+            dtype="float32",
+            nodata=nan,
+            compress="deflate",  # COG, spfeas reads these with an older GDAL
+            context=context,
+        )
+
+    for index in indexes:
+        index.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,153 @@
+# switch to geowombat env
+# %% build every stack product from one read of the interpolated stacks
+# author: Michael Mann mmann1123@gwu.edu
+# to run from terminal: python 2b_build_stacks.py south
+# or only some products: python 2b_build_stacks.py south --products bgrn
+
+# replaces running 2_create_mosaics.py (float32 BGRN) and 6_stack_2_single_band.py
+# (B8, B11, B12 x 10000 int16) separately, the shared B8 stacks are read once
+
+# expected file structure:
+# interpolated (set current directory here)
+# ├── B2_S2_SR_interp_linear_south-0000000000-0000000000.tif
+# ├── B2_S2_SR_interp_linear_south-0000000000-0000023296.tif
+# ├── etc
+
+# products: which bands, dtype, scale factor, output layout and codec, outputs are
+# Cloud Optimized GeoTIFFs, compare codecs with python cog.py benchmark
+products = {
+    "bgrn": {
+        "bands": ["B2", "B3", "B4", "B8"],
+        "dtype": "float32",
+        "scale": 1,
+        "layout": "multiband",
+        "path": "../mosaic/S2_SR_{quarter}_{zone}.tif",
+        # spfeas reads the mosaics with an older GDAL
+        "codec": "deflate",
+    },
+    "single_band": {
+        "bands": ["B8", "B11", "B12"],
+        "dtype": "int16",
+        "scale": 10000,
+        "layout": "single_band",
+        "path": "../single_band_mosaics/{band}_S2_SR_{quarter}_{zone}.tif",
+        "codec": "zstd",
+    },
+}
+
+
+def main():
+    import argparse
+    import os
+    from glob import glob
+    from execution import ExecutionContext
+    from mosaic import OVERLAP_RULES, TileIndex, tile_grid, write_products
+
+    parser = argparse.ArgumentParser(description="build stack products")
+    parser.add_argument("north_or_south", type=str, help="type 'north' or 'south'")
+    parser.add_argument(
+        "--products",
+        type=str,
+        nargs="+",
+        default=list(products),
+        choices=list(products),
+        help="products to write",
+    )
+    parser.add_argument(
+        "--rule",
+        type=str,
+        default="max",
+        choices=OVERLAP_RULES,
+        help="how overlapping tiles combine, see mosaic.TileIndex.read",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="defaults to the node's cpus"
+    )
+    parser.add_argument(
+        "--distributed", action="store_true", help="local dask cluster with dashboard"
+    )
+    args = parser.parse_args()
+
+    # location of the interpolated image stacks
+    # os.chdir(r"/CCAS/groups/engstromgrp/mike/interpolated/")
+    os.chdir(r"/mnt/bigdrive/Dropbox/wb_malawi/malawi_imagery_new/interpolated")
+
+    images = glob(f"*.tif")
+    print("Number of images found:", len(images))
+    if not images:
+        raise ValueError("No images found in the folder")
+
+    # list all unique year and quarter
+    unique_quarters = [
+        "2020_Q01",
+        "2020_Q02",
+        "2020_Q03",
+        "2020_Q04",
+        "2021_Q01",
+        "2021_Q02",
+        "2021_Q03",
+        "2021_Q04",
+        "2022_Q01",
+        "2022_Q02",
+        "2022_Q03",
+        "2022_Q04",
+        "2023_Q01",
+        "2023_Q02",
+        "2023_Q03",
+        "2023_Q04",
+        "2024_Q01",
+        "2024_Q02",
+    ]
+
+    # Set quaters that should be skipped
+    skip_quarters = [
+        "2024_Q01",
+        "2024_Q02",
+    ]
+
+    grid = args.north_or_south
+    # skip the {stack}_last.tif sidecars of incremental interpolation
+    a_grid = sorted([f for f in images if grid in f and not f.endswith("_last.tif")])
+    specs = [products[name] for name in args.products]
+
+    # one tile index per band needed by any product, on a shared grid
+    band_names = list(dict.fromkeys(b for spec in specs for b in spec["bands"]))
+    band_files = {
+        band: sorted([f for f in a_grid if f.startswith(f"{band}_")])
+        for band in band_names
+    }
+    print("files:", band_files)
+    out_grid = tile_grid([f for files in band_files.values() for f in files])
+    indexes = {band: TileIndex(files, out_grid) for band, files in band_files.items()}
+
+    quarters = [q for q in unique_quarters if q not in skip_quarters]
+    print("working on quarters:", quarters, "north_south:", grid)
+
+    # each stack holds one band per quarter, overlapping tiles combine with --rule
+    # and gaps take the band mean from the interpolation statistics sidecars
+    # workers sized to the node's cpus, cgroup quota and memory limit, per window
+    # timings are saved next to the output stacks of the first product
+    output_dir = os.path.dirname(specs[0]["path"])
+    os.makedirs(output_dir or ".", exist_ok=True)
+    with ExecutionContext(
+        n_workers=args.workers,
+        distributed=args.distributed,
+        timings_path=os.path.join(output_dir, f"stack_timings_{grid}.csv"),
+    ) as context:
+        written = write_products(
+            indexes,
+            [unique_quarters.index(quarter) + 1 for quarter in quarters],
+            quarters,
+            specs,
+            fields={"zone": grid},
+            rule=args.rule,
+            context=context,
+        )
+    print(f"wrote {len(written)} files")
+
+    for index in indexes.values():
+        index.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -3,8 +3,22 @@
 # author: Michael Mann GWU mmann1123@gwu.edu
 # run from terminal as
 # python 2_run_spfeas.py
-# then submit all the batch scripts using
-# bash run_all_spfeas_batch_files.sh or follow prompt
+# then follow the prompt, or submit without asking with --yes, print the jobs
+# without submitting with --dry_run, or run every task on this machine with
+# python 3_run_spfeas.py --backend local --cpus_per_task 2 --memory_per_task 16GB --yes
+
+# each stage is one Slurm job array driven by a task manifest (see slurm.py): one
+# spfeas task per image x feature, and when chain_vrt_to_tif is True one VRT to
+# tif task per spfeas task that starts as soon as its feature finished (aftercorr)
+
+# with shard_size set each mosaic is cut into shards with a halo of the feature's
+# largest scale (see tiling.plan_shards), spfeas runs once per shard and keeps
+# the core, and a stitch task per image x feature mosaics the cores into one VRT
+# (then tifs) once every shard finished, so a zone spreads over as many nodes
+
+# every run writes its manifests, array scripts, logs and runtimes to a new
+# spfeas_batch_scripts/run_{time}_{id} folder (dry_run_... with --dry_run) and
+# leaves earlier runs alone, their arrays may still be queued
 
 # input file structure:
 # mosaics
@@ -15,12 +29,24 @@
 # NOTE: --overwrite doesn't work for spfeas, so delete the output folder if you want to rerun
 
 
+import argparse
 import os
 from glob import glob
 from functions import *  # import helper functions
-import subprocess
 from tqdm import tqdm
-from multiprocessing import Pool
+from cog import gdal_translate_options, gdaladdo_command
+from scheduler import (
+    CostModel,
+    RuntimeHistory,
+    array_label,
+    image_pixels,
+    job_arrays,
+    plan_jobs,
+    timed_command,
+)
+from executors import add_executor_arguments, confirm, executor_from_args
+from slurm import run_folder, write_manifest
+from tiling import raster_shards
 
 
 ############### EDIT THE FOLLOWING ################
@@ -31,10 +57,15 @@ output_folder_name = (
 )
 
 band_order = "bgrn"  # band order for spfeas
-partition = "defq"  # partition for slurm
-time_request = "04-12:35:00"  # time request for slurm DD-HH:MM:SS
 email = "mmann1123@gwu.edu"  # email for slurm notifications
 
+# partitions and time requests come from a cost model fit on the runtimes of
+# earlier runs (see scheduler.py), tasks are split by scale or packed into jobs
+candidate_partitions = ["tiny", "short", "defq"]  # shortest limit first
+split_features = ["gabor", "fourier"]  # one task per scale, the slowest features
+pack_hours = 2  # cheap tasks are grouped into jobs of about this many hours
+runtime_history_name = "spfeas_runtimes.csv"  # kept in the output folder
+
 # features to run and what scales
 feature_scale_dict = {
     "hog": [3, 5, 7],
@@ -47,16 +78,35 @@ feature_scale_dict = {
     "orb": [31, 51, 71],
     "gabor": [3, 5, 7],
     "fourier": [31, 51, 71],
-    # NOTE: Consider breaking gabor and fourier into separate scripts because they take so long
-    # eg "gabor": [3], "gabor": [5], "gabor": [7]  UNTESTED
+    # NOTE: features in split_features run one job per scale
 }
 
+# core pixels per side of the spfeas shards, e.g. 4096, None runs whole mosaics.
+# shards read a halo of the feature's largest scale, the stitched features match
+# an unsharded run as long as spfeas runs with --block 1
+shard_size = None
+
 image_name_subset = "*"  # subset of images to process, use '*' for all images or '*south*' for only south images
+max_parallel = None  # spfeas array elements running at once, None for no limit
+
+# convert each feature's VRT to tifs (4_features_to_tifs.py) as soon as it is done
+chain_vrt_to_tif = True
+vrt_partition = "short"  # partition for the VRT to tif jobs
+vrt_time_request = "00-23:59:00"  # time request for the VRT to tif jobs
+feature_dtype = "float32"  # spfeas output dtype, sets the predictor
+codec = "deflate"  # see python cog.py benchmark, the spfeas env has an older GDAL
 
 ################ Don't edit below this line ################
 
+parser = argparse.ArgumentParser(description="run spfeas on slurm or locally")
+args = add_executor_arguments(parser).parse_args()
+
 # check for errors in slurm partition and time request
-check_partition_time(partition, time_request)
+for candidate in candidate_partitions:
+    if candidate not in partitions:
+        raise ValueError(f"Partition not found in partitions dictionary: {candidate}")
+if chain_vrt_to_tif:
+    check_partition_time(vrt_partition, vrt_time_request)
 
 
 # throw error if band order is not correct
@@ -84,95 +134,262 @@ os.makedirs(output_folder, exist_ok=True)
 os.makedirs(os.path.join(output_folder, "features"), exist_ok=True)
 
 
-# make folder to hold batch scripts
+# make folder to hold the runs, queued arrays read their manifests at start so
+# nothing in an earlier run is removed or overwritten
 batch_script_path = os.path.join(output_folder, "spfeas_batch_scripts")
 os.makedirs(batch_script_path, exist_ok=True)
-# remove all files in the folder
-files = glob(os.path.join(batch_script_path, "*.sh"))
-with Pool() as p:
-    # Use tqdm for progress bar
-    for _ in tqdm(
-        p.imap_unordered(remove_file, files),
-        total=len(files),
-        desc="erasing existing batch scripts",
-    ):
-        pass
-
-# write the batch script to run all the other batch scripts
-with open(f"{output_folder}/run_all_spfeas_batch_files.sh", "w") as f:
-
-    f.write(
-        f"""#!/bin/bash
-
-# Set the folder containing the .sh files
-folder={batch_script_path}
-
-# Loop through each .sh file in the folder
-for file in "$folder"/*.sh; do
-    # Submit the .sh file to Slurm
-    sbatch "$file"
-done
-"""
+
+# runtimes of tasks finished in earlier runs go to the history, then fit the
+# cost model that sizes this run's jobs
+history = RuntimeHistory(os.path.join(output_folder, runtime_history_name))
+for previous_run in sorted(glob(os.path.join(batch_script_path, "run_*"))):
+    history.collect(
+        glob(os.path.join(previous_run, "spfeas_*_manifest.jsonl")),
+        os.path.join(previous_run, "runtimes"),
     )
+model = CostModel().fit(history.read())
 
-# for each image write a batch script
-for image in tqdm(images, desc="writing new batch scripts"):
-    for feature, scales in feature_scale_dict.items():
+run_path = run_folder(batch_script_path, "dry_run" if args.dry_run else "run")
+runtime_folder = os.path.join(run_path, "runtimes")
 
-        # get file name without extension
-        image_name = os.path.splitext(os.path.basename(image))[0]
+spfeas_env = """export PATH="/groups/engstromgrp/anaconda3/bin:$PATH"
+source activate Ryan_CondaEnvP2.7"""
 
-        # unpack scales as space separated string
-        scale_text = " ".join([str(scale) for scale in scales])
+feature_folder = os.path.join(output_folder, "features")
+shard_folder = os.path.join(output_folder, "shards")
+tif_folder = os.path.join(output_folder, "tifs")
+tif_options = gdal_translate_options(feature_dtype, codec)
 
-        # write the batch script
-        with open(
-            f"{batch_script_path}/{image_name}_{feature}_{scale_text}.sh", "w"
-        ) as f:
-            f.write(
-                f"""#!/bin/bash
-#SBATCH -p {partition}
-#SBATCH -J sp_{feature}_{image_name}_run
-#SBATCH --export=NONE
-#SBATCH -t {time_request}
-#SBATCH --mail-type=ALL
-#SBATCH --mail-user={email} 
-#SBATCH -e {batch_script_path}/{image_name}_{feature}.err
-#SBATCH -o {batch_script_path}/{image_name}_{feature}.out
+# one task per image x feature (x shard), split by scale and packed into jobs by
+# plan_jobs
+tasks = []
+for image in tqdm(images, desc="reading image sizes"):
+    # get file name without extension
+    image_name = os.path.splitext(os.path.basename(image))[0]
+    for feature, scales in feature_scale_dict.items():
+        task = {
+            "name": f"{image_name}_{feature}",
+            "image": image,
+            "image_name": image_name,
+            "feature": feature,
+            "scales": scales,
+        }
+        if not shard_size:
+            tasks.append({**task, "pixels": image_pixels(image)})
+            continue
+        for shard in raster_shards(image, shard_size, halo=max(scales)):
+            _, _, width, height = shard["window"]
+            tasks.append(
+                {
+                    **task,
+                    "name": f"{image_name}_{feature}_t{shard['shard_id']}",
+                    "pixels": width * height,
+                    "shard": shard,
+                }
+            )
+jobs = plan_jobs(
+    tasks,
+    model,
+    candidate_partitions,
+    split_features=split_features,
+    pack_hours=pack_hours,
+)
 
 
-export PATH="/groups/engstromgrp/anaconda3/bin:$PATH"
-source activate Ryan_CondaEnvP2.7
+def spfeas_command(task, image=None, output=None):
+    # unpack scales as space separated string
+    scale_text = " ".join([str(scale) for scale in task["scales"]])
+    # output folders will be created automatically
+    image = image or task["image"]
+    output = output or os.path.join(feature_folder, task["name"])
+    return f"spfeas -i {image} -o {output} --block 1 --scales {scale_text} --tr {task['feature']} --overwrite"
+
+
+def core_path(task):
+    # spfeas output of a shard without its halo
+    return os.path.join(shard_folder, f"{task['name']}.tif")
+
+
+def shard_command(task):
+    # cut the shard with its halo, run spfeas on it and keep the core
+    work = os.path.join(shard_folder, task["name"])
+    window = " ".join(str(v) for v in task["shard"]["window"])
+    crop = " ".join(str(v) for v in task["shard"]["crop"])
+    return "\n".join(
+        [
+            # a stale core from an earlier run would pass the stitch check
+            f"rm -rf {work} {core_path(task)}",
+            f"mkdir -p {work}",
+            f"gdal_translate -q -srcwin {window} {task['image']} {work}/input.tif",
+            spfeas_command(task, f"{work}/input.tif", f"{work}/spfeas"),
+            f"vrt=$(ls {work}/spfeas/*TR{task['feature']}.vrt | head -n 1)",
+            f"gdal_translate -q -srcwin {crop} {tif_options} $vrt {core_path(task)}",
+            f"rm -rf {work}",
+        ]
+    )
 
-# output folders will be created automatically
-spfeas -i {image} -o {os.path.join(output_folder, "features", image_name+'_'+feature)} --block 1 --scales {scale_text} --tr {feature} --overwrite
 
-"""
-            )
+def stitch_command(group, cores):
+    # mosaic the shard cores of one image x feature into a VRT named like spfeas
+    # names them, fails if a shard is missing instead of leaving a hole
+    output = os.path.join(feature_folder, group["name"])
+    scale_text = "-".join(str(scale) for scale in group["scales"])
+    vrt = f"{output}/{group['image_name']}_SC{scale_text}_TR{group['feature']}.vrt"
+    core_list = os.path.join(run_path, f"{group['name']}_cores.txt")
+    with open(core_list, "w") as f:
+        f.write("\n".join(cores) + "\n")
+    return "\n".join(
+        [
+            f"for core in $(cat {core_list}); do test -f $core; done",
+            f"mkdir -p {output}",
+            f"gdalbuildvrt -q -overwrite -input_file_list {core_list} {vrt}",
+        ]
+    )
+
+
+def vrt_command(task):
+    # the VRT name is only known once spfeas wrote it
+    output = os.path.join(feature_folder, task["name"])
+    find_vrt = f"vrt=$(ls {output}/*TR{task['feature']}.vrt | head -n 1)"
+    # tifs are named by image and feature whether or not the task was split
+    commands = vrt_to_tif_commands(
+        "$vrt",
+        f"{task['image_name']}_{task['feature']}",
+        task["feature"],
+        task["scales"],
+        tif_folder,
+        tif_options,
+        overviews=lambda tif: gdaladdo_command(tif, feature_dtype),
+    )
+    return "\n".join([find_vrt] + commands)
+
+
+# one array per partition and time request, element i of the VRT to tif array
+# converts the outputs of element i of its spfeas array
+task_fields = ["name", "feature", "scales", "pixels", "estimate_seconds"]
+stages = []
+for (job_partition, job_time), array_jobs in job_arrays(jobs).items():
+    label = array_label(job_partition, job_time)
+    entries = []
+    vrt_entries = []
+    for job in array_jobs:
+        entries.append(
+            {
+                "name": job["name"],
+                "partition": job_partition,
+                "time_request": job_time,
+                "estimate_seconds": job["estimate_seconds"],
+                # task metadata for the runtime history
+                "tasks": [
+                    {key: task[key] for key in task_fields} for task in job["tasks"]
+                ],
+                "command": "\n".join(
+                    timed_command(
+                        task["name"],
+                        shard_command(task) if shard_size else spfeas_command(task),
+                        runtime_folder,
+                    )
+                    for task in job["tasks"]
+                ),
+            }
+        )
+        vrt_entries.append(
+            {
+                "name": f"{job['name']}_vrt2tif",
+                "command": "\n".join(vrt_command(task) for task in job["tasks"]),
+            }
+        )
+    manifest = write_manifest(
+        f"{run_path}/spfeas_{label}_manifest.jsonl", entries
+    )
+    stages.append(
+        {
+            "name": f"spfeas_{label}",
+            "manifest": manifest,
+            "job_name": f"sp_{label}",
+            "partition": job_partition,
+            "time_request": job_time,
+            "setup": spfeas_env,
+            "max_parallel": max_parallel,
+        }
+    )
+    n_tasks = sum(len(job["tasks"]) for job in array_jobs)
+    print(f"{label}: {len(array_jobs)} jobs, {n_tasks} tasks")
+    if chain_vrt_to_tif and not shard_size:
+        os.makedirs(tif_folder, exist_ok=True)
+        vrt_manifest = write_manifest(
+            f"{run_path}/vrt_to_tif_{label}_manifest.jsonl", vrt_entries
+        )
+        stages.append(
+            {
+                "name": f"vrt_to_tif_{label}",
+                "manifest": vrt_manifest,
+                "job_name": f"vrt2tif_{label}",
+                "partition": vrt_partition,
+                "time_request": vrt_time_request,
+                "setup": spfeas_env,
+                "after": f"spfeas_{label}",
+                # element i starts once spfeas element i finished ok
+                "dependency": "aftercorr",
+            }
+        )
+
+# one stitch task per image x feature (x scale when split), after every spfeas
+# array ended (afterany) since the shards of a feature land in several arrays
+if shard_size:
+    os.makedirs(shard_folder, exist_ok=True)
+    groups = {}
+    for job in jobs:
+        for task in job["tasks"]:
+            name = f"{task['image_name']}_{task['feature']}"
+            if "split_from" in task:
+                name += f"_sc{task['scales'][0]}"
+            group = groups.setdefault(name, {**task, "name": name, "cores": []})
+            group["cores"].append(core_path(task))
+    stitch_entries = []
+    for group in groups.values():
+        commands = [stitch_command(group, sorted(group["cores"]))]
+        if chain_vrt_to_tif:
+            os.makedirs(tif_folder, exist_ok=True)
+            commands.append(vrt_command(group))
+        stitch_entries.append(
+            {"name": f"{group['name']}_stitch", "command": "\n".join(commands)}
+        )
+    stitch_manifest = write_manifest(
+        f"{run_path}/stitch_manifest.jsonl", stitch_entries
+    )
+    stages.append(
+        {
+            "name": "stitch",
+            "manifest": stitch_manifest,
+            "job_name": "stitch",
+            "partition": vrt_partition,
+            "time_request": vrt_time_request,
+            "setup": spfeas_env,
+            "after": [stage["name"] for stage in stages],
+            "dependency": "afterany",
+        }
+    )
+    print(f"stitch: {len(stitch_entries)} features from {len(tasks)} shard tasks")
 
 
 print(
     f"""\n\n############# IMPORANT ################## 
 #############################################
-All batch scripts will be written to folder: {batch_script_path}
-
-Execute all batch scripts using:  {output_folder}/run_all_spfeas_batch_files.sh
+{len(tasks)} spfeas tasks, {sum(len(job["tasks"]) for job in jobs)} after splitting by scale, packed into {len(jobs)} jobs
+Job arrays, task manifests and logs are written to folder: {run_path}
+Runtimes of finished tasks are added to {history.path} on the next run
 
-All output feature vrts and images will be writen to: {output_folder}/features
+All output feature vrts and images will be writen to: {feature_folder}
 #############################################
 #############################################
 
     """
 )
 
-# Ask the user if they want to execute the bash script
-execute_script = input(
-    f"Execute all the batch scripts and create all spfeas features? (yes/no): "
-)
-
-
-# If the user answers 'yes', execute the bash script
-if execute_script.lower() == "yes":
-    subprocess.run(["bash", f"{output_folder}/run_all_spfeas_batch_files.sh"])
+# Ask the user if they want to run the tasks, unless --yes or --dry_run
+executor = executor_from_args(args, email=email, log_dir=run_path)
+if confirm(args, f"Run all {args.backend} jobs and create all spfeas features?"):
+    executor.run(stages, dry_run=args.dry_run)
 
 # %%
@@ -1,20 +1,29 @@
 # %% execute the following code to convert the VRT files to TIF files
-# it will create a series of bash scripts that will be executed in parallel
-# in a folder called batch_scripts_vrt_to_tif in the parent directory of the feature VRT files
+# it writes a task manifest with one task per VRT x scale and submits it as a
+# single Slurm job array (see slurm.py), the manifest, script and logs of each
+# run go to a new run_{time}_{id} folder (dry_run_... with --dry_run) in
+# batch_scripts_vrt_to_tif in the parent directory of the feature VRT files,
+# earlier runs are left alone since their arrays may still be queued
 # author: Michael Mann GWU
 # from terminal:
 # python 3_features_to_tifs.py
+# print the sbatch call without submitting: python 4_features_to_tifs.py --dry_run
+# start after a running spfeas array: python 4_features_to_tifs.py --after 123456
+# convert on this machine without asking: python 4_features_to_tifs.py --backend local --yes
+# 3_run_spfeas.py chains this conversion per feature when chain_vrt_to_tif is True
 # Import modules
 
 # NOTE gabor takes 9 hours to process most others less than 2 hours . consider spliting gabor
 
 # %%
+import argparse
 import os
+import re
 from glob import glob
 from functions import *
-from multiprocessing import Pool
-import subprocess
-from tqdm import tqdm
+from cog import gdal_translate_options, gdaladdo_command
+from executors import add_executor_arguments, confirm, executor_from_args
+from slurm import run_folder, write_manifest
 
 ################################################
 # NEED TO EDIT THIS LINES
@@ -29,13 +38,25 @@ vrt_glob = '*'   # Subset features: use '*' for all vrt files or '*fourier*' or
 partition = "short"  # partition for slurm
 time_request = "00-23:59:00"  # time request for slurm DD-HH:MM:SS
 email = "mmann1123@gwu.edu"  # email for slurm notifications
+feature_dtype = "float32"  # spfeas output dtype, sets the predictor
+codec = "deflate"  # see python cog.py benchmark, the spfeas env has an older GDAL
 
 
 ################ Don't edit below this line ################
 
+parser = argparse.ArgumentParser(description="convert spfeas vrts to tifs")
+add_executor_arguments(parser)
+parser.add_argument(
+    "--after", type=str, default=None, help="slurm job id to wait for (afterok)"
+)
+args = parser.parse_args()
+
 # check for errors in slurm partition and time request
 check_partition_time(partition, time_request)
 
+# tiled output with the predictor for the dtype instead of plain LZW
+tif_options = gdal_translate_options(feature_dtype, codec)
+
 
 # create folder for feature tifs
 feature_tif_output_directory = os.path.join(
@@ -43,58 +64,13 @@ feature_tif_output_directory = os.path.join(
 )
 os.makedirs(feature_tif_output_directory, exist_ok=True)
 
-# create folder for batch scripts
+# create folder for batch scripts, one subfolder per run holds its manifest,
+# array script and slurm errors and outputs
 batch_script_path = os.path.join(
     os.path.dirname(feature_vrt_output_directory), "batch_scripts_vrt_to_tif"
 )
 os.makedirs(batch_script_path, exist_ok=True)
-
-
-# remove any existing batch scripts using pool map
-print("Removing existing batch scripts")
-# Get list of files
-files = glob(os.path.join(batch_script_path, "*.sh"))
-
-with Pool() as p:
-    # Use tqdm for progress bar
-    for _ in tqdm(p.imap_unordered(remove_file, files), total=len(files)):
-        pass
-
-# create folder for slurm errors and outputs
-slurm_output_directory = os.path.join(
-    os.path.dirname(feature_vrt_output_directory), "slurm_outputs"
-)
-os.makedirs(slurm_output_directory, exist_ok=True)
-
-# erase old slurm outputs
-files = glob(os.path.join(slurm_output_directory, "*.err")) + glob(
-    os.path.join(slurm_output_directory, "*.out")
-)
-with Pool() as p:
-    # Use tqdm for progress bar
-    for _ in tqdm(p.imap_unordered(remove_file, files), total=len(files)):
-        pass
-
-
-# write the batch script to run all the other batch scripts
-with open(
-    f"{os.path.dirname(feature_vrt_output_directory)}/run_all_vrt_to_tif_batch_files.sh",
-    "w",
-) as f:
-
-    f.write(
-        f"""#!/bin/bash
-
-# Set the folder containing the .sh files
-folder={batch_script_path}
-
-# Loop through each .sh file in the folder
-for file in "$folder"/*.sh; do
-    # Submit the .sh file to Slurm
-    sbatch "$file"
-done
-"""
-    )
+run_path = run_folder(batch_script_path, "dry_run" if args.dry_run else "run")
 
 
 # Get all VRT paths
@@ -108,130 +84,77 @@ else:
     print("Example", vrt_paths[:5])
 
 
-# for each vrt file get its scales and feature name, and region based on the vrt path
-
-
-def process_vrt(vrt):
+# one task per vrt and scale, bands are extracted in the spfeas output order
+tasks = []
+for vrt in vrt_paths:
     # get all scales
     scales = get_scales(vrt)
     # get feature name
     feature = get_feature_name(vrt)
 
-    # get folder name
-    folder = get_vrt_folder_name(vrt)
-
-    band_count = 0
+    # get folder name, tasks split by scale (3_run_spfeas.py) write to
+    # {image}_{feature}_sc{scale} but their tifs are named like the others
+    folder = re.sub(r"_sc\d+$", "", get_vrt_folder_name(vrt))
 
     for scale in scales:
-
-        print(
-            "Processing feature: ",
+        commands = vrt_to_tif_commands(
+            vrt,
+            folder,
             feature,
-            " with scales: ",
             scales,
-            " in folder: ",
-            folder,
+            feature_tif_output_directory,
+            tif_options,
+            overviews=lambda tif: gdaladdo_command(tif, feature_dtype),
+            scale=scale,
+        )
+        tasks.append(
+            {
+                "name": f"{folder}_{scale}_vrt_to_tif",
+                "vrt": vrt,
+                "feature": feature,
+                "scales": scales,
+                "scale": scale,
+                "command": "\n".join(commands),
+            }
         )
 
-        # bashscript output file name
-        bash_script_name = f"{folder}_{scale}_vrt_to_tif.sh"
-
-        # create bash script path
-        path_to_bash_script = os.path.join(batch_script_path, bash_script_name)
-
-        # delete the file if it exists
-        if os.path.exists(path_to_bash_script):
-            os.remove(path_to_bash_script)
-        print("Writing bash file to: ", path_to_bash_script)
-
-        # unpack scales as space separated string
-        scale_text = "_".join([str(scale) for scale in scales])
-
-        # Write SBATCH header
-        with open(os.path.join(path_to_bash_script), "a+") as file:
-            file.write(
-                f"""#!/bin/bash
-#SBATCH -p {partition}
-#SBATCH -J {folder}_{scale}_vrt2tif
-#SBATCH --export=NONE
-#SBATCH -t {time_request}
-#SBATCH --mail-type=ALL
-#SBATCH --mail-user={email}
-#SBATCH -e {slurm_output_directory}/{folder}_vrt2tif.err
-#SBATCH -o {slurm_output_directory}/{folder}_vrt2tif.out 
-
-export PATH="/groups/engstromgrp/anaconda3/bin:$PATH"
-source activate Ryan_CondaEnvP2.7
-
-# This script takes the VRT files (the output of spfeas) and extracts the VRT
-# band-by-band, assigning each band according to its output name. The order of
-# outputs is determined from the spfeas package.
-        
-    """
-            )
-
-        # Open file and add comment indicating the scale and the output
-        with open(os.path.join(path_to_bash_script), "a+") as file:
-            file.write(f"###################### \n #{folder.upper()}\n\n")
-
-        for output in feature_bands_table[feature]:
-
-            # Open file and add comment indicating the scale and the output
-            with open(os.path.join(path_to_bash_script), "a+") as file:
-                file.write(f"# scale: {scale}, output: {output}\n")
-
-            # Increase band count by 1
-            band_count += 1
-
-            # Create the relative path for the output tif that will be
-            output_tif = os.path.join(
-                feature_tif_output_directory,
-                folder + "_SC" + scale + "_" + output + ".tif",
-            )
-
-            # Open file and write the gdal command to extract the bands and write to tif
-            with open(os.path.join(path_to_bash_script), "a+") as file:
-                file.write(
-                    f'gdal_translate -b {band_count} -of GTiff -co "COMPRESS=LZW" -co "BIGTIFF=YES" {vrt} {output_tif}\n\n'
-                )
-
-
-with Pool() as p:
-    # Use tqdm for progress bar
-    for _ in tqdm(p.imap_unordered(process_vrt, vrt_paths), total=len(vrt_paths)):
-        pass
+manifest = write_manifest(
+    os.path.join(run_path, "vrt_to_tif_manifest.jsonl"), tasks
+)
+stages = [
+    {
+        "name": "vrt_to_tif",
+        "manifest": manifest,
+        "job_name": "vrt2tif",
+        "partition": partition,
+        "time_request": time_request,
+        "setup": """export PATH="/groups/engstromgrp/anaconda3/bin:$PATH"
+source activate Ryan_CondaEnvP2.7""",
+    }
+]
+# a placeholder stage lets the array wait for a job submitted elsewhere
+if args.after:
+    stages[0].update(after="previous", dependency="afterok")
+    stages.insert(0, {"name": "previous", "job_id": args.after})
 
 
 print(
     f"""\n\n############# IMPORANT ################## 
 #############################################
-All batch scripts will be written to folder: {batch_script_path}
-
-Execute all batch scripts using:  {os.path.dirname(feature_vrt_output_directory)}/run_all_vrt_to_tif_batch_files.sh
+{len(tasks)} tasks in one job array
+Task manifest: {manifest}
 
 All output tifs will be written to folder: {feature_tif_output_directory}
 
-Slurm outputs will be written to folder: {slurm_output_directory}
+Slurm outputs will be written to folder: {run_path}
 #############################################
 #############################################
 
     """
 )
 
-
-# Ask the user if they want to execute the bash script
-execute_script = input(
-    f"Execute all the batch scripts and convert spfeas vrts to tifs? (yes/no): "
-)
-
-
-# If the user answers 'yes', execute the bash script
-if execute_script.lower() == "yes":
-    subprocess.run(
-        [
-            "bash",
-            f"{os.path.dirname(feature_vrt_output_directory)}/run_all_vrt_to_tif_batch_files.sh",
-        ]
-    )
-# %%
+# Ask the user if they want to run the tasks, unless --yes or --dry_run
+executor = executor_from_args(args, email=email, log_dir=run_path)
+if confirm(args, f"Run the {args.backend} jobs and convert spfeas vrts to tifs?"):
+    executor.run(stages, dry_run=args.dry_run)
 # %%
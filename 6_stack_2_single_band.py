@@ -1,16 +1,14 @@
 # geoombwat env
 # OPTIONAL: convert multiband images to single band for time series feature extraction
 # author: Michael Mann GWU mmann1123@gwu.edu
+# or run 2b_build_stacks.py to write these together with the BGRN mosaics
+# from one read of the interpolated stacks
 
 from glob import glob
 import os
-import geowombat as gw
-import os
 from helpers import list_files_pattern
-from numpy import nan
-from glob import glob
-from geowombat.backends.rasterio_ import get_file_bounds
-import dask.array as da
+from execution import ExecutionContext
+from mosaic import OVERLAP_RULES, TileIndex, layer_means, tile_grid, write_mosaics
 import argparse
 
 
@@ -19,6 +17,19 @@ def main():
     parser = argparse.ArgumentParser(description="stack bgrn bands into a mosaic")
 
     parser.add_argument("north_or_south", type=str, help="type 'north' or 'south'")
+    parser.add_argument(
+        "--rule",
+        type=str,
+        default="max",
+        choices=OVERLAP_RULES,
+        help="how overlapping tiles combine, see mosaic.TileIndex.read",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="defaults to the node's cpus"
+    )
+    parser.add_argument(
+        "--distributed", action="store_true", help="local dask cluster with dashboard"
+    )
     args = parser.parse_args()
 
     # location of the interpolated image stacks
@@ -62,93 +73,63 @@ def main():
     grid = args.north_or_south
 
     # isolate the grid
-    a_grid = sorted([f for f in images if grid in f])
+    # skip the {stack}_last.tif sidecars of incremental interpolation
+    a_grid = sorted([f for f in images if grid in f and not f.endswith("_last.tif")])
 
     # pattern = r"linear_*_(.+?)\.tif"
     pattern = r"linear_([^_]+?)\.tif"
     grid_code = list_files_pattern(a_grid, pattern)
 
     # get list of files for each band in order B2, B3, B4, B8
-    bgrn = [sorted([f for f in a_grid if f"{band}" in f]) for band in band_order]
-    bounds = get_file_bounds(
-        bgrn[0],
-        bounds_by="union",
-        return_bounds=True,
-    )
+    # match the band prefix so e.g. B2 would not pick up the B12 stacks
+    bgrn = [
+        sorted([f for f in a_grid if f.startswith(f"{band}_")]) for band in band_order
+    ]
 
-    for quarter in unique_quarters:
-        # skip unnecessary quarters
-        if quarter in [
-            "2024_Q01",
-            "2024_Q02",
-        ]:
-            continue
-        print("working on quarter:", quarter, "north_south:", grid)
-
-        if grid == "south":
-            with gw.config.update(bigtiff="YES", ref_bounds=bounds):
-
-                for i, value in enumerate(bgrn):
-
-                    # open each band seperately and interate over quarters
-                    with gw.open(
-                        value[0],
-                        band_names=unique_quarters,
-                    ) as Banda:
-                        Banda = Banda.sel(band=quarter)
-                        with gw.open(
-                            value[1],
-                            band_names=unique_quarters,
-                        ) as Bandb:
-                            Bandb = Bandb.sel(band=quarter)
-                            Band = da.maximum(
-                                Banda, Bandb
-                            )  # mosaic not working w very large files use instead
-                            Band = Band.fillna(Band.mean(skipna=True))
-                            out = Band * 10000
-                            out.attrs = Band.attrs
-
-                            print("files:", bgrn)
-                            out = out.astype("int16")
-
-                            out_name = f"{output_dir}/{band_order[i]}_S2_SR_{quarter}_{grid}.tif"
-                            print(out_name)
-                            out.gw.save(
-                                filename=out_name,
-                                nodata=nan,
-                                overwrite=True,
-                                num_workers=19,
-                                compress="lzw",
-                            )
-        else:
-            with gw.config.update(bigtiff="YES", ref_bounds=bounds):
-
-                for i, value in enumerate(bgrn):
-
-                    # open each band seperately and interate over quarters
-                    with gw.open(
-                        value[0],
-                        band_names=unique_quarters,
-                    ) as Banda:
-                        Banda = Banda.sel(band=quarter)
-                        Band = Banda.fillna(Banda.mean(skipna=True))
-                        out = Band * 10000
-                        out.attrs = Band.attrs
-
-                        print("files:", bgrn)
-                        out = out.astype("int16")
-
-                        out_name = (
-                            f"{output_dir}/{band_order[i]}_S2_SR_{quarter}_{grid}.tif"
-                        )
-                        print(out_name)
-                        out.gw.save(
-                            filename=out_name,
-                            nodata=nan,
-                            overwrite=True,
-                            num_workers=19,
-                            compress="lzw",
-                        )
+    # one tile index per band on a shared grid, any number of tiles per band
+    out_grid = tile_grid([f for band_files in bgrn for f in band_files])
+    indexes = [TileIndex(band_files, out_grid) for band_files in bgrn]
+
+    # skip unnecessary quarters
+    quarters = [q for q in unique_quarters if q not in ["2024_Q01", "2024_Q02"]]
+    print("working on quarters:", quarters, "north_south:", grid)
+    # each stack holds one band per quarter
+    quarter_bands = [unique_quarters.index(quarter) + 1 for quarter in quarters]
+
+    # workers sized to the node's cpus, cgroup quota and memory limit instead of
+    # num_workers=19, per window timings are saved with the outputs
+    with ExecutionContext(
+        n_workers=args.workers,
+        distributed=args.distributed,
+        timings_path=f"{output_dir}/timings_{grid}.csv",
+    ) as context:
+        for i, index in enumerate(indexes):
+            out_names = [
+                f"{output_dir}/{band_order[i]}_S2_SR_{quarter}_{grid}.tif"
+                for quarter in quarters
+            ]
+            print("files:", bgrn[i])
+            print(out_names)
+            # one pass over the band's windows writes every quarter, overlapping
+            # tiles combine with --rule, gaps take the band mean from the
+            # interpolation statistics sidecars, then x 10000 to int16
+            write_mosaics(
+                [index],
+                quarter_bands,
+                out_names,
+                rule=args.rule,
+                fill=[
+                    layer_means([(index, band)], rule=args.rule)
+                    for band in quarter_bands
+                ],
+                scale=10000,
+                dtype="int16",
+                compress="zstd",  # COG, read by xr_fresh with a recent GDAL
+                context=context,
+            )
+
+    for index in indexes:
+        index.close()
 
 
 if __name__ == "__main__":
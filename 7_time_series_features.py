@@ -17,6 +17,7 @@
 # NOTE: inputs can be floating point or integer
 
 import geowombat as gw
+import argparse
 import os, sys
 
 sys.path.append("/home/mmann1123/Documents/github/xr_fresh/")
@@ -30,6 +31,14 @@ import re
 import logging
 from pathlib import Path
 from helpers import get_quarter_dates
+from resources import window_size_for_memory
+from cog import gtiff_profile, to_cog
+
+# e.g. python 7_time_series_features.py --mem 32GB --workers 3
+parser = argparse.ArgumentParser(description="time series features")
+parser.add_argument("--mem", type=str, default="32GB", help="memory budget")
+parser.add_argument("--workers", type=int, default=3, help="gw.series num_workers")
+args, _ = parser.parse_known_args()
 
 zones = ["south"]  # "north",
 output_path = "../time_features"
@@ -119,9 +128,16 @@ for zone in zones:
                 start, end = get_quarter_dates(quarter)
 
             print(f"working on {band_name} {a_period}")
+            # windows sized to the budget and aligned to the GeoTIFF tiles
+            window_size = window_size_for_memory(
+                a_period[0],
+                n_times=len(a_period),
+                mem_budget=args.mem,
+                workers=args.workers,
+            )
             with gw.series(
                 a_period,
-                window_size=[512, 512],  # transfer_lib="numpy"
+                window_size=window_size,  # transfer_lib="numpy"
                 nodata=np.nan,
             ) as src:
                 # iterate across functions
@@ -167,11 +183,17 @@ for zone in zones:
                             src.apply(
                                 func=func_instance,
                                 outfile=outfile,
-                                num_workers=3,
+                                num_workers=args.workers,
                                 processes=False,
                                 bands=1,
-                                kwargs={"BIGTIFF": "YES", "compress": "LZW"},
+                                # tiled with the float predictor
+                                kwargs={
+                                    **gtiff_profile("float32", "zstd"),
+                                    "BIGTIFF": "YES",
+                                },
                             )
+                            # add overviews and the COG layout
+                            to_cog(outfile, codec="zstd")
                             # Log the output
                             logging.info(f"outfile: {outfile}")
                         except Exception as e:
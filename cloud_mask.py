@@ -0,0 +1,376 @@
+# Description: Local NumPy/dask version of the s2cloudless cloud and shadow mask
+# built in helpers.add_cloud_bands, add_shadow_bands and add_cld_shdw_mask,
+# so the mask parameters can be tuned without an Earth Engine round trip
+# author: Michael Mann mmann1123@gwu.edu
+
+# inputs are on-disk L2A rasters (B8, SCL), the s2cloudless probability and the
+# MEAN_SOLAR_AZIMUTH_ANGLE of the scene. Like the ee graph:
+# - clouds are probability > CLD_PRB_THRESH
+# - shadows are dark non-water NIR pixels within CLD_PRJ_DIST km of a cloud in the
+#   direction of the sun, projected on a 100 m grid
+# - the combined mask is eroded by 2 pixels and dilated by BUFFER * 2 / SCALE
+#   pixels on a 20 m grid, because ee reprojects the focal chain to 20 m
+
+# Example:
+# from cloud_mask import mask_scene_files
+# mask = mask_scene_files("B8.tif", "SCL.tif", "probability.tif", 123.4, outfile="mask.tif")
+
+import math
+
+SR_BAND_SCALE = 1e4
+
+
+def disk(radius):
+    """Circular kernel like the ee focal default
+    Args:
+        radius (float): radius in pixels
+    Returns:
+        numpy.ndarray: boolean kernel
+    """
+    import numpy as np
+
+    size = int(math.floor(radius))
+    y, x = np.ogrid[-size : size + 1, -size : size + 1]
+    return x**2 + y**2 <= radius**2
+
+
+def downsample(array, factor, how="any"):
+    """Reduce a boolean array to a coarser grid
+    Args:
+        array (numpy.ndarray): 2D boolean array, shape is padded up to a multiple of factor
+        factor (int): number of pixels per coarse pixel along each axis
+        how (str): "any" to mark a coarse pixel if any pixel is set, "nearest" to take the
+            upper left pixel
+    Returns:
+        numpy.ndarray
+    """
+    import numpy as np
+
+    if factor == 1:
+        return array
+    if how == "nearest":
+        return array[::factor, ::factor]
+    rows = -(-array.shape[0] // factor) * factor
+    cols = -(-array.shape[1] // factor) * factor
+    padded = np.zeros((rows, cols), dtype=bool)
+    padded[: array.shape[0], : array.shape[1]] = array
+    return padded.reshape(rows // factor, factor, cols // factor, factor).any(axis=(1, 3))
+
+
+def upsample(array, factor, shape):
+    """Repeat a coarse array back onto the fine grid
+    Args:
+        array (numpy.ndarray): 2D array on the coarse grid
+        factor (int): number of pixels per coarse pixel along each axis
+        shape (tuple): shape of the fine grid
+    Returns:
+        numpy.ndarray
+    """
+    if factor == 1:
+        return array[: shape[0], : shape[1]]
+    return array.repeat(factor, axis=0).repeat(factor, axis=1)[: shape[0], : shape[1]]
+
+
+def threshold_clouds(probability, CLD_PRB_THRESH=30):
+    """Cloud pixels from the s2cloudless probability
+    Args:
+        probability (numpy.ndarray): cloud probability 0-100
+        CLD_PRB_THRESH (int): cloud probability threshold
+    Returns:
+        numpy.ndarray: boolean cloud mask
+    """
+    return probability > CLD_PRB_THRESH
+
+
+def dark_pixels(b8, scl, NIR_DRK_THRESH=0.2):
+    """Dark NIR pixels that are not water, the potential cloud shadows
+    Args:
+        b8 (numpy.ndarray): B8 surface reflectance scaled by 1e4
+        scl (numpy.ndarray): scene classification layer
+        NIR_DRK_THRESH (float): NIR dark pixel threshold
+    Returns:
+        numpy.ndarray: boolean dark pixel mask
+    """
+    return (b8 < NIR_DRK_THRESH * SR_BAND_SCALE) & (scl != 6)
+
+
+def shadow_offsets(solar_azimuth, CLD_PRJ_DIST=2, projection_scale=100):
+    """Row and column offsets searched for clouds on the projection grid
+    Args:
+        solar_azimuth (float): MEAN_SOLAR_AZIMUTH_ANGLE in degrees clockwise from north
+        CLD_PRJ_DIST (float): cloud projection distance in km
+        projection_scale (float): pixel size of the projection grid in meters
+    Returns:
+        list: list of unique (row, col) offsets toward the sun
+    """
+    # same angle ee uses for directionalDistanceTransform: toward the sun,
+    # counter clockwise from east
+    angle = math.radians(90 - solar_azimuth)
+    steps = int(round(CLD_PRJ_DIST * 1000 / projection_scale))
+    offsets = []
+    for step in range(1, steps + 1):
+        offset = (
+            int(round(-step * math.sin(angle))),
+            int(round(step * math.cos(angle))),
+        )
+        if offset not in offsets:
+            offsets.append(offset)
+    return offsets
+
+
+def project_shadows(
+    clouds, solar_azimuth, CLD_PRJ_DIST=2, SCALE=10, projection_scale=100
+):
+    """Mark pixels with a cloud toward the sun within CLD_PRJ_DIST km
+    Args:
+        clouds (numpy.ndarray): boolean cloud mask at SCALE
+        solar_azimuth (float): MEAN_SOLAR_AZIMUTH_ANGLE in degrees
+        CLD_PRJ_DIST (float): cloud projection distance in km
+        SCALE (int): pixel size of clouds in meters
+        projection_scale (int): pixel size the projection is computed at, 100 in ee
+    Returns:
+        numpy.ndarray: boolean cloud projection at SCALE, clouds included
+    """
+    import numpy as np
+
+    factor = int(projection_scale // SCALE)
+    coarse = downsample(clouds, factor)
+    projected = coarse.copy()
+    rows, cols = coarse.shape
+    for row_off, col_off in shadow_offsets(solar_azimuth, CLD_PRJ_DIST, projection_scale):
+        # projected[r, c] |= coarse[r + row_off, c + col_off]
+        dst_rows = slice(max(0, -row_off), min(rows, rows - row_off))
+        dst_cols = slice(max(0, -col_off), min(cols, cols - col_off))
+        src_rows = slice(max(0, row_off), min(rows, rows + row_off))
+        src_cols = slice(max(0, col_off), min(cols, cols + col_off))
+        if dst_rows.start >= dst_rows.stop or dst_cols.start >= dst_cols.stop:
+            continue
+        np.logical_or(
+            projected[dst_rows, dst_cols],
+            coarse[src_rows, src_cols],
+            out=projected[dst_rows, dst_cols],
+        )
+    return upsample(projected, factor, clouds.shape)
+
+
+def erode_mask(is_cld_shdw, SCALE=10, mask_scale=20):
+    """Remove small cloud and shadow patches, the ee focalMin(2)
+    Args:
+        is_cld_shdw (numpy.ndarray): boolean cloud or shadow mask at SCALE
+        SCALE (int): image scale in meters
+        mask_scale (int): pixel size the focal operations run at, 20 in ee
+    Returns:
+        numpy.ndarray: boolean mask on the mask_scale grid
+    """
+    from scipy import ndimage
+
+    factor = int(mask_scale // SCALE)
+    coarse = downsample(is_cld_shdw, factor, how="nearest")
+    return ndimage.binary_erosion(coarse, structure=disk(2), border_value=1)
+
+
+def buffer_mask(eroded, shape, BUFFER=40, SCALE=10, mask_scale=20):
+    """Dilate the eroded mask, the ee focalMax(BUFFER * 2 / SCALE)
+    Args:
+        eroded (numpy.ndarray): output of erode_mask
+        shape (tuple): shape of the mask at SCALE
+        BUFFER (int): buffer distance around cloud objects
+        SCALE (int): image scale in meters
+        mask_scale (int): pixel size the focal operations run at, 20 in ee
+    Returns:
+        numpy.ndarray: boolean cloud mask at SCALE
+    """
+    from scipy import ndimage
+
+    factor = int(mask_scale // SCALE)
+    coarse = ndimage.binary_dilation(eroded, structure=disk(BUFFER * 2 / SCALE))
+    return upsample(coarse, factor, shape)
+
+
+def clean_mask(is_cld_shdw, BUFFER=40, SCALE=10, mask_scale=20):
+    """Remove small patches then buffer the cloud and shadow mask
+    Args:
+        is_cld_shdw (numpy.ndarray): boolean cloud or shadow mask at SCALE
+        BUFFER (int): buffer distance around cloud objects
+        SCALE (int): image scale in meters
+        mask_scale (int): pixel size the focal operations run at, 20 in ee
+    Returns:
+        numpy.ndarray: boolean cloud mask at SCALE
+    """
+    eroded = erode_mask(is_cld_shdw, SCALE, mask_scale)
+    return buffer_mask(eroded, is_cld_shdw.shape, BUFFER, SCALE, mask_scale)
+
+
+def cloud_mask(
+    probability,
+    b8,
+    scl,
+    solar_azimuth,
+    CLD_PRB_THRESH=30,
+    NIR_DRK_THRESH=0.2,
+    CLD_PRJ_DIST=2,
+    BUFFER=40,
+    SCALE=10,
+    return_layers=False,
+):
+    """Cloud and shadow mask for a single scene held in memory
+    Args:
+        probability (numpy.ndarray): s2cloudless probability
+        b8 (numpy.ndarray): B8 surface reflectance scaled by 1e4
+        scl (numpy.ndarray): scene classification layer
+        solar_azimuth (float): MEAN_SOLAR_AZIMUTH_ANGLE in degrees
+        CLD_PRB_THRESH (int): cloud probability threshold
+        NIR_DRK_THRESH (float): NIR dark pixel threshold
+        CLD_PRJ_DIST (float): cloud projection distance in km
+        BUFFER (int): buffer distance around cloud objects
+        SCALE (int): image scale in meters
+        return_layers (bool): also return the intermediate layers
+    Returns:
+        numpy.ndarray: boolean mask, True for cloud or shadow, or a dict of layers
+            named like the ee bands if return_layers
+    """
+    clouds = threshold_clouds(probability, CLD_PRB_THRESH)
+    dark = dark_pixels(b8, scl, NIR_DRK_THRESH)
+    cld_proj = project_shadows(clouds, solar_azimuth, CLD_PRJ_DIST, SCALE)
+    shadows = cld_proj & dark
+    cloudmask = clean_mask(clouds | shadows, BUFFER, SCALE)
+    if return_layers:
+        return {
+            "clouds": clouds,
+            "dark_pixels": dark,
+            "cloud_transform": cld_proj,
+            "shadows": shadows,
+            "cloudmask": cloudmask,
+        }
+    return cloudmask
+
+
+def halo_pixels(CLD_PRJ_DIST=2, BUFFER=40, SCALE=10, projection_scale=100, mask_scale=20):
+    """Overlap needed between blocks so each block matches the full image result
+    Args:
+        CLD_PRJ_DIST (float): cloud projection distance in km
+        BUFFER (int): buffer distance around cloud objects
+        SCALE (int): image scale in meters
+        projection_scale (int): pixel size of the shadow projection grid
+        mask_scale (int): pixel size of the focal operations
+    Returns:
+        int: halo in pixels, a multiple of the coarsest grid
+    """
+    factor = int(projection_scale // SCALE)
+    shadow = CLD_PRJ_DIST * 1000 / SCALE + factor
+    focal = (2 + math.floor(BUFFER * 2 / SCALE) + 1) * (mask_scale // SCALE)
+    return int(math.ceil((shadow + focal) / factor) * factor)
+
+
+def cloud_mask_dask(
+    probability,
+    b8,
+    scl,
+    solar_azimuth,
+    CLD_PRB_THRESH=30,
+    NIR_DRK_THRESH=0.2,
+    CLD_PRJ_DIST=2,
+    BUFFER=40,
+    SCALE=10,
+):
+    """Blockwise cloud mask over dask arrays
+
+    Every block is computed with a halo from halo_pixels, so the result is the
+    same as cloud_mask on the whole scene. Chunks must be multiples of the 100 m
+    projection grid (10 pixels at 10 m) so the coarse grids line up across blocks.
+
+    Args:
+        probability (dask.array.Array): s2cloudless probability
+        b8 (dask.array.Array): B8 surface reflectance scaled by 1e4
+        scl (dask.array.Array): scene classification layer
+        solar_azimuth (float): MEAN_SOLAR_AZIMUTH_ANGLE in degrees
+        CLD_PRB_THRESH, NIR_DRK_THRESH, CLD_PRJ_DIST, BUFFER, SCALE: see cloud_mask
+    Returns:
+        dask.array.Array: boolean mask, True for cloud or shadow
+    """
+    import dask.array as da
+
+    factor = int(100 // SCALE)
+    b8 = b8.rechunk(probability.chunks)
+    scl = scl.rechunk(probability.chunks)
+    for chunks in probability.chunks:
+        if any(chunk % factor for chunk in chunks[:-1]):
+            raise ValueError(f"Chunks must be multiples of {factor} pixels")
+
+    def _block(prob_block, b8_block, scl_block):
+        return cloud_mask(
+            prob_block,
+            b8_block,
+            scl_block,
+            solar_azimuth,
+            CLD_PRB_THRESH=CLD_PRB_THRESH,
+            NIR_DRK_THRESH=NIR_DRK_THRESH,
+            CLD_PRJ_DIST=CLD_PRJ_DIST,
+            BUFFER=BUFFER,
+            SCALE=SCALE,
+        )
+
+    depth = halo_pixels(CLD_PRJ_DIST, BUFFER, SCALE)
+    return da.map_overlap(
+        _block,
+        probability,
+        b8,
+        scl,
+        depth=depth,
+        boundary="none",
+        trim=True,
+        dtype=bool,
+        align_arrays=False,
+    )
+
+
+def mask_scene_files(
+    b8_path,
+    scl_path,
+    probability_path,
+    solar_azimuth,
+    outfile=None,
+    chunks=2560,
+    num_workers=4,
+    **params,
+):
+    """Cloud mask a scene from on-disk rasters
+
+    SCL and the cloud probability are resampled to the B8 10 m grid.
+
+    Args:
+        b8_path (str): B8 surface reflectance GeoTIFF
+        scl_path (str): scene classification layer GeoTIFF
+        probability_path (str): s2cloudless probability GeoTIFF
+        solar_azimuth (float): MEAN_SOLAR_AZIMUTH_ANGLE in degrees
+        outfile (str): optional output GeoTIFF, 1 = cloud or shadow
+        chunks (int): block size in pixels, a multiple of 10
+        num_workers (int): workers used to save outfile
+        **params: CLD_PRB_THRESH, NIR_DRK_THRESH, CLD_PRJ_DIST, BUFFER, SCALE
+    Returns:
+        xarray.DataArray: uint8 mask, 1 = cloud or shadow
+    """
+    import geowombat as gw
+
+    with gw.config.update(ref_image=b8_path):
+        with gw.open(b8_path, chunks=chunks) as b8, gw.open(
+            scl_path, chunks=chunks, resampling="nearest"
+        ) as scl, gw.open(probability_path, chunks=chunks) as probability:
+            mask = cloud_mask_dask(
+                probability.sel(band=1).data,
+                b8.sel(band=1).data,
+                scl.sel(band=1).data,
+                solar_azimuth,
+                **params,
+            )
+            out = b8.sel(band=[1]).copy(data=mask.astype("uint8")[None])
+            out.attrs = b8.attrs
+            if outfile is not None:
+                out.gw.save(
+                    filename=outfile,
+                    nodata=255,
+                    overwrite=True,
+                    num_workers=num_workers,
+                    compress="lzw",
+                )
+            return out
@@ -0,0 +1,300 @@
+# Description: Shared output profiles for the pipeline writers, tiled Cloud
+# Optimized GeoTIFFs with overviews and the predictor that suits the dtype, plus a
+# benchmark of write time, read time and size per codec
+# author: Michael Mann mmann1123@gwu.edu
+
+# predictor 2 (horizontal differencing) for integers and 3 (floating point) for
+# floats, LERC codecs take none. DEFAULT_CODEC is deflate because the spfeas
+# environment reads the mosaics with an older GDAL without zstd or lerc, use
+# zstd for products only read by a recent GDAL
+
+# Example:
+# from cog import gtiff_profile, to_cog
+# with rasterio.open("tmp.tif", "w", **gtiff_profile("float32"), **profile) as dst: ...
+# to_cog("tmp.tif", "S2_SR_2021_Q01_south.tif", codec="deflate")
+
+# compare codecs on representative rasters from terminal:
+# python cog.py benchmark ../tifs/*_SC3_*.tif --codecs lzw deflate zstd lerc_zstd
+# or on synthetic feature rasters:
+# python cog.py benchmark --synthetic
+
+import argparse
+import csv
+import os
+import shutil
+import tempfile
+import time
+
+import numpy as np
+
+DEFAULT_CODEC = "deflate"
+BLOCK_SIZE = 512
+
+# creation options per codec on top of COMPRESS
+CODECS = {
+    "lzw": {},
+    "deflate": {"zlevel": 6},
+    "zstd": {"zstd_level": 9},
+    # lossless unless max_z_error is set
+    "lerc": {"max_z_error": 0},
+    "lerc_deflate": {"max_z_error": 0},
+    "lerc_zstd": {"max_z_error": 0},
+}
+
+
+def predictor(dtype, codec=DEFAULT_CODEC):
+    """GeoTIFF predictor for a dtype
+    Args:
+        dtype (str): raster dtype
+        codec (str): codec name, LERC codecs take no predictor
+    Returns:
+        int: 1 none, 2 horizontal differencing (integers), 3 floating point
+    """
+    if codec.startswith("lerc"):
+        return 1
+    if np.issubdtype(np.dtype(dtype), np.floating):
+        return 3
+    return 2
+
+
+def gtiff_profile(dtype, codec=DEFAULT_CODEC, blocksize=BLOCK_SIZE):
+    """Tiled GeoTIFF creation options for rasterio.open, gw.save or src.apply kwargs
+    Args:
+        dtype (str): raster dtype
+        codec (str): one of CODECS
+        blocksize (int): internal tile rows and columns
+    Returns:
+        dict: creation options
+    """
+    if codec not in CODECS:
+        raise ValueError(f"codec must be one of {list(CODECS)}")
+    return {
+        "tiled": True,
+        "blockxsize": blocksize,
+        "blockysize": blocksize,
+        "compress": codec,
+        "predictor": predictor(dtype, codec),
+        "BIGTIFF": "IF_SAFER",
+        **CODECS[codec],
+    }
+
+
+def overview_resampling(dtype):
+    """Average floats, nearest for integer classes and scaled values"""
+    return "average" if np.issubdtype(np.dtype(dtype), np.floating) else "nearest"
+
+
+def to_cog(path, outfile=None, codec=DEFAULT_CODEC, blocksize=BLOCK_SIZE):
+    """Rewrite a raster as a Cloud Optimized GeoTIFF with overviews
+    Args:
+        path (str): input raster
+        outfile (str): output path, defaults to replacing path
+        codec (str): one of CODECS
+        blocksize (int): internal tile rows and columns
+    Returns:
+        str: outfile
+    """
+    import rasterio
+    import rasterio.shutil
+
+    outfile = outfile or path
+    with rasterio.open(path) as src:
+        dtype = src.dtypes[0]
+    options = {
+        "compress": codec,
+        "predictor": "YES" if predictor(dtype, codec) > 1 else "NO",
+        "blocksize": blocksize,
+        "overviews": "AUTO",
+        "overview_resampling": overview_resampling(dtype),
+        "BIGTIFF": "IF_SAFER",
+    }
+    # the COG driver names the level options differently than GTiff
+    for key, value in CODECS[codec].items():
+        options["level" if key in ["zlevel", "zstd_level"] else key] = value
+    tmp = outfile + ".cog.tif"
+    rasterio.shutil.copy(path, tmp, driver="COG", **options)
+    os.replace(tmp, outfile)
+    return outfile
+
+
+def gdal_translate_options(dtype, codec=DEFAULT_CODEC, blocksize=BLOCK_SIZE):
+    """Creation options for gdal_translate in the shell scripts
+
+    Written as a tiled GTiff rather than -of COG so older GDAL builds (the
+    spfeas environment) can run them, add overviews with gdaladdo_command.
+
+    Args:
+        dtype (str): raster dtype
+        codec (str): one of CODECS
+        blocksize (int): internal tile rows and columns
+    Returns:
+        str: e.g. -of GTiff -co TILED=YES ... -co PREDICTOR=3
+    """
+    profile = gtiff_profile(dtype, codec, blocksize)
+    options = ["-of GTiff"]
+    for key, value in profile.items():
+        if key == "tiled":
+            value = "YES"
+        options.append(f'-co "{key.upper()}={str(value).upper()}"')
+    return " ".join(options)
+
+
+def gdaladdo_command(path, dtype, levels=(2, 4, 8, 16, 32)):
+    """gdaladdo command building internal overviews for a raster"""
+    levels = " ".join(str(level) for level in levels)
+    return f"gdaladdo -r {overview_resampling(dtype)} {path} {levels}"
+
+
+def synthetic_rasters(folder, size=2048, seed=0):
+    """Write representative feature rasters, a smooth float32 feature, a noisy
+    float32 texture and a x10000 int16 reflectance band
+    Args:
+        folder (str): output folder
+        size (int): rows and columns
+        seed (int): random seed
+    Returns:
+        list: paths
+    """
+    import rasterio
+    from rasterio.transform import from_origin
+
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[0:size, 0:size] / size
+    smooth = np.sin(6 * x) * np.cos(4 * y) + 0.05 * rng.standard_normal((size, size))
+    texture = rng.gamma(2.0, 1.0, (size, size))
+    reflectance = np.clip(0.2 + 0.1 * smooth, 0, 1) * 10000
+    arrays = {
+        "feature_smooth_float32.tif": smooth.astype("float32"),
+        "feature_texture_float32.tif": texture.astype("float32"),
+        "reflectance_int16.tif": reflectance.astype("int16"),
+    }
+    paths = []
+    for name, array in arrays.items():
+        path = os.path.join(folder, name)
+        with rasterio.open(
+            path,
+            "w",
+            driver="GTiff",
+            height=size,
+            width=size,
+            count=1,
+            dtype=array.dtype,
+            crs="EPSG:32736",
+            transform=from_origin(500000, 8500000, 10, 10),
+        ) as dst:
+            dst.write(array, 1)
+        paths.append(path)
+    return paths
+
+
+def benchmark(rasters, codecs=tuple(CODECS), cog=True, repeats=3, window_size=512):
+    """Write, read and size each raster with each codec
+    Args:
+        rasters (list): input rasters
+        codecs (list): codec names
+        cog (bool): also build the COG with overviews, timed with the write
+        repeats (int): reads per measurement, the fastest is kept
+        window_size (int): window rows and columns of the random window reads
+    Returns:
+        list: one dict per (raster, codec) with write_seconds, read_seconds,
+            window_read_seconds, megabytes and ratio to the uncompressed size
+    """
+    import rasterio
+    from rasterio.windows import Window
+
+    results = []
+    folder = tempfile.mkdtemp(prefix="codec_benchmark_")
+    try:
+        for raster in rasters:
+            with rasterio.open(raster) as src:
+                data = src.read()
+                profile = src.profile.copy()
+            raw_mb = data.nbytes / 1024**2
+            rng = np.random.default_rng(0)
+            windows = [
+                Window(
+                    int(rng.integers(0, max(profile["width"] - window_size, 1))),
+                    int(rng.integers(0, max(profile["height"] - window_size, 1))),
+                    min(window_size, profile["width"]),
+                    min(window_size, profile["height"]),
+                )
+                for _ in range(8)
+            ]
+            for codec in codecs:
+                outfile = os.path.join(folder, f"{codec}.tif")
+                profile.update(driver="GTiff", **gtiff_profile(data.dtype, codec))
+                start = time.perf_counter()
+                try:
+                    with rasterio.open(outfile, "w", **profile) as dst:
+                        dst.write(data)
+                    if cog:
+                        to_cog(outfile, codec=codec)
+                except Exception as e:
+                    print(f"{codec} not available: {e}")
+                    continue
+                write_seconds = time.perf_counter() - start
+
+                read_seconds = []
+                window_seconds = []
+                for _ in range(repeats):
+                    start = time.perf_counter()
+                    with rasterio.open(outfile) as src:
+                        src.read()
+                    read_seconds.append(time.perf_counter() - start)
+                    start = time.perf_counter()
+                    with rasterio.open(outfile) as src:
+                        for window in windows:
+                            src.read(window=window)
+                    window_seconds.append(time.perf_counter() - start)
+
+                megabytes = os.path.getsize(outfile) / 1024**2
+                results.append(
+                    {
+                        "raster": os.path.basename(raster),
+                        "dtype": str(data.dtype),
+                        "codec": codec,
+                        "predictor": predictor(data.dtype, codec),
+                        "write_seconds": round(write_seconds, 3),
+                        "read_seconds": round(min(read_seconds), 3),
+                        "window_read_seconds": round(min(window_seconds), 3),
+                        "megabytes": round(megabytes, 2),
+                        "ratio": round(megabytes / raw_mb, 3),
+                    }
+                )
+                print(results[-1])
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="GeoTIFF codec benchmark")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    bench = subparsers.add_parser("benchmark", help="time and size each codec")
+    bench.add_argument("rasters", type=str, nargs="*", help="rasters to test")
+    bench.add_argument("--synthetic", action="store_true", help="use test rasters")
+    bench.add_argument("--codecs", type=str, nargs="+", default=list(CODECS))
+    bench.add_argument("--no_cog", action="store_true", help="skip the overviews")
+    bench.add_argument("--repeats", type=int, default=3)
+    bench.add_argument("--out", type=str, default="codec_benchmark.csv")
+    args = parser.parse_args()
+
+    rasters = list(args.rasters)
+    folder = None
+    if args.synthetic or not rasters:
+        folder = tempfile.mkdtemp(prefix="codec_rasters_")
+        rasters += synthetic_rasters(folder)
+    try:
+        results = benchmark(rasters, args.codecs, not args.no_cog, args.repeats)
+    finally:
+        if folder:
+            shutil.rmtree(folder, ignore_errors=True)
+    with open(args.out, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+        writer.writeheader()
+        writer.writerows(results)
+    print("results written to", args.out)
+
+
+if __name__ == "__main__":
+    main()
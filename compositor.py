@@ -0,0 +1,340 @@
+# Description: Local median compositor for a directory of cloud masked scenes,
+# the same .median() the gee download runs after apply_cld_shdw_mask
+# author: Michael Mann mmann1123@gwu.edu
+
+# reads one window at a time from every scene, so memory is bounded by
+# window size x number of scenes x workers, not by the scene size
+# scenes must share the same grid, masked pixels are nodata or nan
+
+# to run from terminal:
+# python compositor.py composite ./scenes/2021_Q01 ./composites/S2_SR_2021_Q01_north.tif
+# python compositor.py benchmark --scenes 10 20 40 60 --size 2048
+
+import argparse
+import multiprocessing
+import os
+import resource
+import time
+from concurrent.futures import ProcessPoolExecutor
+from glob import glob
+
+from cog import DEFAULT_CODEC, gtiff_profile, to_cog
+
+
+def window_grid(height, width, window_size=512):
+    """Split a raster into windows
+    Args:
+        height (int): raster rows
+        width (int): raster columns
+        window_size (int): window rows and columns
+    Returns:
+        list: list of rasterio.windows.Window
+    """
+    from rasterio.windows import Window
+
+    return [
+        Window(col, row, min(window_size, width - col), min(window_size, height - row))
+        for row in range(0, height, window_size)
+        for col in range(0, width, window_size)
+    ]
+
+
+def nanmedian_count(stack):
+    """Per pixel median and number of valid observations
+    Args:
+        stack (numpy.ndarray): (scenes, bands, rows, cols) float array, nan is missing
+    Returns:
+        tuple: (median as float32 (bands, rows, cols), count as uint16 (rows, cols))
+    """
+    import numpy as np
+
+    # sorting puts nan last, so the median sits in the first n_valid values
+    ordered = np.sort(stack, axis=0)
+    n_valid = (~np.isnan(stack)).sum(axis=0)
+    lower = np.take_along_axis(ordered, np.maximum(n_valid - 1, 0)[None] // 2, axis=0)
+    upper = np.take_along_axis(ordered, (n_valid // 2)[None], axis=0)
+    median = ((lower[0] + upper[0]) / 2).astype("float32")
+    median[n_valid == 0] = np.nan
+
+    # a pixel is valid if all of its bands are
+    count = (~np.isnan(stack).any(axis=1)).sum(axis=0).astype("uint16")
+    return median, count
+
+
+def _composite_window(scenes, window, bands):
+    import numpy as np
+    import rasterio
+
+    stack = []
+    for scene in scenes:
+        with rasterio.open(scene) as src:
+            data = src.read(bands, window=window, masked=True)
+            stack.append(data.astype("float32").filled(np.nan))
+    median, count = nanmedian_count(np.stack(stack))
+    return window, median, count
+
+
+def composite_scenes(
+    scenes,
+    outfile,
+    count_outfile=None,
+    bands=None,
+    window_size=512,
+    num_workers=4,
+    compress=DEFAULT_CODEC,
+    cog=True,
+):
+    """Median composite of a list of aligned scenes, written window by window
+
+    Args:
+        scenes (list): paths to masked scenes on the same grid
+        outfile (str): output composite GeoTIFF, float32 with nan as nodata
+        count_outfile (str): output valid observation count GeoTIFF, uint16,
+            defaults to outfile with _count.tif
+        bands (list): 1 based band indexes to composite, defaults to all
+        window_size (int): window rows and columns
+        num_workers (int): processes computing windows in parallel
+        compress (str): codec, see cog.CODECS
+        cog (bool): rewrite the outputs as Cloud Optimized GeoTIFFs with overviews
+    Returns:
+        tuple: (outfile, count_outfile)
+    """
+    import rasterio
+
+    if not scenes:
+        raise ValueError("No scenes found to composite")
+    if count_outfile is None:
+        count_outfile = os.path.splitext(outfile)[0] + "_count.tif"
+
+    with rasterio.open(scenes[0]) as src:
+        profile = src.profile.copy()
+        descriptions = src.descriptions
+    bands = list(bands or range(1, profile["count"] + 1))
+    for scene in scenes[1:]:
+        with rasterio.open(scene) as src:
+            if (src.height, src.width, src.transform) != (
+                profile["height"],
+                profile["width"],
+                profile["transform"],
+            ):
+                raise ValueError(f"Scene is not on the same grid: {scene}")
+
+    profile.update(
+        driver="GTiff",
+        count=len(bands),
+        dtype="float32",
+        nodata=float("nan"),
+        **gtiff_profile("float32", compress, blocksize=256),
+    )
+    count_profile = dict(
+        profile,
+        count=1,
+        dtype="uint16",
+        nodata=None,
+        **gtiff_profile("uint16", compress, blocksize=256),
+    )
+
+    windows = window_grid(profile["height"], profile["width"], window_size)
+    print(f"Compositing {len(scenes)} scenes in {len(windows)} windows")
+    with rasterio.open(outfile, "w", **profile) as dst, rasterio.open(
+        count_outfile, "w", **count_profile
+    ) as count_dst:
+        dst.descriptions = tuple(descriptions[b - 1] for b in bands)
+        count_dst.descriptions = ("valid_count",)
+
+        with ProcessPoolExecutor(num_workers) as executor:
+            # keep a bounded number of windows in memory
+            futures = []
+            for window in windows:
+                futures.append(
+                    executor.submit(_composite_window, scenes, window, bands)
+                )
+                if len(futures) >= 2 * num_workers:
+                    _write_window(dst, count_dst, futures.pop(0).result())
+            for future in futures:
+                _write_window(dst, count_dst, future.result())
+
+    if cog:
+        to_cog(outfile, codec=compress)
+        to_cog(count_outfile, codec=compress)
+    return outfile, count_outfile
+
+
+def _write_window(dst, count_dst, result):
+    window, median, count = result
+    dst.write(median, window=window)
+    count_dst.write(count, 1, window=window)
+
+
+def composite_directory(scene_dir, outfile, pattern="*.tif", **kwargs):
+    """Median composite of every scene in a directory
+    Args:
+        scene_dir (str): folder of masked scenes for one quarter
+        outfile (str): output composite GeoTIFF
+        pattern (str): glob pattern for the scenes
+        **kwargs: passed to composite_scenes
+    Returns:
+        tuple: (outfile, count_outfile)
+    """
+    scenes = sorted(glob(os.path.join(scene_dir, pattern)))
+    return composite_scenes(scenes, outfile, **kwargs)
+
+
+def peak_rss_mb():
+    """Peak resident memory of this process and its largest finished child in MB
+
+    ru_maxrss is a high water mark over the life of the process, see
+    _timed_composite for a per run figure.
+
+    Returns:
+        tuple: (self, children)
+    """
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024,
+    )
+
+
+def _timed_composite(scene_dir, outfile, window_size, num_workers):
+    """Composite a folder and report seconds and peak memory, run in a fresh
+    process per benchmark size so the peaks are not carried over between runs
+    Returns:
+        tuple: (seconds, peak rss MB of the process, of its largest worker)
+    """
+    start = time.perf_counter()
+    composite_directory(
+        scene_dir,
+        outfile,
+        window_size=window_size,
+        num_workers=num_workers,
+        cog=False,  # time the compositing only
+    )
+    seconds = time.perf_counter() - start
+    # the workers are joined when the pool closes, so they count as children
+    return (seconds, *peak_rss_mb())
+
+
+def write_synthetic_scenes(folder, n_scenes, size=2048, bands=4, cloud_fraction=0.3, seed=0):
+    """Write random masked scenes for benchmarking
+    Args:
+        folder (str): output folder
+        n_scenes (int): number of scenes
+        size (int): rows and columns per scene
+        bands (int): bands per scene
+        cloud_fraction (float): fraction of pixels set to nan
+        seed (int): random seed
+    Returns:
+        list: scene paths
+    """
+    import numpy as np
+    import rasterio
+    from rasterio.transform import from_origin
+
+    rng = np.random.default_rng(seed)
+    profile = {
+        "driver": "GTiff",
+        "height": size,
+        "width": size,
+        "count": bands,
+        "dtype": "float32",
+        "nodata": float("nan"),
+        "crs": "EPSG:32736",
+        "transform": from_origin(600000, 8500000, 10, 10),
+        "tiled": True,
+        "blockxsize": 256,
+        "blockysize": 256,
+    }
+    os.makedirs(folder, exist_ok=True)
+    scenes = []
+    for i in range(n_scenes):
+        data = rng.random((bands, size, size), dtype="float32")
+        data[:, rng.random((size, size)) < cloud_fraction] = np.nan
+        path = os.path.join(folder, f"scene_{i:03d}.tif")
+        with rasterio.open(path, "w", **profile) as dst:
+            dst.write(data)
+        scenes.append(path)
+    return scenes
+
+
+def benchmark(scene_counts=(10, 20, 40, 60), size=2048, window_size=512, num_workers=4, folder=None):
+    """Report compositing throughput and peak memory on synthetic stacks
+    Args:
+        scene_counts (list): number of scenes per run
+        size (int): rows and columns per scene
+        window_size (int): window rows and columns
+        num_workers (int): processes
+        folder (str): scratch folder, defaults to a temporary folder
+    Returns:
+        list: one dict per run
+    """
+    import shutil
+    import tempfile
+
+    temporary = folder is None
+    folder = folder or tempfile.mkdtemp(prefix="composite_benchmark_")
+    results = []
+    try:
+        for n_scenes in scene_counts:
+            scene_dir = os.path.join(folder, f"scenes_{n_scenes}")
+            write_synthetic_scenes(scene_dir, n_scenes, size=size)
+            # a new spawned process per size, ru_maxrss never goes down
+            with ProcessPoolExecutor(
+                1, mp_context=multiprocessing.get_context("spawn")
+            ) as executor:
+                seconds, rss_self, rss_children = executor.submit(
+                    _timed_composite,
+                    scene_dir,
+                    os.path.join(folder, f"composite_{n_scenes}.tif"),
+                    window_size,
+                    num_workers,
+                ).result()
+            results.append(
+                {
+                    "scenes": n_scenes,
+                    "seconds": round(seconds, 2),
+                    "mpix_per_s": round(size * size / seconds / 1e6, 3),
+                    "scene_mpix_per_s": round(n_scenes * size * size / seconds / 1e6, 3),
+                    "peak_rss_mb": round(rss_self, 1),
+                    "peak_worker_rss_mb": round(rss_children, 1),
+                }
+            )
+            print(results[-1])
+            shutil.rmtree(scene_dir)
+    finally:
+        if temporary:
+            shutil.rmtree(folder, ignore_errors=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="median composite of masked scenes")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run = subparsers.add_parser("composite", help="composite a folder of scenes")
+    run.add_argument("scene_dir", type=str, help="folder of masked scenes for a quarter")
+    run.add_argument("outfile", type=str, help="output composite tif")
+    run.add_argument("--pattern", type=str, default="*.tif")
+    run.add_argument("--window_size", type=int, default=512)
+    run.add_argument("--num_workers", type=int, default=4)
+
+    bench = subparsers.add_parser("benchmark", help="benchmark on synthetic stacks")
+    bench.add_argument("--scenes", type=int, nargs="+", default=[10, 20, 40, 60])
+    bench.add_argument("--size", type=int, default=2048)
+    bench.add_argument("--window_size", type=int, default=512)
+    bench.add_argument("--num_workers", type=int, default=4)
+    args = parser.parse_args()
+
+    if args.command == "composite":
+        composite_directory(
+            args.scene_dir,
+            args.outfile,
+            pattern=args.pattern,
+            window_size=args.window_size,
+            num_workers=args.num_workers,
+        )
+    else:
+        benchmark(args.scenes, args.size, args.window_size, args.num_workers)
+
+
+if __name__ == "__main__":
+    main()
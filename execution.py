@@ -0,0 +1,193 @@
+# Description: Execution context sized to the node, replaces the hard coded
+# num_workers=19 of the mosaic and stack scripts
+# author: Michael Mann mmann1123@gwu.edu
+
+# workers and threads come from the cpus this process may use (affinity and the
+# cgroup quota of a container or Slurm job) and memory from the cgroup limit.
+# windows run on a thread pool, or on a local dask.distributed cluster with a
+# dashboard when distributed=True. per task timings are written next to the
+# outputs, plus the dask task stream and performance report when distributed
+
+# Example:
+# from execution import ExecutionContext
+# with ExecutionContext(timings_path="../mosaic/timings_south.csv") as context:
+#     for result in context.map(read_window, windows, index):
+#         ...
+
+import csv
+import os
+import socket
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from resources import available_cpus, format_memory, parse_memory
+from resources import memory_limit as node_memory_limit
+
+
+def _timed(func, item, *args):
+    """Run func(item, *args) and return the result with its timing"""
+    start = time.time()
+    result = func(item, *args)
+    stop = time.time()
+    worker = f"{socket.gethostname()}-{os.getpid()}-{threading.get_ident()}"
+    return result, start, stop, worker
+
+
+class ExecutionContext:
+    """Workers sized to the node for windowed stages.
+
+    Args:
+        n_workers (int): worker processes (distributed) or threads (local),
+            defaults to the available cpus divided by threads_per_worker
+        threads_per_worker (int): threads per distributed worker, defaults to 2
+            on nodes with 4 or more cpus, always 1 locally
+        memory_limit (str|int): memory shared by the workers, e.g. "64GB",
+            defaults to the available memory capped by the cgroup limit
+        distributed (bool): start a local dask.distributed cluster
+        dashboard_address (str): dashboard address of the distributed cluster
+        timings_path (str): csv of per task timings, saved on exit
+        max_in_flight (int): tasks submitted ahead of the one being consumed,
+            defaults to twice the total threads
+    """
+
+    def __init__(
+        self,
+        n_workers=None,
+        threads_per_worker=None,
+        memory_limit=None,
+        distributed=False,
+        dashboard_address=":8787",
+        timings_path=None,
+        max_in_flight=None,
+    ):
+        cpus = available_cpus()
+        if threads_per_worker is None:
+            threads_per_worker = 2 if distributed and cpus >= 4 else 1
+        self.threads_per_worker = threads_per_worker
+        self.n_workers = n_workers or max(cpus // threads_per_worker, 1)
+        self.memory = (
+            parse_memory(memory_limit) if memory_limit else node_memory_limit()
+        )
+        self.distributed = distributed
+        self.dashboard_address = dashboard_address
+        self.timings_path = timings_path
+        self.max_in_flight = max_in_flight or 2 * self.n_workers * threads_per_worker
+        self.timings = []
+        self.client = None
+        self._cluster = None
+        self._executor = None
+        self._report = None
+
+    @property
+    def num_workers(self):
+        """Total threads, for APIs such as gw.save(num_workers=...)"""
+        return self.n_workers * self.threads_per_worker
+
+    def __enter__(self):
+        memory_per_worker = self.memory // self.n_workers
+        if self.distributed:
+            from dask.distributed import Client, LocalCluster, performance_report
+
+            self._cluster = LocalCluster(
+                n_workers=self.n_workers,
+                threads_per_worker=self.threads_per_worker,
+                memory_limit=memory_per_worker,
+                dashboard_address=self.dashboard_address,
+            )
+            self.client = Client(self._cluster)
+            print("dask dashboard:", self.client.dashboard_link)
+            if self.timings_path:
+                self._report = performance_report(
+                    filename=os.path.splitext(self.timings_path)[0] + "_report.html"
+                )
+                self._report.__enter__()
+        else:
+            self._executor = ThreadPoolExecutor(self.n_workers)
+        workers = (
+            f"{self.n_workers} workers x {self.threads_per_worker} threads"
+            if self.distributed
+            else f"{self.n_workers} threads"
+        )
+        print(f"{workers}, {format_memory(memory_per_worker)} per worker")
+        return self
+
+    def _submit(self, func, item, args):
+        if self.client is not None:
+            return self.client.submit(_timed, func, item, *args, pure=False)
+        return self._executor.submit(_timed, func, item, *args)
+
+    def map(self, func, items, *args, label=None):
+        """Run func(item, *args) for each item, yielding results in order
+
+        At most max_in_flight tasks are pending so results of large windows do
+        not pile up in memory. Shared args are sent to the cluster once.
+
+        Args:
+            func (callable): top level function, must pickle when distributed
+            items (list): one task per item
+            *args: arguments shared by every task
+            label (str): stage name written to the timings
+        Yields:
+            func results in the order of items
+        """
+        if self.client is not None and args:
+            args = tuple(self.client.scatter(list(args), broadcast=True))
+        pending = deque()
+        items = iter(items)
+        for item in items:
+            pending.append(self._submit(func, item, args))
+            if len(pending) >= self.max_in_flight:
+                break
+        task = 0
+        while pending:
+            result, start, stop, worker = pending.popleft().result()
+            self.timings.append(
+                {
+                    "label": label or getattr(func, "__name__", "task"),
+                    "task": task,
+                    "start": round(start, 4),
+                    "stop": round(stop, 4),
+                    "seconds": round(stop - start, 4),
+                    "worker": worker,
+                }
+            )
+            task += 1
+            for item in items:
+                pending.append(self._submit(func, item, args))
+                break
+            yield result
+
+    def save_timings(self):
+        """Write the per task timings and, when distributed, the task stream"""
+        if not self.timings_path:
+            return
+        os.makedirs(os.path.dirname(self.timings_path) or ".", exist_ok=True)
+        if self.timings:
+            with open(self.timings_path, "w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=list(self.timings[0].keys()))
+                writer.writeheader()
+                writer.writerows(self.timings)
+        if self.client is not None:
+            import json
+
+            stream = self.client.get_task_stream()
+            with open(
+                os.path.splitext(self.timings_path)[0] + "_task_stream.json", "w"
+            ) as f:
+                json.dump(stream, f, default=str)
+        print("timings written to", self.timings_path)
+
+    def __exit__(self, *exc):
+        try:
+            if self._report is not None:
+                self._report.__exit__(*exc)
+            self.save_timings()
+        finally:
+            if self.client is not None:
+                self.client.close()
+                self._cluster.close()
+            if self._executor is not None:
+                self._executor.shutdown()
+        return False
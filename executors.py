@@ -0,0 +1,375 @@
+# Description: Run the stages of a task manifest on Slurm or on this machine
+# behind one interface, so single workstation runs and tests use the same
+# pipeline as the cluster
+# author: Michael Mann mmann1123@gwu.edu
+
+# a stage is a dict with the manifest (slurm.write_manifest) and how to run it:
+# {"name": "spfeas_tiny_4h", "manifest": "spfeas_tiny_4h_manifest.jsonl",
+#  "partition": "tiny", "time_request": "00-03:59:00", "setup": spfeas_env,
+#  "cpus_per_task": 1, "memory": "16GB", "after": "earlier stage",
+#  "dependency": "aftercorr"}
+# "after" can also list several stages, the stage then waits for all of them
+# SlurmExecutor writes one job array per stage and chains them with sbatch
+# dependencies, LocalExecutor runs the tasks in a pool of processes, each pinned
+# to its own cpus and under a memory limit, with the same dependencies
+
+# Example:
+# from executors import LocalExecutor, SlurmExecutor
+# results = LocalExecutor(cpus_per_task=2, memory_per_task="8GB").run(stages)
+# job_ids = SlurmExecutor(email="me@gwu.edu").run(stages)
+
+# from terminal the spfeas scripts take the backend and skip the prompt with --yes:
+# python 3_run_spfeas.py --backend local --cpus_per_task 2 --memory_per_task 8GB --yes
+
+import os
+import shutil
+import subprocess
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from resources import available_cpus, format_memory, memory_limit, parse_memory
+from slurm import (
+    DEPENDENCY_TYPES,
+    DryRunBackend,
+    SbatchBackend,
+    read_manifest,
+    submit_stages,
+    write_array_script,
+)
+
+BACKENDS = ["slurm", "local"]
+
+
+def stage_script(stage):
+    """Array script path of a stage, next to its manifest"""
+    base = os.path.splitext(stage["manifest"])[0]
+    if base.endswith("_manifest"):
+        base = base[: -len("_manifest")]
+    return base + ".sh"
+
+
+class SlurmExecutor:
+    """Submit each stage as one job array.
+
+    Args:
+        backend: object with submit(script, dependency), defaults to
+            slurm.SbatchBackend, see slurm.FakeSbatch
+        email (str): address for Slurm notifications
+        log_dir (str): folder of the .out and .err files, defaults to the folder
+            of each manifest
+        cpus_per_task (int): cpus per element, overrides the stages' requests
+        memory_per_task (str|int): memory per element, e.g. "8GB", overrides the
+            stages' requests
+    """
+
+    def __init__(
+        self,
+        backend=None,
+        email=None,
+        log_dir=None,
+        cpus_per_task=None,
+        memory_per_task=None,
+    ):
+        self.backend = backend or SbatchBackend()
+        self.email = email
+        self.log_dir = log_dir
+        self.cpus_per_task = cpus_per_task
+        self.memory_per_task = memory_per_task
+
+    def run(self, stages, dry_run=False):
+        """Write the array scripts and submit them in order
+        Args:
+            stages (list): stage dicts, see the module description, a stage with a
+                job_id instead of a manifest is a job submitted elsewhere
+            dry_run (bool): print the sbatch calls instead of submitting
+        Returns:
+            dict: stage name -> job id
+        """
+        submitted = []
+        for stage in stages:
+            if "job_id" in stage:
+                submitted.append(stage)
+                continue
+            memory = self.memory_per_task or stage.get("memory")
+            script = write_array_script(
+                stage_script(stage),
+                stage["manifest"],
+                stage.get("job_name", stage["name"]),
+                stage["partition"],
+                stage["time_request"],
+                email=self.email,
+                log_dir=self.log_dir or os.path.dirname(stage["manifest"]) or ".",
+                setup=stage.get("setup", ""),
+                max_parallel=stage.get("max_parallel"),
+                cpus_per_task=self.cpus_per_task or stage.get("cpus_per_task"),
+                # sbatch --mem takes megabytes with an M suffix
+                memory=f"{parse_memory(memory) // 2**20}M" if memory else None,
+            )
+            submitted.append({**stage, "script": script})
+        backend = DryRunBackend() if dry_run else self.backend
+        return submit_stages(submitted, backend)
+
+
+class LocalExecutor:
+    """Run the tasks of each stage in a pool of local processes.
+
+    Each task runs with bash, pinned with taskset to cpus_per_task cpus of its
+    own and with its virtual memory capped (ulimit -v) at memory_per_task, so
+    the number of tasks at once is the smaller of the cpus and the memory
+    available (cgroup limits included) divided by the per task request.
+    Dependencies match Slurm: aftercorr waits for the task at the same index of
+    the earlier stage, afterok for all of them, tasks whose dependency failed
+    are skipped.
+
+    Args:
+        workers (int): tasks at once, defaults to what the cpus and memory allow
+        cpus_per_task (int): cpus per task, defaults to each stage's
+            cpus_per_task or 1
+        memory_per_task (str|int): memory per task, e.g. "8GB", defaults to each
+            stage's memory or no limit
+        log_dir (str): folder of the per task .out and .err files, defaults to
+            the folder of each manifest
+        setup (str): shell lines run before every task instead of the stages'
+            Slurm setup, e.g. activating a local env
+    """
+
+    def __init__(
+        self,
+        workers=None,
+        cpus_per_task=None,
+        memory_per_task=None,
+        log_dir=None,
+        setup="",
+    ):
+        self.workers = workers
+        self.cpus_per_task = cpus_per_task
+        self.memory_per_task = (
+            parse_memory(memory_per_task) if memory_per_task else None
+        )
+        self.log_dir = log_dir
+        self.setup = setup
+
+    def _limits(self, stage):
+        cpus = self.cpus_per_task or stage.get("cpus_per_task") or 1
+        memory = self.memory_per_task
+        if memory is None and stage.get("memory"):
+            memory = parse_memory(stage["memory"])
+        return cpus, memory
+
+    def _slots(self, stages):
+        """cpu sets that can run at once, the largest task request counts"""
+        if hasattr(os, "sched_getaffinity"):
+            cpus = sorted(os.sched_getaffinity(0))
+        else:
+            cpus = list(range(os.cpu_count() or 1))
+        # the cgroup quota can allow fewer cpus than the affinity lists
+        cpus = cpus[: available_cpus()]
+        limits = [self._limits(stage) for stage in stages]
+        per_task = max(n for n, _ in limits)
+        n_slots = max(len(cpus) // per_task, 1)
+        memories = [memory for _, memory in limits if memory]
+        if memories:
+            n_slots = min(n_slots, max(memory_limit() // max(memories), 1))
+        if self.workers:
+            n_slots = min(n_slots, self.workers)
+        return [cpus[i * per_task : (i + 1) * per_task] for i in range(n_slots)]
+
+    def _command(self, stage, entry, cpu_set):
+        _, memory = self._limits(stage)
+        lines = [self.setup] if self.setup else []
+        if memory:
+            # kilobytes, applies to the task and everything it starts
+            lines.append(f"ulimit -v {memory // 1024}")
+        lines.append(entry["command"])
+        command = ["bash", "-e", "-c", "\n".join(lines)]
+        if cpu_set and shutil.which("taskset"):
+            command = ["taskset", "-c", ",".join(str(c) for c in cpu_set)] + command
+        return command
+
+    def _run_task(self, stage, index, entry, cpu_set):
+        log_dir = self.log_dir or os.path.dirname(stage["manifest"]) or "."
+        os.makedirs(log_dir, exist_ok=True)
+        log = os.path.join(log_dir, f"{stage['name']}_{index}")
+        threads = str(max(len(cpu_set), 1))
+        env = {
+            **os.environ,
+            "LOCAL_TASK_ID": str(index),
+            # numpy and gdal thread pools stay within the task's cpus
+            "OMP_NUM_THREADS": threads,
+            "OPENBLAS_NUM_THREADS": threads,
+            "MKL_NUM_THREADS": threads,
+            "GDAL_NUM_THREADS": threads,
+        }
+        start = time.time()
+        with open(log + ".out", "w") as out, open(log + ".err", "w") as err:
+            returncode = subprocess.run(
+                self._command(stage, entry, cpu_set), stdout=out, stderr=err, env=env
+            ).returncode
+        return returncode, time.time() - start
+
+    def _ready(self, key, dependencies, results):
+        """True to start, False to skip, None to wait"""
+        for kind, dependency in dependencies.get(key, []):
+            if dependency is None:
+                # no element at this index to wait for, never satisfied
+                return False
+            if dependency not in results:
+                return None
+            code = results[dependency]
+            if kind in ["afterok", "aftercorr"] and code != 0:
+                return False
+            if kind == "afternotok" and code == 0:
+                return False
+        return True
+
+    def run(self, stages, dry_run=False):
+        """Run every task of every stage, respecting the dependencies
+        Args:
+            stages (list): stage dicts, see the module description
+            dry_run (bool): print the tasks instead of running them
+        Returns:
+            dict: stage name -> exit code per task, None for skipped tasks
+        """
+        entries = {}
+        dependencies = {}
+        order = []
+        by_name = {stage["name"]: stage for stage in stages}
+        for stage in stages:
+            if "job_id" in stage:
+                raise ValueError(f"Cannot wait for job {stage['job_id']} locally")
+            stage_entries = read_manifest(stage["manifest"])
+            after = stage.get("after") or []
+            if isinstance(after, str):
+                after = [after]
+            kind = stage.get("dependency", "afterok")
+            for name in after:
+                if name not in entries:
+                    raise ValueError(f"Unknown stage: {name}")
+            if kind not in DEPENDENCY_TYPES:
+                raise ValueError(f"dependency must be one of {DEPENDENCY_TYPES}")
+            entries[stage["name"]] = stage_entries
+            for index in range(len(stage_entries)):
+                key = (stage["name"], index)
+                order.append(key)
+                if kind == "aftercorr":
+                    # like FakeSbatch, an index the earlier stage does not have
+                    # counts as failed
+                    dependencies[key] = [
+                        (kind, (name, index) if index < len(entries[name]) else None)
+                        for name in after
+                    ]
+                elif after:
+                    dependencies[key] = [
+                        (kind, (name, i))
+                        for name in after
+                        for i in range(len(entries[name]))
+                    ]
+
+        slots = self._slots(stages)
+        if dry_run:
+            for name, stage_entries in entries.items():
+                cpus, memory = self._limits(by_name[name])
+                memory = format_memory(memory) if memory else "no memory limit"
+                print(f"{name}: {len(stage_entries)} tasks, {cpus} cpus, {memory}")
+                for entry in stage_entries:
+                    print(f"  {entry['name']}")
+            print(f"{len(slots)} tasks at once")
+            return {}
+
+        print(f"running {len(order)} tasks, {len(slots)} at once")
+        results = {}
+        pending = list(order)
+        running = {}
+        start = time.time()
+        with ThreadPoolExecutor(len(slots)) as pool:
+            while pending or running:
+                n_pending = len(pending)
+                for key in list(pending):
+                    if not slots:
+                        break
+                    ready = self._ready(key, dependencies, results)
+                    if ready is None:
+                        continue
+                    pending.remove(key)
+                    name, index = key
+                    if not ready:
+                        results[key] = None
+                        print(f"skipped {name} {entries[name][index]['name']}")
+                        continue
+                    cpu_set = slots.pop()
+                    entry = entries[name][index]
+                    future = pool.submit(
+                        self._run_task, by_name[name], index, entry, cpu_set
+                    )
+                    running[future] = (key, cpu_set)
+                if not running:
+                    if len(pending) == n_pending:
+                        raise RuntimeError(
+                            f"{len(pending)} tasks wait for tasks that never run"
+                        )
+                    # tasks after a skipped one are skipped on the next pass
+                    continue
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    key, cpu_set = running.pop(future)
+                    slots.append(cpu_set)
+                    returncode, seconds = future.result()
+                    results[key] = returncode
+                    name, index = key
+                    status = "ok" if returncode == 0 else f"failed ({returncode})"
+                    print(
+                        f"[{len(results)}/{len(order)}] {name} "
+                        f"{entries[name][index]['name']} {status} in {seconds:.0f}s, "
+                        f"{len(running)} running, {time.time() - start:.0f}s elapsed"
+                    )
+
+        summary = {}
+        for name, index in order:
+            summary.setdefault(name, []).append(results[(name, index)])
+        codes = [code for stage_codes in summary.values() for code in stage_codes]
+        failed = sum(code not in [0, None] for code in codes)
+        skipped = codes.count(None)
+        ok = len(codes) - failed - skipped
+        print(f"done: {ok} ok, {failed} failed, {skipped} skipped")
+        return summary
+
+
+def add_executor_arguments(parser):
+    """Backend options shared by the scripts that run task manifests"""
+    parser.add_argument("--backend", type=str, default="slurm", choices=BACKENDS)
+    parser.add_argument(
+        "--yes", action="store_true", help="run without asking, e.g. in CI"
+    )
+    parser.add_argument(
+        "--dry_run", action="store_true", help="print the jobs, run nothing"
+    )
+    parser.add_argument(
+        "--workers", type=int, default=None, help="local tasks at once"
+    )
+    parser.add_argument("--cpus_per_task", type=int, default=None)
+    parser.add_argument("--memory_per_task", type=str, default=None, help="e.g. 8GB")
+    return parser
+
+
+def executor_from_args(args, email=None, log_dir=None):
+    """SlurmExecutor or LocalExecutor from add_executor_arguments options"""
+    if args.backend == "local":
+        return LocalExecutor(
+            workers=args.workers,
+            cpus_per_task=args.cpus_per_task,
+            memory_per_task=args.memory_per_task,
+            log_dir=log_dir,
+        )
+    return SlurmExecutor(
+        email=email,
+        log_dir=log_dir,
+        cpus_per_task=args.cpus_per_task,
+        memory_per_task=args.memory_per_task,
+    )
+
+
+def confirm(args, question):
+    """True with --yes, else ask, replaces the input() prompts of the scripts"""
+    if args.yes or args.dry_run:
+        return True
+    return input(f"{question} (yes/no): ").lower() == "yes"
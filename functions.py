@@ -131,3 +131,29 @@ def convert_time_to_seconds(time):
 
 
 # %%
+
+
+# gdal_translate commands that write each band of a spfeas VRT to its own tif,
+# bands are ordered by scale then by the outputs in feature_bands_table. vrt can
+# be a shell variable resolved when the job runs, e.g. "$vrt"
+def vrt_to_tif_commands(
+    vrt, folder, feature, scales, tif_directory, tif_options, overviews=None, scale=None
+):
+    commands = []
+    band_count = 0
+    for vrt_scale in scales:
+        for output in feature_bands_table[feature]:
+            band_count += 1
+            if scale is not None and str(vrt_scale) != str(scale):
+                continue
+            output_tif = os.path.join(
+                tif_directory, f"{folder}_SC{vrt_scale}_{output}.tif"
+            )
+            commands.append(f"# scale: {vrt_scale}, output: {output}")
+            commands.append(
+                f"gdal_translate -b {band_count} {tif_options} {vrt} {output_tif}"
+            )
+            if overviews is not None:
+                # e.g. cog.gdaladdo_command so the tiled tif reads like a COG
+                commands.append(overviews(output_tif))
+    return commands
@@ -0,0 +1,249 @@
+# Description: Track Earth Engine export tasks with bounded concurrency, status
+# polling, retries and a resumable state file
+# author: Michael Mann mmann1123@gwu.edu
+
+# Example:
+# from gee_tasks import ExportTaskManager
+# manager = ExportTaskManager("gee_export_state.json", max_in_flight=20)
+# submit_composite_exports(plan, task_manager=manager)
+# manager.run()
+
+# tasks are queued as factories that build a new ee.batch.Task, ee does not start
+# a task object twice so every retry starts a fresh one
+
+# rerunning the same script skips every export already marked COMPLETED in the
+# state file and re-attaches to tasks that were still running
+
+import json
+import os
+import random
+import time
+
+DONE_STATES = ["COMPLETED"]
+FAILED_STATES = ["FAILED", "CANCELLED"]
+ACTIVE_STATES = ["UNSUBMITTED", "READY", "RUNNING", "CANCEL_REQUESTED"]
+
+
+class EarthEngineBackend:
+    """Start and poll tasks on Earth Engine."""
+
+    def start(self, task):
+        """Start an ee.batch.Task
+        Args:
+            task: ee.batch.Task
+        Returns:
+            str: task id
+        """
+        task.start()
+        return task.id
+
+    def status(self, task_id):
+        """Get the state of a task
+        Args:
+            task_id (str): task id returned by start
+        Returns:
+            tuple: (state, error message or None)
+        """
+        import ee
+
+        status = ee.data.getTaskStatus(task_id)[0]
+        return status["state"], status.get("error_message")
+
+
+class FakeClock:
+    """Clock that only moves when sleep is called, for use with FakeBackend."""
+
+    def __init__(self, now=0.0):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class FakeBackend:
+    """Local stand in for Earth Engine that simulates task latency and failures.
+
+    Args:
+        latency (tuple): (min, max) seconds a task takes to finish
+        failure_rate (float): probability that a started task fails
+        clock (callable): returns the current time, e.g. FakeClock().time
+        seed (int): random seed
+    """
+
+    def __init__(self, latency=(1, 5), failure_rate=0.0, clock=time.monotonic, seed=None):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.clock = clock
+        self.random = random.Random(seed)
+        self.tasks = {}
+        self.started = []
+
+    def start(self, task):
+        task_id = f"FAKE_{len(self.started)}"
+        self.started.append(task)
+        finish = self.clock() + self.random.uniform(*self.latency)
+        fails = self.random.random() < self.failure_rate
+        self.tasks[task_id] = (finish, fails)
+        return task_id
+
+    def status(self, task_id):
+        if task_id not in self.tasks:
+            return "FAILED", "unknown task id"
+        finish, fails = self.tasks[task_id]
+        if self.clock() < finish:
+            return "RUNNING", None
+        if fails:
+            return "FAILED", "simulated failure"
+        return "COMPLETED", None
+
+
+class ExportTaskManager:
+    """Run export tasks with at most max_in_flight running at once.
+
+    Task states are written to a JSON file after every change so a rerun
+    skips exports that already succeeded.
+
+    Args:
+        state_path (str): path to the JSON state file
+        backend: object with start(task) and status(task_id), defaults to EarthEngineBackend
+        max_in_flight (int): maximum number of tasks submitted but not finished
+        poll_interval (float): seconds between status polls
+        max_retries (int): number of times a failed task is resubmitted
+        backoff (float): seconds before the first retry, doubled for each further retry
+        clock (callable): returns the current time
+        sleep (callable): sleeps for a number of seconds
+    """
+
+    def __init__(
+        self,
+        state_path,
+        backend=None,
+        max_in_flight=10,
+        poll_interval=30,
+        max_retries=3,
+        backoff=60,
+        clock=time.monotonic,
+        sleep=time.sleep,
+    ):
+        self.state_path = state_path
+        self.backend = backend or EarthEngineBackend()
+        self.max_in_flight = max_in_flight
+        self.poll_interval = poll_interval
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.clock = clock
+        self.sleep = sleep
+        self.pending = {}
+        self.state = self._load()
+
+    def _load(self):
+        if os.path.exists(self.state_path):
+            with open(self.state_path) as f:
+                return json.load(f)
+        return {}
+
+    def _save(self):
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(self.state, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.state_path)
+
+    def is_complete(self, name):
+        """Check if an export already succeeded
+        Args:
+            name (str): export name
+        Returns:
+            bool
+        """
+        return self.state.get(name, {}).get("state") in DONE_STATES
+
+    def add(self, name, make_task):
+        """Queue a task unless it already succeeded
+        Args:
+            name (str): unique export name
+            make_task (callable): returns a new task object for backend.start,
+                called once per attempt, e.g. a functools.partial of
+                helpers.composite_export_task
+        Returns:
+            bool: True if the task was queued
+        """
+        if not callable(make_task):
+            raise TypeError(f"Queue a function that builds the task of {name}")
+        if self.is_complete(name):
+            return False
+        record = self.state.setdefault(name, {"state": "UNSUBMITTED", "attempts": 0})
+        if record["state"] in FAILED_STATES:
+            # failed in an earlier run, start counting retries again
+            record["attempts"] = 0
+        self.pending[name] = make_task
+        return True
+
+    def _start(self, name):
+        record = self.state[name]
+        # a failed ee.batch.Task cannot be started again, build a new one
+        record["task_id"] = self.backend.start(self.pending[name]())
+        record["state"] = "READY"
+        record["attempts"] += 1
+        record["error"] = None
+
+    def run(self):
+        """Submit queued tasks and poll them until all have finished
+        Returns:
+            dict: number of tasks per final state
+        """
+        queue = []
+        in_flight = []
+        for name in self.pending:
+            record = self.state[name]
+            if record["state"] in DONE_STATES:
+                continue
+            if record["state"] in ACTIVE_STATES and record.get("task_id"):
+                # still running from a previous run, poll instead of resubmitting
+                in_flight.append(name)
+            else:
+                queue.append(name)
+        retry_at = {}
+
+        print(f"Tasks queued: {len(queue)}, already running: {len(in_flight)}")
+        while queue or in_flight:
+            now = self.clock()
+            for name in list(queue):
+                if len(in_flight) >= self.max_in_flight:
+                    break
+                if retry_at.get(name, now) > now:
+                    continue
+                self._start(name)
+                queue.remove(name)
+                in_flight.append(name)
+            self._save()
+
+            self.sleep(self.poll_interval)
+
+            for name in list(in_flight):
+                record = self.state[name]
+                state, error = self.backend.status(record["task_id"])
+                record["state"] = state
+                record["error"] = error
+                if state in DONE_STATES:
+                    in_flight.remove(name)
+                    print(f"Completed: {name}")
+                elif state in FAILED_STATES:
+                    in_flight.remove(name)
+                    if record["attempts"] <= self.max_retries:
+                        delay = self.backoff * 2 ** (record["attempts"] - 1)
+                        retry_at[name] = self.clock() + delay
+                        queue.append(name)
+                        print(f"Failed: {name} ({error}), retrying in {delay}s")
+                    else:
+                        print(f"Failed: {name} ({error}), giving up")
+            self._save()
+
+        summary = {}
+        for name in self.pending:
+            state = self.state[name]["state"]
+            summary[state] = summary.get(state, 0) + 1
+        print("Task summary:", summary)
+        return summary
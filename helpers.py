@@ -13,6 +13,7 @@
 # BUFFER = 100
 
 import json
+from functools import partial
 
 
 def get_quarter_dates(quarter_str):
@@ -73,13 +74,18 @@ def get_quarter_dates(quarter_str):
 #     return image.updateMask(not_water.Not())
 
 
-def bounds_tiler(image_list, max_area=2.5e10):
+def bounds_tiler(image_list, max_area=2.5e10, resolution=10, halo=0):
     """Breaks the image into smaller blocks if the area is too large
     geowobat has trouble with large image blocks
 
+    Blocks come from tiling.plan_tiles, so they form a 2D grid aligned to the
+    pixel grid rather than strips along y.
+
     Args:
         image_list (list): list of images
         max_area (float): maximum area in meters for a block
+        resolution (float): pixel size in meters
+        halo (int): pixels added on each side of a block
 
     Returns:
         list: list of bounds
@@ -100,36 +106,26 @@ def bounds_tiler(image_list, max_area=2.5e10):
                         )
 
     """
-    import geopandas as gpd
-    from shapely.geometry import Polygon
+    from shapely.geometry import box
     from geowombat.backends.rasterio_ import get_file_bounds
+    from tiling import plan_tiles, tile_bounds
 
     bounds = get_file_bounds(
         image_list,
         return_bounds=True,
     )
-    # convert bounds to meters in global equal area projection
-    minx, miny, maxx, maxy = bounds
-    bounds_gdf = gpd.GeoDataFrame(
-        geometry=[Polygon([(minx, miny), (minx, maxy), (maxx, maxy), (maxx, miny)])],
-        crs="EPSG:4326",
+    tiles = plan_tiles(
+        box(*bounds),
+        resolution=resolution,
+        max_pixels=int(max_area / resolution**2),
+        halo=halo,
+        crs="EPSG:6933",
     )
-    area = bounds_gdf.to_crs("EPSG:6933").area.values
     # if small return one block
-    if area < max_area:
+    if len(tiles) == 1:
         return [bounds]
-    elif area > max_area:
-        print("Large block found, breaking into 2.5e10m^2 blocks")
-        num_blocks = int(area / max_area) + 1
-        print("num_blocks:", num_blocks)
-
-        # get the bounds of the block
-        y_step = (maxy - miny) / num_blocks
-        blocks = [
-            [minx, miny + i * y_step, maxx, miny + (i + 1) * y_step]
-            for i in range(num_blocks)
-        ]
-        return blocks
+    print("Large block found, num_blocks:", len(tiles))
+    return tile_bounds(tiles, crs="EPSG:4326")
 
 
 def list_files_pattern(images, pattern):
@@ -480,3 +476,369 @@ def create_ee_polygon_from_geojson(geojson_path):
         raise ValueError(
             "The GeoJSON must be a Feature or FeatureCollection with Polygon or MultiPolygon geometries"
         )
+
+
+def prepare_geometry(
+    geojson_path,
+    SCALE=10,
+    tolerance=None,
+    hull=False,
+    precision=1e-6,
+    cache_dir="./data/geometry_cache",
+    crs="EPSG:32736",
+):
+    """Simplify an AOI for export and cache the coordinate payload on disk
+
+    The geometry is buffered and then simplified by tolerance in a projected crs,
+    so the result still covers the original AOI. The adm2 boundaries are already
+    sparse, so most of the saving comes from snapping the coordinates to precision
+    degrees (1e-6 is about 0.1 m, well inside the buffer) instead of the 15 digits
+    of the source files. The payload is cached under a key made of the file hash,
+    tolerance, hull and precision, so later calls skip both the simplification
+    and any getInfo round trip.
+
+    Args:
+        geojson_path (str): path to the .geojson file
+        SCALE (int): export scale in meters
+        tolerance (float): simplification tolerance in meters, defaults to SCALE
+        hull (bool): use the convex hull of the AOI
+        precision (float): grid size in degrees the coordinates are snapped to
+        cache_dir (str): folder holding the cached payloads
+        crs (str): projected crs used for the simplification
+    Returns:
+        dict: GeoJSON geometry in EPSG:4326, pass to ee.Geometry or use
+            ["coordinates"] as an export region
+
+    Example:
+
+    north = prepare_geometry("./data/north_adm2.geojson", SCALE=10)
+    fc_north = ee.Geometry(north)
+    """
+    import hashlib
+    import os
+
+    if tolerance is None:
+        tolerance = SCALE
+
+    with open(geojson_path, "rb") as f:
+        file_hash = hashlib.sha256(f.read()).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(geojson_path))[0]
+    cache_path = os.path.join(
+        cache_dir,
+        f"{name}_{file_hash}_tol{tolerance:g}_prec{precision:g}"
+        f"{'_hull' if hull else ''}.json",
+    )
+    if os.path.exists(cache_path):
+        with open(cache_path) as f:
+            payload = json.load(f)
+        print(f"Using cached geometry {cache_path} ({len(json.dumps(payload))} bytes)")
+        return payload
+
+    import geopandas as gpd
+    import shapely
+    from shapely.geometry import mapping
+
+    aoi = gpd.read_file(geojson_path)
+    before = len(json.dumps(mapping(aoi.to_crs("EPSG:4326").unary_union)))
+
+    geometry = aoi.to_crs(crs).unary_union
+    if hull:
+        geometry = geometry.convex_hull
+    geometry = geometry.buffer(tolerance).simplify(tolerance)
+    geometry = gpd.GeoSeries([geometry], crs=crs).to_crs("EPSG:4326").iloc[0]
+    geometry = shapely.set_precision(geometry, precision)
+    payload = json.loads(json.dumps(mapping(geometry)))
+    print(
+        f"Prepared geometry {name}: {before} bytes -> {len(json.dumps(payload))} bytes"
+    )
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(cache_path, "w") as f:
+        json.dump(payload, f)
+    return payload
+
+
+def quarter_date_ranges(years):
+    """List the quarters covered by a set of years
+    Args:
+        years (iterable): years to include, e.g. range(2020, 2025)
+    Returns:
+        list: list of (year, quarter, start_date, end_date) tuples, dates as "YYYY-MM-DD"
+
+    # Example usage
+    for year, quarter, start, end in quarter_date_ranges(range(2021, 2024)):
+        print(year, quarter, start, end)
+    """
+    import pendulum
+
+    quarters = []
+    for year in years:
+        for quarter in range(1, 5):
+            dt = pendulum.datetime(year, 3 * quarter - 2, 1)
+            quarters.append(
+                (
+                    year,
+                    quarter,
+                    dt.first_of("quarter").strftime(r"%Y-%m-%d"),
+                    dt.last_of("quarter").strftime(r"%Y-%m-%d"),
+                )
+            )
+    return quarters
+
+
+def build_quarterly_composite(
+    site,
+    start_date,
+    end_date,
+    bands,
+    CLOUD_FILTER=75,
+    CLD_PRB_THRESH=30,
+    NIR_DRK_THRESH=0.2,
+    CLD_PRJ_DIST=2,
+    BUFFER=40,
+    SCALE=10,
+    float_scenes=True,
+):
+    """Build the cloud masked median composite for one site and date range.
+    Args:
+        site: ee.Geometry, area of interest
+        start_date: str, start date in 'YYYY-MM-DD' format
+        end_date: str, end date in 'YYYY-MM-DD' format
+        bands: list, bands to keep in the composite
+        CLOUD_FILTER: int, maximum cloud cover percentage
+        CLD_PRB_THRESH: int, cloud probability threshold
+        NIR_DRK_THRESH: float, NIR dark pixel threshold
+        CLD_PRJ_DIST: int, cloud projection distance
+        BUFFER: int, buffer distance around cloud objects
+        SCALE: int, image scale in meters
+        float_scenes: bool, convert each scene to float before the median
+    Returns:
+        ee.Image
+    """
+    collection = get_s2A_SR_sr_cld_collection(
+        site,
+        start_date,
+        end_date,
+        CLOUD_FILTER=CLOUD_FILTER,
+    )
+
+    # add cloud and shadow mask
+    masked = collection.map(
+        lambda image: add_cld_shdw_mask(
+            image,
+            CLD_PRB_THRESH=CLD_PRB_THRESH,
+            NIR_DRK_THRESH=NIR_DRK_THRESH,
+            CLD_PRJ_DIST=CLD_PRJ_DIST,
+            SCALE=SCALE,
+            BUFFER=BUFFER,
+        )
+    ).map(apply_cld_shdw_mask)
+    if float_scenes:
+        masked = masked.map(convert_to_float)
+
+    return masked.select(bands).median()
+
+
+def plan_composite_exports(
+    sites,
+    years,
+    bands=None,
+    multiband=None,
+    mask_band=None,
+    folder="malawi_imagery",
+    mask_folder="cloud_mask",
+    composite_params=None,
+    max_pixels=500000000000,
+    regions=None,
+):
+    """Plan the exports for each (site, quarter) composite.
+
+    Every entry of the plan describes a single composite graph and all the
+    exports that are fanned out from it, so the composite is only built once
+    no matter how many bands are exported.
+
+    Args:
+        sites (dict): site name -> ee.Geometry (or any placeholder for a dry run)
+        years (iterable): years to composite
+        bands (list): bands exported as single band images "{band}_S2_SR_{year}_Q{qq}_{site}"
+        multiband (list): bands exported together as "S2_SR_{year}_Q{qq}_{site}"
+        mask_band (str): band used for the "NoDataMask_{year}_Q{qq}_{site}" export, None to skip
+        folder (str): google drive folder for image exports
+        mask_folder (str): google drive folder for no data mask exports
+        composite_params (dict): keyword arguments for build_quarterly_composite
+        max_pixels (int): maxPixels for each export
+        regions (dict): site name -> GeoJSON geometry from prepare_geometry, used as
+            the export region instead of pulling coordinates with getInfo
+    Returns:
+        list: list of composite entries, each with an "exports" list
+
+    Example:
+
+    plan = plan_composite_exports(
+        {"north": fc_north},
+        range(2020, 2025),
+        bands=["B2", "B3"],
+        mask_band="B2",
+    )
+    submit_composite_exports(plan, dry_run=True)
+    """
+    bands = list(bands or [])
+    multiband = list(multiband or [])
+    composite_params = dict(composite_params or {})
+    regions = dict(regions or {})
+
+    # bands needed in the composite graph
+    composite_bands = list(bands)
+    for band in multiband + ([mask_band] if mask_band else []):
+        if band not in composite_bands:
+            composite_bands.append(band)
+    if not composite_bands:
+        raise ValueError("At least one of bands, multiband or mask_band is required")
+
+    plan = []
+    for name, site in sites.items():
+        for year, quarter, start_date, end_date in quarter_date_ranges(years):
+            period = f"{year}_Q{str(quarter).zfill(2)}"
+            exports = [
+                {
+                    "kind": "band",
+                    "name": f"{band}_S2_SR_{period}_{name}",
+                    "bands": [band],
+                    "folder": folder,
+                    "max_pixels": max_pixels,
+                }
+                for band in bands
+            ]
+            if multiband:
+                exports.append(
+                    {
+                        "kind": "multiband",
+                        "name": f"S2_SR_{period}_{name}",
+                        "bands": multiband,
+                        "folder": folder,
+                        "max_pixels": max_pixels,
+                    }
+                )
+            if mask_band:
+                exports.append(
+                    {
+                        "kind": "mask",
+                        "name": f"NoDataMask_{period}_{name}",
+                        "bands": [mask_band],
+                        "folder": mask_folder,
+                        "max_pixels": max_pixels,
+                    }
+                )
+            plan.append(
+                {
+                    "site": name,
+                    "geometry": site,
+                    "region": regions.get(name),
+                    "year": year,
+                    "quarter": quarter,
+                    "start_date": start_date,
+                    "end_date": end_date,
+                    "bands": composite_bands,
+                    "params": composite_params,
+                    "exports": exports,
+                }
+            )
+    return plan
+
+
+def composite_export_task(composite, export, region, scale=10, region_payload=None):
+    """Create (but do not start) the export task for one planned export.
+    Args:
+        composite: ee.Image, composite returned by build_quarterly_composite
+        export (dict): export entry from plan_composite_exports
+        region: ee.Geometry, export region
+        scale (int): export scale in meters
+        region_payload (dict): GeoJSON geometry of region from prepare_geometry
+    Returns:
+        ee.batch.Task
+    """
+    import ee
+
+    if export["kind"] == "mask":
+        # Create no-data mask where 1 = missing data, 0 = valid data
+        no_data_mask = composite.select(export["bands"][0]).mask().Not().toUint8()
+        return ee.batch.Export.image.toDrive(
+            image=no_data_mask,
+            description=export["name"],
+            folder=export["folder"],
+            fileNamePrefix=export["name"],
+            scale=scale,
+            maxPixels=export["max_pixels"],
+            # the cached payload avoids a getInfo round trip per export
+            region=(
+                region_payload["coordinates"]
+                if region_payload is not None
+                else region.getInfo()["coordinates"]
+            ),
+            fileFormat="GeoTIFF",
+        )
+
+    image = composite.select(export["bands"])
+    if export["kind"] == "multiband":
+        image = image.toFloat()
+    export_config = {
+        "scale": scale,
+        "maxPixels": export["max_pixels"],
+        "driveFolder": export["folder"],
+        "region": region,
+    }
+    return ee.batch.Export.image(image, export["name"], export_config)
+
+
+def submit_composite_exports(plan, scale=10, dry_run=False, task_manager=None):
+    """Build each planned composite once and start all of its exports.
+    Args:
+        plan (list): output of plan_composite_exports
+        scale (int): export scale in meters
+        dry_run (bool): only report what would be submitted, nothing is sent to ee
+        task_manager: gee_tasks.ExportTaskManager, if given tasks are queued on it
+            instead of started, and composites whose exports all succeeded are skipped
+    Returns:
+        dict: {"composites": number of composite graphs, "exports": number of export tasks}
+    """
+    n_composites = 0
+    n_exports = 0
+    for entry in plan:
+        exports = entry["exports"]
+        if task_manager is not None:
+            exports = [e for e in exports if not task_manager.is_complete(e["name"])]
+            if not exports:
+                continue
+        n_composites += 1
+        n_exports += len(exports)
+        if dry_run:
+            continue
+
+        print(f"Site: {entry['site']} Year: {entry['year']} Quarter: {entry['quarter']}")
+        composite = build_quarterly_composite(
+            entry["geometry"],
+            entry["start_date"],
+            entry["end_date"],
+            entry["bands"],
+            **entry["params"],
+        )
+        for export in exports:
+            make_task = partial(
+                composite_export_task,
+                composite,
+                export,
+                entry["geometry"],
+                scale,
+                region_payload=entry.get("region"),
+            )
+            if task_manager is not None:
+                # built again for every attempt, see ExportTaskManager.add
+                task_manager.add(export["name"], make_task)
+            else:
+                make_task().start()
+
+    print(
+        f"{'Dry run: ' if dry_run else ''}{n_composites} composite graphs, "
+        f"{n_exports} export tasks"
+    )
+    return {"composites": n_composites, "exports": n_exports}
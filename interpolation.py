@@ -0,0 +1,1160 @@
+# Description: Schedule the (band, grid) interpolation tasks of
+# 1_interpolate_missing_values.py across a process pool that fits in memory
+# author: Michael Mann mmann1123@gwu.edu
+
+# each task runs the same gw.series apply as the serial loop (num_workers=1 per
+# task), so outputs are identical, but several tasks run at once as long as
+# their estimated memory fits in the budget
+
+# Example:
+# from interpolation import build_interpolation_tasks, run_tasks
+# tasks = build_interpolation_tasks(["B2", "B3"], ["north"], output_dir="interpolated")
+# run_tasks(tasks, max_workers=12, mem_budget="200GB")
+
+# fill_gaps is a numba compiled alternative to xr_fresh interpolate_nan for the
+# (time, band, y, x) windows gw.series hands over, compare them with
+# python interpolation.py benchmark --times 8 16 32
+
+# append_quarter extends an existing stack by a new quarter, re-interpolating
+# only the trailing gaps it closes. the last valid quarter of each pixel is kept
+# in a {stack}_last.tif sidecar next to the stack
+
+# every stack gets a {stack}_stats.json sidecar with per quarter mean, std, min,
+# max, count and histogram collected while it is written, see raster_stats, and
+# the valid pixels of each quarter before filling (observed), the cloud free
+# weights of the mosaic overlap rules
+
+# group_by_grid merges the band tasks of a grid so run_multiband_task reads each
+# window once across all bands and quarters and writes one stack per band
+
+import argparse
+import csv
+import multiprocessing
+import os
+import re
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from glob import glob
+
+import numpy as np
+
+from cog import gtiff_profile
+from raster_stats import StatsAccumulator, read_stats
+from resources import (
+    available_memory,
+    format_memory,
+    parse_memory,
+    window_size_for_memory,
+)
+
+try:
+    import geowombat as gw
+
+    TimeModule = gw.TimeModule
+except ImportError:
+    TimeModule = object
+
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+    prange = range
+
+# jax and its import cost dominate the memory of an idle worker
+WORKER_BASE_MEMORY = 1.5 * 1024**3
+
+# interpolated stacks are intermediate and read by a recent GDAL, tiled with the
+# float predictor but without overviews, a task codec of None writes the stacks
+# with the same options as the serial loop
+STACK_CODEC = "zstd"
+
+FILL_METHODS = {"linear": 0, "nearest": 1}
+EDGE_POLICIES = {"nan": 0, "nearest": 1, "extrapolate": 2}
+
+
+def _fill_gaps_kernel(data, method, edge):
+    """Fill nan gaps along axis 0 of a (time, pixels) float64 array, one pixel per thread"""
+    n_time, n_pixels = data.shape
+    out = data.copy()
+    for p in prange(n_pixels):
+        first = -1
+        second = -1
+        before_last = -1
+        prev = -1
+        for t in range(n_time):
+            if np.isnan(data[t, p]):
+                continue
+            if first < 0:
+                first = t
+            elif second < 0:
+                second = t
+            if prev >= 0 and t - prev > 1:
+                slope = (data[t, p] - data[prev, p]) / (t - prev)
+                for g in range(prev + 1, t):
+                    if method == 1:
+                        # nearest, ties go to the earlier observation
+                        out[g, p] = data[prev, p] if g - prev <= t - g else data[t, p]
+                    else:
+                        # same form as np.interp
+                        out[g, p] = slope * (g - prev) + data[prev, p]
+            before_last = prev
+            prev = t
+        if first < 0 or edge == 0:
+            continue
+        last = prev
+        if edge == 2 and second >= 0:
+            slope = (data[second, p] - data[first, p]) / (second - first)
+            for g in range(first):
+                out[g, p] = data[first, p] - slope * (first - g)
+            slope = (data[last, p] - data[before_last, p]) / (last - before_last)
+            for g in range(last + 1, n_time):
+                out[g, p] = data[last, p] + slope * (g - last)
+        else:
+            for g in range(first):
+                out[g, p] = data[first, p]
+            for g in range(last + 1, n_time):
+                out[g, p] = data[last, p]
+    return out
+
+
+if njit is not None:
+    _fill_gaps_kernel = njit(parallel=True, cache=True)(_fill_gaps_kernel)
+
+
+def fill_gaps_array(array, method="linear", edge="nearest", missing_value=np.nan):
+    """Fill missing values along the first (time) axis
+    Args:
+        array (numpy.ndarray): (time, ...) array
+        method (str): "linear" or "nearest"
+        edge (str): leading and trailing gaps, "nan" to leave them, "nearest" to
+            repeat the first or last observation (like np.interp) or "extrapolate"
+            to extend the slope of the first or last two observations
+        missing_value (float): value treated as missing besides nan
+    Returns:
+        numpy.ndarray: float64 array of the same shape
+    """
+    if method not in FILL_METHODS:
+        raise ValueError(f"method must be one of {list(FILL_METHODS)}")
+    if edge not in EDGE_POLICIES:
+        raise ValueError(f"edge must be one of {list(EDGE_POLICIES)}")
+    array = np.asarray(array, dtype="float64")
+    shape = array.shape
+    data = array.reshape(shape[0], -1)
+    if missing_value is not None and not np.isnan(missing_value):
+        data = np.where(data == missing_value, np.nan, data)
+    data = np.ascontiguousarray(data)
+    out = _fill_gaps_kernel(data, FILL_METHODS[method], EDGE_POLICIES[edge])
+    return out.reshape(shape)
+
+
+class fill_gaps(TimeModule):
+    """gw.series module that fills time series gaps with the numba kernel
+
+    Drop in for xr_fresh interpolate_nan, use transfer_lib="numpy".
+
+    Args:
+        method (str): "linear" or "nearest"
+        edge (str): "nan", "nearest" or "extrapolate", see fill_gaps_array
+        missing_value (float): value treated as missing
+        count (int): number of output bands, the number of time steps
+
+    Example:
+
+    with gw.series(files, transfer_lib="numpy", window_size=[512, 512]) as src:
+        src.apply(
+            func=fill_gaps(method="linear", count=len(src.filenames)),
+            outfile="B2_S2_SR_interp_linear_north.tif",
+            bands=1,
+        )
+    """
+
+    def __init__(self, method="linear", edge="nearest", missing_value=np.nan, count=1):
+        super().__init__()
+        self.method = method
+        self.edge = edge
+        self.missing_value = missing_value
+        self.count = count
+
+    def calculate(self, array):
+        filled = fill_gaps_array(array, self.method, self.edge, self.missing_value)
+        # (time x 1 x height x width) -> (time x height x width)
+        return filled.squeeze()
+
+
+class gap_aware(TimeModule):
+    """Wrap a gap filling module so only pixels with gaps are interpolated
+
+    Windows without any missing value are passed straight through. In mixed
+    windows the pixels with gaps are gathered into a compact (time, 1, 1, n)
+    batch, filled by the wrapped module and scattered back. Skipped windows and
+    pixels are counted in stats.
+
+    Args:
+        module: gw.TimeModule that fills gaps along time, e.g. interpolate_nan or fill_gaps
+        missing_value (float): value treated as missing besides nan
+    """
+
+    def __init__(self, module, missing_value=np.nan):
+        super().__init__()
+        self.module = module
+        self.missing_value = missing_value
+        self.count = module.count
+        self.dtype = getattr(module, "dtype", "float64")
+        self.stats = dict.fromkeys(
+            ["windows", "windows_skipped", "pixels", "pixels_filled"], 0
+        )
+        self._lock = threading.Lock()
+
+    def calculate(self, array):
+        array = np.asarray(array, dtype="float64")
+        data = array.reshape(array.shape[0], -1)
+        missing = np.isnan(data)
+        if self.missing_value is not None and not np.isnan(self.missing_value):
+            missing |= data == self.missing_value
+        gaps = missing.any(axis=0)
+        n_gaps = int(gaps.sum())
+
+        with self._lock:
+            self.stats["windows"] += 1
+            self.stats["windows_skipped"] += n_gaps == 0
+            self.stats["pixels"] += data.shape[1]
+            self.stats["pixels_filled"] += n_gaps
+
+        if n_gaps == 0:
+            return array.squeeze()
+        batch = data[:, gaps].reshape(data.shape[0], 1, 1, n_gaps)
+        filled = np.asarray(self.module.calculate(batch), dtype="float64")
+        out = data.copy()
+        out[:, gaps] = filled.reshape(data.shape[0], n_gaps)
+        return out.reshape(array.shape).squeeze()
+
+    def skipped(self):
+        """Share of windows and pixels that needed no interpolation
+        Returns:
+            dict: windows_skipped_fraction and pixels_skipped_fraction
+        """
+        stats = self.stats
+        return {
+            "windows_skipped_fraction": round(
+                stats["windows_skipped"] / max(stats["windows"], 1), 4
+            ),
+            "pixels_skipped_fraction": round(
+                1 - stats["pixels_filled"] / max(stats["pixels"], 1), 4
+            ),
+        }
+
+
+class collect_stats(TimeModule):
+    """Wrap a gw.series module and collect statistics of its output bands
+
+    Statistics are accumulated per window as the output is written, so the
+    sidecar needs no extra read, see raster_stats. The valid pixels of the
+    input are counted before the module fills them.
+
+    Args:
+        module: gw.TimeModule returning (time, height, width)
+        count (int): output bands
+        missing_value (float): input value treated as missing besides nan
+    """
+
+    def __init__(self, module, count, missing_value=np.nan):
+        super().__init__()
+        self.module = module
+        self.count = count
+        self.missing_value = missing_value
+        self.dtype = getattr(module, "dtype", "float64")
+        self.stats = StatsAccumulator(count)
+        self._lock = threading.Lock()
+
+    def calculate(self, array):
+        # (time x 1 x height x width) -> (time x height x width)
+        observed = np.asarray(array).reshape(array.shape[0], *array.shape[2:])
+        with self._lock:
+            self.stats.observe(observed, missing_value=self.missing_value)
+        out = self.module.calculate(array)
+        data = np.asarray(out).reshape(array.shape[0], *array.shape[2:])
+        with self._lock:
+            self.stats.update(data)
+        return out
+
+
+def quarter_labels(names):
+    """Year and quarter, e.g. 2021_Q01, of each file name, else the name"""
+    labels = []
+    for name in names:
+        match = re.search(r"\d{4}_Q\d{2}", name or "")
+        labels.append(match.group() if match else name)
+    return labels
+
+
+def build_interpolation_tasks(
+    bands,
+    grids,
+    input_dir=".",
+    output_dir="interpolated",
+    interp_type="linear",
+    missing_value=float("nan"),
+    window_size=(512, 512),
+    transfer_lib="jax",
+    kernel="xr_fresh",
+    skip_complete=False,
+    append=False,
+    codec=STACK_CODEC,
+):
+    """List one interpolation task per (band, grid)
+    Args:
+        bands (list): band folders under input_dir, e.g. ["B2", "B3"]
+        grids (list): grid codes matched against the file names
+        input_dir (str): folder holding one sub folder of quarterly tifs per band
+        output_dir (str): folder for the interpolated stacks
+        interp_type (str): interpolation method passed to interpolate_nan
+        missing_value (float): value treated as missing
+        window_size (tuple): gw.series window rows and columns
+        transfer_lib (str): gw.series transfer library
+        kernel (str): "xr_fresh" for interpolate_nan or "numba" for fill_gaps, numba
+            always uses the numpy transfer library
+        skip_complete (bool): only interpolate pixels with gaps, see gap_aware
+        append (bool): extend existing stacks by their new quarters with
+            append_quarter instead of rebuilding them, stacks that are already
+            complete are skipped. append_quarter fills linearly, so stacks of
+            any other interp_type are always rebuilt
+        codec (str): stack codec, see cog.CODECS, None for the serial loop's
+            {"BIGTIFF": "YES"} options
+    Returns:
+        list: list of task dicts
+    """
+    if append and interp_type != "linear":
+        print(f"append only refills linearly, rebuilding the {interp_type} stacks")
+        append = False
+    tasks = []
+    for band_name in bands:
+        f_list = sorted(glob(os.path.join(input_dir, band_name, "*.tif")))
+        for grid in grids:
+            a_grid = sorted([f for f in f_list if grid in f])
+            if not a_grid:
+                print("no files for", band_name, grid)
+                continue
+            outfile = os.path.join(
+                output_dir, f"{band_name}_S2_SR_interp_{interp_type}_{grid}.tif"
+            )
+            mode = "full"
+            if append and os.path.exists(outfile):
+                import rasterio
+
+                with rasterio.open(outfile) as src:
+                    n_done = src.count
+                if n_done == len(a_grid):
+                    print("up to date", outfile)
+                    continue
+                if n_done < len(a_grid):
+                    mode = "append"
+            tasks.append(
+                {
+                    "band": band_name,
+                    "grid": grid,
+                    "files": a_grid,
+                    "outfile": outfile,
+                    "mode": mode,
+                    "interp_type": interp_type,
+                    "missing_value": missing_value,
+                    "window_size": list(window_size),
+                    "transfer_lib": "numpy" if kernel == "numba" else transfer_lib,
+                    "kernel": kernel,
+                    "skip_complete": skip_complete,
+                    "codec": codec,
+                }
+            )
+    return tasks
+
+
+def raster_shape(path):
+    """Rows, columns and bytes per pixel of a raster
+    Args:
+        path (str): raster path
+    Returns:
+        tuple: (rows, cols, itemsize)
+    """
+    import numpy as np
+    import rasterio
+
+    with rasterio.open(path) as src:
+        return src.height, src.width, np.dtype(src.dtypes[0]).itemsize
+
+
+def estimate_task_memory(task, copies=4):
+    """Estimate the peak memory of one interpolation task
+    Args:
+        task (dict): task from build_interpolation_tasks or group_by_grid
+        copies (int): window sized float64 arrays alive at once (input, mask,
+            interpolated values, output)
+    Returns:
+        int: bytes
+    """
+    files = task["files"]
+    if isinstance(files, dict):
+        # multiband task, every band is held for the window
+        files = [f for band_files in files.values() for f in band_files]
+    rows, cols, _ = raster_shape(files[0])
+    window_rows = min(task["window_size"][0], rows)
+    window_cols = min(task["window_size"][1], cols)
+    window = window_rows * window_cols * len(files) * 8
+    return int(WORKER_BASE_MEMORY + copies * window)
+
+
+def size_task_windows(tasks, mem_budget=None, max_workers=None, copies=4):
+    """Set each task's window_size from the memory budget
+
+    run_tasks keeps up to max_workers tasks in flight, so each window is sized
+    for that share of the budget, see resources.window_size_for_memory.
+
+    Args:
+        tasks (list): tasks from build_interpolation_tasks or group_by_grid
+        mem_budget (str|int): e.g. "32GB", defaults to the available memory
+        max_workers (int): concurrent tasks, defaults to the cpu count
+        copies (int): window sized float64 arrays alive at once per task
+    Returns:
+        list: the same tasks
+    """
+    for task in tasks:
+        files = task["files"]
+        n_bands = 1
+        if isinstance(files, dict):
+            n_bands = len(files)
+            files = next(iter(files.values()))
+        task["window_size"] = window_size_for_memory(
+            files[0],
+            n_times=len(files),
+            mem_budget=mem_budget,
+            n_bands=n_bands,
+            workers=min(max_workers or os.cpu_count(), len(tasks)),
+            copies=copies,
+            base_memory=WORKER_BASE_MEMORY,
+        )
+    return tasks
+
+
+def interpolation_module(task, count):
+    """gw.series module for a task
+    Args:
+        task (dict): task from build_interpolation_tasks
+        count (int): number of time steps
+    Returns:
+        gw.TimeModule
+    """
+    if task.get("kernel", "xr_fresh") == "numba":
+        module = fill_gaps(
+            method=task["interp_type"],
+            missing_value=task["missing_value"],
+            count=count,
+        )
+    else:
+        from xr_fresh.interpolate_series import interpolate_nan
+
+        module = interpolate_nan(
+            interp_type=task["interp_type"],
+            missing_value=task["missing_value"],
+            count=count,
+        )
+    if task.get("skip_complete", False):
+        module = gap_aware(module, missing_value=task["missing_value"])
+    return module
+
+
+def stack_options(task, dtype):
+    """Creation options of a task's stacks, see build_interpolation_tasks codec"""
+    codec = task.get("codec", STACK_CODEC)
+    if codec is None:
+        return {"BIGTIFF": "YES"}
+    return {**gtiff_profile(dtype, codec), "BIGTIFF": "YES"}
+
+
+def run_interpolation_task(task):
+    """Interpolate one (band, grid) time series, same as the serial script
+    Args:
+        task (dict): task from build_interpolation_tasks
+    Returns:
+        dict: band, grid, outfile, seconds, pixels and pixels_per_second, plus the
+            skipped window and pixel fractions when skip_complete is set
+    """
+    if task.get("mode") == "append":
+        return run_append_task(task)
+    if task.get("mode") == "multiband":
+        return run_multiband_task(task)
+    start = time.perf_counter()
+    rows, cols, _ = raster_shape(task["files"][0])
+    with gw.config.update(bigtiff="yes"):
+        with gw.series(
+            task["files"],
+            transfer_lib=task["transfer_lib"],
+            window_size=task["window_size"],
+        ) as src:
+            module = interpolation_module(task, count=len(src.filenames))
+            stats_module = collect_stats(
+                module,
+                count=len(src.filenames),
+                missing_value=task["missing_value"],
+            )
+            src.apply(
+                func=stats_module,
+                outfile=task["outfile"],
+                num_workers=1,
+                bands=1,
+                kwargs=stack_options(task, stats_module.dtype),
+            )
+    stats_module.stats.write(task["outfile"], quarter_labels(task["files"]))
+    seconds = time.perf_counter() - start
+    pixels = rows * cols * len(task["files"])
+    result = {
+        "band": task["band"],
+        "grid": task["grid"],
+        "outfile": task["outfile"],
+        "seconds": round(seconds, 2),
+        "pixels": pixels,
+        "pixels_per_second": round(pixels / seconds),
+    }
+    if isinstance(module, gap_aware):
+        result.update(module.skipped())
+        print(f"{task['band']} {task['grid']} skipped: {module.skipped()}")
+    return result
+
+
+def last_observation_path(stack_path):
+    """Sidecar holding the last valid quarter of each pixel of a stack"""
+    return os.path.splitext(stack_path)[0] + "_last.tif"
+
+
+def _missing(data, missing_value):
+    missing = np.isnan(data)
+    if missing_value is not None and not np.isnan(missing_value):
+        missing |= data == missing_value
+    return missing
+
+
+def build_last_observation(files, outfile, missing_value=np.nan, block_size=512):
+    """Record the last valid quarter and its value for each pixel
+
+    Files are read newest first and a block stops as soon as every pixel has an
+    observation, so only the trailing gaps are read.
+
+    Args:
+        files (list): quarterly tifs in time order
+        outfile (str): 2 band tif, band 1 the index of the last valid quarter
+            (-1 if none), band 2 its value
+        missing_value (float): value treated as missing besides nan
+        block_size (int): rows and columns read at once
+    Returns:
+        str: outfile
+    """
+    import rasterio
+    from rasterio.windows import Window
+
+    with rasterio.open(files[0]) as src:
+        profile = src.profile.copy()
+        height, width = src.height, src.width
+    profile.update(count=2, dtype="float64", nodata=None, driver="GTiff")
+    sources = [rasterio.open(f) for f in files]
+    try:
+        with rasterio.open(outfile, "w", **profile) as dst:
+            for row_off in range(0, height, block_size):
+                for col_off in range(0, width, block_size):
+                    window = Window(
+                        col_off,
+                        row_off,
+                        min(block_size, width - col_off),
+                        min(block_size, height - row_off),
+                    )
+                    shape = (window.height, window.width)
+                    index = np.full(shape, -1.0)
+                    value = np.full(shape, np.nan)
+                    for t in range(len(sources) - 1, -1, -1):
+                        todo = index < 0
+                        if not todo.any():
+                            break
+                        data = sources[t].read(1, window=window).astype("float64")
+                        found = todo & ~_missing(data, missing_value)
+                        index[found] = t
+                        value[found] = data[found]
+                    dst.write(np.stack([index, value]), window=window)
+    finally:
+        for src in sources:
+            src.close()
+    return outfile
+
+
+def append_window(stack, new, last_index, last_value):
+    """Extend an interpolated window by one quarter in place of a full rerun
+
+    Matches fill_gaps (linear, nearest edges) on the full series: pixels with a
+    new observation have their trailing gap, from the last observation to the
+    new quarter, interpolated again. Pixels without one repeat the last
+    observation. Bands before each pixel's last observation are not touched.
+
+    Args:
+        stack (numpy.ndarray): (time, rows, cols) interpolated bands, updated in place
+        new (numpy.ndarray): (rows, cols) new quarter, nan = missing
+        last_index (numpy.ndarray): (rows, cols) last valid quarter, -1 if none,
+            updated in place
+        last_value (numpy.ndarray): (rows, cols) value of the last valid quarter,
+            updated in place
+    Returns:
+        tuple: (new band, number of pixels whose trailing gap was filled again)
+    """
+    n_time = stack.shape[0]
+    observed = ~np.isnan(new)
+    seen = last_index >= 0
+    # only the gap between the last observation and the new quarter changes
+    gap = observed & (last_index < n_time - 1)
+    for t in range(int(last_index[gap].min(initial=n_time - 1)) + 1, n_time):
+        closes = gap & (last_index < t)
+        if not closes.any():
+            continue
+        prev = last_index[closes]
+        slope = (new[closes] - last_value[closes]) / (n_time - prev)
+        # same form as _fill_gaps_kernel, leading gaps take the first observation
+        stack[t][closes] = np.where(
+            seen[closes], slope * (t - prev) + last_value[closes], new[closes]
+        )
+
+    band = np.where(observed, new, last_value)
+    last_index[observed] = n_time
+    last_value[observed] = new[observed]
+    return band, int(gap.sum())
+
+
+def append_quarter(
+    stack_path,
+    new_file,
+    files=None,
+    outfile=None,
+    missing_value=np.nan,
+    block_size=512,
+    codec=STACK_CODEC,
+):
+    """Append one quarter to an interpolated stack
+
+    Only the trailing gaps closed by the new quarter are interpolated, so the
+    work per refresh does not grow with the length of the archive. Untouched
+    bands are copied as is since a GeoTIFF cannot gain a band in place.
+
+    Args:
+        stack_path (str): {band}_S2_SR_interp_linear_{grid}.tif to extend
+        new_file (str): tif of the new quarter
+        files (list): quarterly tifs already in the stack, only needed to build
+            the last observation sidecar when it does not exist yet
+        outfile (str): output path, defaults to replacing stack_path
+        missing_value (float): value treated as missing besides nan
+        block_size (int): rows and columns read at once
+        codec (str): stack codec, None keeps the options of the existing stack
+    Returns:
+        dict: pixels and pixels_refilled
+    """
+    import rasterio
+    from rasterio.windows import Window
+
+    last_path = last_observation_path(stack_path)
+    if not os.path.exists(last_path):
+        if not files:
+            raise ValueError(f"Pass the stack files to build {last_path}")
+        build_last_observation(files, last_path, missing_value, block_size)
+
+    outfile = outfile or stack_path
+    tmp_file = outfile + ".append.tif"
+    tmp_last = last_path + ".append.tif"
+    refilled = 0
+    with rasterio.open(stack_path) as stack, rasterio.open(
+        new_file
+    ) as new_src, rasterio.open(last_path) as last_src:
+        if (new_src.height, new_src.width) != (stack.height, stack.width):
+            raise ValueError(f"{new_file} is not on the grid of {stack_path}")
+        profile = stack.profile.copy()
+        profile.update(count=stack.count + 1)
+        profile.update(stack_options({"codec": codec}, profile["dtype"]))
+        # refilled trailing gaps change earlier bands too, so describe them all
+        stats = StatsAccumulator(stack.count + 1)
+        # earlier quarters keep their valid pixels before filling, the new one
+        # is counted as it is read
+        old_stats = read_stats(stack_path) or {}
+        observed = [
+            old_stats.get(str(band + 1), {}).get("observed")
+            for band in range(stack.count)
+        ]
+        if None not in observed:
+            stats.observed = np.array(observed + [0], dtype="int64")
+        with rasterio.open(tmp_file, "w", **profile) as dst, rasterio.open(
+            tmp_last, "w", **last_src.profile
+        ) as last_dst:
+            for row_off in range(0, stack.height, block_size):
+                for col_off in range(0, stack.width, block_size):
+                    window = Window(
+                        col_off,
+                        row_off,
+                        min(block_size, stack.width - col_off),
+                        min(block_size, stack.height - row_off),
+                    )
+                    bands = stack.read(window=window).astype("float64")
+                    new = new_src.read(1, window=window).astype("float64")
+                    new[_missing(new, missing_value)] = np.nan
+                    if stats.observed is not None:
+                        stats.observe(new[None], bands=[stack.count])
+                    last_index, last_value = last_src.read(window=window)
+                    band, n = append_window(bands, new, last_index, last_value)
+                    refilled += n
+                    out = np.concatenate([bands, band[None]])
+                    stats.update(out)
+                    dst.write(out, window=window)
+                    last_dst.write(np.stack([last_index, last_value]), window=window)
+            dst.descriptions = stack.descriptions + (os.path.basename(new_file),)
+            labels = quarter_labels(dst.descriptions)
+
+    os.replace(tmp_file, outfile)
+    stats.write(outfile, labels)
+    os.replace(tmp_last, last_observation_path(outfile))
+    pixels = stack.height * stack.width
+    print(
+        f"appended {os.path.basename(new_file)} to {os.path.basename(outfile)}: "
+        f"{refilled / pixels:.2%} of pixels refilled"
+    )
+    return {"pixels": pixels, "pixels_refilled": refilled}
+
+
+def run_append_task(task):
+    """Append the quarters of a task that are missing from its existing stack
+    Args:
+        task (dict): task from build_interpolation_tasks with mode "append"
+    Returns:
+        dict: same keys as run_interpolation_task plus pixels_refilled
+    """
+    import rasterio
+
+    if task["interp_type"] != "linear":
+        raise ValueError(
+            f"append_quarter fills linearly, rebuild {task['outfile']} instead"
+        )
+    start = time.perf_counter()
+    with rasterio.open(task["outfile"]) as src:
+        n_done = src.count
+    refilled = 0
+    for i in range(n_done, len(task["files"])):
+        result = append_quarter(
+            task["outfile"],
+            task["files"][i],
+            files=task["files"][:i],
+            missing_value=task["missing_value"],
+            block_size=task["window_size"][0],
+            codec=task.get("codec", STACK_CODEC),
+        )
+        refilled += result["pixels_refilled"]
+    seconds = time.perf_counter() - start
+    rows, cols, _ = raster_shape(task["files"][0])
+    pixels = rows * cols * (len(task["files"]) - n_done)
+    return {
+        "band": task["band"],
+        "grid": task["grid"],
+        "outfile": task["outfile"],
+        "seconds": round(seconds, 2),
+        "pixels": pixels,
+        "pixels_per_second": round(pixels / max(seconds, 1e-9)),
+        "pixels_refilled": refilled,
+    }
+
+
+def group_by_grid(tasks):
+    """Merge the full rebuild tasks of each grid into one multiband task
+
+    All bands of a grid share the cloud mask of each quarter, so they are read
+    together one window at a time, see run_multiband_task. The windows are read
+    with rasterio and gap filled as numpy batches, so the merged tasks use the
+    numpy transfer library. Append tasks are returned unchanged.
+
+    Args:
+        tasks (list): tasks from build_interpolation_tasks
+    Returns:
+        list: multiband tasks followed by the remaining tasks
+    """
+    grids = {}
+    others = []
+    for task in tasks:
+        if task.get("mode", "full") == "full":
+            grids.setdefault(task["grid"], []).append(task)
+        else:
+            others.append(task)
+
+    merged = []
+    for grid, group in grids.items():
+        counts = {len(task["files"]) for task in group}
+        if len(counts) > 1:
+            raise ValueError(f"Bands of {grid} have different numbers of quarters")
+        task = dict(group[0])
+        task.update(
+            {
+                "band": "+".join(t["band"] for t in group),
+                "bands": [t["band"] for t in group],
+                "files": {t["band"]: t["files"] for t in group},
+                "outfile": {t["band"]: t["outfile"] for t in group},
+                "mode": "multiband",
+                "transfer_lib": "numpy",
+            }
+        )
+        merged.append(task)
+    return merged + others
+
+
+def _windows(height, width, window_size):
+    from rasterio.windows import Window
+
+    rows, cols = window_size
+    return [
+        Window(col, row, min(cols, width - col), min(rows, height - row))
+        for row in range(0, height, rows)
+        for col in range(0, width, cols)
+    ]
+
+
+def check_same_grid(files):
+    """Raise a ValueError unless all files share shape, transform and crs"""
+    import rasterio
+
+    grid = None
+    for path in files:
+        with rasterio.open(path) as src:
+            src_grid = (src.height, src.width, src.transform, src.crs)
+        if grid is None:
+            grid = src_grid
+        elif src_grid != grid:
+            raise ValueError(f"{path} is not on the grid of {files[0]}")
+
+
+def run_multiband_task(task):
+    """Interpolate every band of a grid in one pass over the windows
+
+    Each window is read across all bands and quarters, the pixels with a gap in
+    any band are found once and gap filled together as one batch, and each band
+    is written to its own stack. Pixels without gaps are copied as is.
+
+    Args:
+        task (dict): task from group_by_grid
+    Returns:
+        dict: same keys as run_interpolation_task with band "B2+B3+..."
+    """
+    import rasterio
+
+    start = time.perf_counter()
+    bands = task["bands"]
+    n_time = len(task["files"][bands[0]])
+    module = interpolation_module(dict(task, skip_complete=False), count=n_time)
+    # the bands are reshaped into one (bands, time, pixels) block per window
+    check_same_grid([f for band in bands for f in task["files"][band]])
+    sources = {band: [rasterio.open(f) for f in task["files"][band]] for band in bands}
+    first = sources[bands[0]][0]
+    height, width = first.height, first.width
+    profile = first.profile.copy()
+    profile.update(
+        driver="GTiff",
+        count=n_time,
+        dtype=getattr(module, "dtype", "float64"),
+        nodata=None,
+    )
+    profile.update(stack_options(task, profile["dtype"]))
+    stats = dict.fromkeys(["windows", "windows_skipped", "pixels", "pixels_filled"], 0)
+    band_stats = {band: StatsAccumulator(n_time) for band in bands}
+    outputs = {}
+    try:
+        for band in bands:
+            outputs[band] = rasterio.open(task["outfile"][band], "w", **profile)
+        for window in _windows(height, width, task["window_size"]):
+            # (band, time, rows, cols)
+            data = np.stack(
+                [
+                    np.stack([src.read(1, window=window) for src in sources[band]])
+                    for band in bands
+                ]
+            ).astype("float64")
+            pixels = data.reshape(len(bands), n_time, -1)
+            # before the gaps are filled in place
+            for i, band in enumerate(bands):
+                band_stats[band].observe(data[i], missing_value=task["missing_value"])
+            # gaps come from the shared cloud mask so one index serves all bands
+            gaps = _missing(pixels, task["missing_value"]).any(axis=(0, 1))
+            n_gaps = int(gaps.sum())
+            stats["windows"] += 1
+            stats["windows_skipped"] += n_gaps == 0
+            stats["pixels"] += pixels.shape[2]
+            stats["pixels_filled"] += n_gaps
+            if n_gaps:
+                # (time, 1, 1, bands x gap pixels)
+                batch = pixels[:, :, gaps].transpose(1, 0, 2)
+                filled = module.calculate(
+                    batch.reshape(n_time, 1, 1, len(bands) * n_gaps)
+                )
+                filled = np.asarray(filled, dtype="float64").reshape(
+                    n_time, len(bands), n_gaps
+                )
+                pixels[:, :, gaps] = filled.transpose(1, 0, 2)
+            for i, band in enumerate(bands):
+                out = data[i].astype(profile["dtype"])
+                band_stats[band].update(out)
+                outputs[band].write(out, window=window)
+    finally:
+        for dst in outputs.values():
+            dst.close()
+        for band_sources in sources.values():
+            for src in band_sources:
+                src.close()
+
+    for band in bands:
+        labels = quarter_labels(task["files"][band])
+        band_stats[band].write(task["outfile"][band], labels)
+
+    seconds = time.perf_counter() - start
+    n_pixels = height * width * n_time * len(bands)
+    skipped = {
+        "windows_skipped_fraction": round(
+            stats["windows_skipped"] / max(stats["windows"], 1), 4
+        ),
+        "pixels_skipped_fraction": round(
+            1 - stats["pixels_filled"] / max(stats["pixels"], 1), 4
+        ),
+    }
+    print(f"{task['band']} {task['grid']} skipped: {skipped}")
+    return {
+        "band": task["band"],
+        "grid": task["grid"],
+        "outfile": ";".join(task["outfile"].values()),
+        "seconds": round(seconds, 2),
+        "pixels": n_pixels,
+        "pixels_per_second": round(n_pixels / seconds),
+        **skipped,
+    }
+
+
+def run_tasks(
+    tasks,
+    max_workers=None,
+    mem_budget=None,
+    task_function=run_interpolation_task,
+    memory_function=estimate_task_memory,
+    log_file=None,
+):
+    """Run tasks in a process pool keeping the summed memory estimate under budget
+
+    Larger tasks are started first. A task that does not fit is held back until
+    running tasks finish, unless nothing is running.
+
+    Args:
+        tasks (list): task dicts
+        max_workers (int): maximum concurrent tasks, defaults to the cpu count
+        mem_budget (str|int): e.g. "32GB", defaults to the available memory
+        task_function (callable): runs one task and returns a dict of timings
+        memory_function (callable): estimates the bytes one task needs
+        log_file (str): optional csv of the per task timings
+    Returns:
+        list: one result dict per task
+    """
+    max_workers = max_workers or os.cpu_count()
+    budget = parse_memory(mem_budget) if mem_budget else available_memory()
+    pending = sorted(
+        [(memory_function(task), task) for task in tasks],
+        key=lambda x: x[0],
+        reverse=True,
+    )
+    print(
+        f"Running {len(pending)} tasks on {max_workers} workers "
+        f"with a {format_memory(budget)} memory budget"
+    )
+
+    results = []
+    running = {}
+    used = 0
+    start = time.perf_counter()
+    # spawn so jax is not forked with live threads
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers, mp_context=context) as executor:
+        while pending or running:
+            for memory, task in list(pending):
+                if len(running) >= max_workers:
+                    break
+                if used + memory > budget and running:
+                    continue
+                if memory > budget:
+                    print(
+                        f"Warning: {task.get('band')} {task.get('grid')} needs "
+                        f"{format_memory(memory)}, more than the budget"
+                    )
+                future = executor.submit(task_function, task)
+                running[future] = memory
+                used += memory
+                pending.remove((memory, task))
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                used -= running.pop(future)
+                result = future.result()
+                results.append(result)
+                print(
+                    f"finished {result.get('band')} {result.get('grid')} in "
+                    f"{result['seconds']}s ({result['pixels_per_second']:,} pixels/s)"
+                )
+
+    seconds = time.perf_counter() - start
+    total_pixels = sum(r["pixels"] for r in results)
+    print(
+        f"All {len(results)} tasks in {seconds:.1f}s, "
+        f"{total_pixels / seconds:,.0f} pixels/s overall"
+    )
+    if log_file and results:
+        with open(log_file, "w", newline="") as f:
+            # append and full tasks report different columns
+            fieldnames = list(dict.fromkeys(k for r in results for k in r))
+            writer = csv.DictWriter(f, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(results)
+    return results
+
+
+def _file_hash(path):
+    import hashlib
+
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def check_serial_outputs(tasks, serial_dir):
+    """Compare the stacks run_tasks wrote with a serial run of the same tasks
+
+    Each task is run again in this process, one after the other like the
+    original band x grid loop, into serial_dir, and every stack is compared
+    byte for byte with the pooled output.
+
+    Args:
+        tasks (list): tasks already run with run_tasks
+        serial_dir (str): folder for the serial outputs
+    Returns:
+        dict: pooled stack path -> True if identical to the serial stack
+    """
+    os.makedirs(serial_dir, exist_ok=True)
+    matches = {}
+    for task in tasks:
+        if task.get("mode") == "append":
+            raise ValueError(
+                f"{task['outfile']} was appended in place, check with append=False"
+            )
+        outfiles = task["outfile"]
+        if not isinstance(outfiles, dict):
+            outfiles = {task["band"]: outfiles}
+        serial = {
+            band: os.path.join(serial_dir, os.path.basename(path))
+            for band, path in outfiles.items()
+        }
+        if isinstance(task["outfile"], dict):
+            run_interpolation_task(dict(task, outfile=serial))
+        else:
+            run_interpolation_task(dict(task, outfile=serial[task["band"]]))
+        for band, path in outfiles.items():
+            matches[path] = _file_hash(path) == _file_hash(serial[band])
+
+    differ = [path for path, same in matches.items() if not same]
+    print(
+        f"{len(matches) - len(differ)} of {len(matches)} stacks identical to the "
+        "serial run"
+    )
+    for path in differ:
+        print("differs:", path)
+    return matches
+
+
+def synthetic_window(n_times, size=512, missing_fraction=0.3, seed=0):
+    """Random (time, 1, size, size) window with nan gaps
+    Args:
+        n_times (int): time steps
+        size (int): rows and columns
+        missing_fraction (float): share of missing values
+        seed (int): random seed
+    Returns:
+        numpy.ndarray
+    """
+    rng = np.random.default_rng(seed)
+    array = rng.random((n_times, 1, size, size))
+    array[rng.random(array.shape) < missing_fraction] = np.nan
+    return array
+
+
+def benchmark_kernels(times=(8, 16, 32), size=512, missing_fraction=0.3, repeats=3):
+    """Time fill_gaps against the xr_fresh numpy and jax paths on one window
+
+    The first call includes numba compilation or jax start up, the steady state
+    is the best of the following repeats.
+
+    Args:
+        times (list): series lengths to test
+        size (int): window rows and columns
+        missing_fraction (float): share of missing values
+        repeats (int): steady state calls per kernel
+    Returns:
+        list: one dict per (kernel, series length)
+    """
+    kernels = {"numba": lambda a, n: fill_gaps(count=n).calculate(a)}
+    try:
+        from xr_fresh.interpolate_series import interpolate_nan
+
+        kernels["numpy"] = lambda a, n: interpolate_nan(
+            interp_type="linear", missing_value=np.nan, count=n
+        ).calculate(a)
+        try:
+            import jax.numpy as jnp
+
+            kernels["jax"] = lambda a, n: np.asarray(
+                interpolate_nan(
+                    interp_type="linear", missing_value=np.nan, count=n
+                ).calculate(jnp.asarray(a))
+            )
+        except ImportError:
+            print("jax not installed, skipping the jax path")
+    except ImportError:
+        print("xr_fresh not installed, only timing the numba kernel")
+
+    results = []
+    for n_times in times:
+        array = synthetic_window(n_times, size, missing_fraction)
+        pixels = size * size
+        for name, kernel in kernels.items():
+            start = time.perf_counter()
+            kernel(array.copy(), n_times)
+            first = time.perf_counter() - start
+            steady = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                kernel(array.copy(), n_times)
+                steady.append(time.perf_counter() - start)
+            best = min(steady)
+            results.append(
+                {
+                    "kernel": name,
+                    "times": n_times,
+                    "first_call_s": round(first, 4),
+                    "steady_s": round(best, 4),
+                    "pixels_per_second": round(pixels / best),
+                }
+            )
+            print(results[-1])
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="gap filling kernel benchmark")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    bench = subparsers.add_parser("benchmark", help="compare numba, numpy and jax")
+    bench.add_argument("--times", type=int, nargs="+", default=[8, 16, 32])
+    bench.add_argument("--size", type=int, default=512)
+    bench.add_argument("--missing_fraction", type=float, default=0.3)
+    bench.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    benchmark_kernels(args.times, args.size, args.missing_fraction, args.repeats)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+# Description: Bit-packed no data mask store (1 bit per pixel per quarter) with a
+# per block summary index, so later stages can skip blocks without reading pixels
+# author: Michael Mann mmann1123@gwu.edu
+
+# built from the NoDataMask_{year}_Q{qq}_{site}.tif exports (1 = missing) or from
+# nan values in a time stack where each band is a quarter
+
+# store layout (a folder):
+# ├── meta.json   quarters, shape, block size, transform and crs
+# ├── bits.npy    uint8 (quarters, rows, ceil(cols / 8)) packed along x, 1 = missing
+# └── index.npy   uint8 (quarters, block rows, block cols) VALID, MISSING or MIXED
+
+# to run from terminal:
+# python mask_store.py ./mask_store/north --masks ../cloud_mask/NoDataMask_*_north.tif
+# python mask_store.py ./mask_store/north_B2 --stack interpolated/B2_S2_SR_interp_linear_north.tif
+
+import argparse
+import json
+import os
+import re
+from glob import glob
+
+VALID = 0
+MISSING = 1
+MIXED = 2
+STATUS_NAMES = {VALID: "valid", MISSING: "missing", MIXED: "mixed"}
+
+
+def block_status(missing):
+    """Summarize a block of the missing mask
+    Args:
+        missing (numpy.ndarray): boolean array, True = missing
+    Returns:
+        int: VALID, MISSING or MIXED
+    """
+    n_missing = missing.sum()
+    if n_missing == 0:
+        return VALID
+    if n_missing == missing.size:
+        return MISSING
+    return MIXED
+
+
+def _iter_missing_strips(layers, block_size):
+    """Yield (quarter, row_off, missing) strips for each layer
+
+    layers is a list of (path, band, from_nan) tuples, one per quarter.
+    """
+    import numpy as np
+    import rasterio
+    from rasterio.windows import Window
+
+    for quarter, (path, band, from_nan) in enumerate(layers):
+        with rasterio.open(path) as src:
+            for row_off in range(0, src.height, block_size):
+                window = Window(0, row_off, src.width, min(block_size, src.height - row_off))
+                data = src.read(band, window=window)
+                if from_nan:
+                    missing = np.isnan(data)
+                    if src.nodata is not None and not np.isnan(src.nodata):
+                        missing |= data == src.nodata
+                else:
+                    missing = data == 1
+                yield quarter, row_off, missing
+
+
+def build_mask_store(store_path, layers, quarters, block_size=512):
+    """Pack missing masks into a store and index each block
+
+    Args:
+        store_path (str): output folder
+        layers (list): (path, band, from_nan) per quarter, from_nan True to treat nan
+            or nodata as missing, False for NoDataMask files where 1 is missing
+        quarters (list): quarter names, e.g. "2021_Q01", in the order of layers
+        block_size (int): block rows and columns of the index
+    Returns:
+        MaskStore
+    """
+    import numpy as np
+    import rasterio
+
+    if len(layers) != len(quarters):
+        raise ValueError("Need one layer per quarter")
+
+    with rasterio.open(layers[0][0]) as src:
+        height, width = src.height, src.width
+        transform, crs = src.transform, src.crs
+    for path, _, _ in layers[1:]:
+        with rasterio.open(path) as src:
+            if (src.height, src.width, src.transform) != (height, width, transform):
+                raise ValueError(f"Mask is not on the same grid: {path}")
+
+    os.makedirs(store_path, exist_ok=True)
+    n_block_rows = -(-height // block_size)
+    n_block_cols = -(-width // block_size)
+    bits = np.lib.format.open_memmap(
+        os.path.join(store_path, "bits.npy"),
+        mode="w+",
+        dtype="uint8",
+        shape=(len(quarters), height, -(-width // 8)),
+    )
+    index = np.zeros((len(quarters), n_block_rows, n_block_cols), dtype="uint8")
+
+    for quarter, row_off, missing in _iter_missing_strips(layers, block_size):
+        bits[quarter, row_off : row_off + missing.shape[0]] = np.packbits(missing, axis=-1)
+        for block_col in range(n_block_cols):
+            block = missing[:, block_col * block_size : (block_col + 1) * block_size]
+            index[quarter, row_off // block_size, block_col] = block_status(block)
+    bits.flush()
+    del bits
+
+    np.save(os.path.join(store_path, "index.npy"), index)
+    with open(os.path.join(store_path, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "quarters": list(quarters),
+                "height": height,
+                "width": width,
+                "block_size": block_size,
+                "transform": list(transform)[:6],
+                "crs": crs.to_wkt() if crs else None,
+            },
+            f,
+            indent=2,
+        )
+
+    store = MaskStore(store_path)
+    print(f"Mask store {store_path}: {store.summary()}")
+    return store
+
+
+def build_from_masks(store_path, mask_files, block_size=512):
+    """Build a store from NoDataMask_{year}_Q{qq}_{site}.tif exports
+    Args:
+        store_path (str): output folder
+        mask_files (list): NoDataMask files of one site
+        block_size (int): block rows and columns of the index
+    Returns:
+        MaskStore
+    """
+    mask_files = sorted(mask_files)
+    quarters = [re.search(r"\d{4}_Q\d{2}", f).group() for f in mask_files]
+    layers = [(f, 1, False) for f in mask_files]
+    return build_mask_store(store_path, layers, quarters, block_size)
+
+
+def build_from_stack(store_path, stack_file, quarters=None, block_size=512):
+    """Build a store from nan values in a time stack, one band per quarter
+    Args:
+        store_path (str): output folder
+        stack_file (str): multi band time stack
+        quarters (list): quarter name per band, defaults to the band descriptions or
+            band numbers
+        block_size (int): block rows and columns of the index
+    Returns:
+        MaskStore
+    """
+    import rasterio
+
+    with rasterio.open(stack_file) as src:
+        count = src.count
+        descriptions = src.descriptions
+    if quarters is None:
+        quarters = [d or str(i + 1) for i, d in enumerate(descriptions)]
+    layers = [(stack_file, band, True) for band in range(1, count + 1)]
+    return build_mask_store(store_path, layers, quarters, block_size)
+
+
+class MaskStore:
+    """Read access to a mask store built by build_mask_store.
+
+    Args:
+        store_path (str): store folder
+    """
+
+    def __init__(self, store_path):
+        import numpy as np
+
+        with open(os.path.join(store_path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.quarters = self.meta["quarters"]
+        self.block_size = self.meta["block_size"]
+        self.shape = (self.meta["height"], self.meta["width"])
+        self.index = np.load(os.path.join(store_path, "index.npy"))
+        self.bits = np.load(os.path.join(store_path, "bits.npy"), mmap_mode="r")
+
+    def _quarter_ids(self, quarters):
+        if quarters is None:
+            return list(range(len(self.quarters)))
+        return [self.quarters.index(q) if isinstance(q, str) else q for q in quarters]
+
+    def window_status(self, row_off, col_off, height, width, quarters=None):
+        """Summarize a pixel window from the block index only
+        Args:
+            row_off (int): first row
+            col_off (int): first column
+            height (int): rows
+            width (int): columns
+            quarters (list): quarter names or positions, defaults to all
+        Returns:
+            int: VALID if every pixel is valid in every quarter, MISSING if every
+                pixel is missing in every quarter, else MIXED
+        """
+        size = self.block_size
+        blocks = self.index[
+            self._quarter_ids(quarters),
+            row_off // size : -(-(row_off + height) // size),
+            col_off // size : -(-(col_off + width) // size),
+        ]
+        if (blocks == VALID).all():
+            return VALID
+        if (blocks == MISSING).all():
+            return MISSING
+        return MIXED
+
+    def read(self, row_off, col_off, height, width, quarters=None):
+        """Unpack the missing mask for a window
+        Args:
+            row_off (int): first row
+            col_off (int): first column
+            height (int): rows
+            width (int): columns
+            quarters (list): quarter names or positions, defaults to all
+        Returns:
+            numpy.ndarray: boolean (quarters, height, width), True = missing
+        """
+        import numpy as np
+
+        first_byte = col_off // 8
+        last_byte = -(-(col_off + width) // 8)
+        packed = self.bits[
+            self._quarter_ids(quarters),
+            row_off : row_off + height,
+            first_byte:last_byte,
+        ]
+        missing = np.unpackbits(packed, axis=-1).astype(bool)
+        start = col_off - first_byte * 8
+        return missing[..., start : start + width]
+
+    def valid_counts(self, quarters=None, bands=None, rows_per_read=1024):
+        """Valid (not missing) pixels per quarter, e.g. cloud free weights of a
+        mosaic tile, see mosaic.TileIndex
+        Args:
+            quarters (list): quarter names or positions, defaults to all
+            bands (list): 1 based band number per quarter used as keys,
+                defaults to the quarter position + 1
+            rows_per_read (int): packed rows unpacked at once
+        Returns:
+            dict: band -> valid pixels
+        """
+        import numpy as np
+
+        ids = self._quarter_ids(quarters)
+        bands = bands or [i + 1 for i in ids]
+        counts = {}
+        for band, q in zip(bands, ids):
+            # packing pads rows with 0 (valid) bits, so count the missing ones
+            missing = 0
+            for row_off in range(0, self.shape[0], rows_per_read):
+                packed = self.bits[q, row_off : row_off + rows_per_read]
+                missing += int(np.unpackbits(packed).sum())
+            counts[band] = self.shape[0] * self.shape[1] - missing
+        return counts
+
+    def summary(self):
+        """Share of blocks per status across all quarters
+        Returns:
+            dict: status name -> fraction of blocks
+        """
+        return {
+            name: round(float((self.index == status).mean()), 4)
+            for status, name in STATUS_NAMES.items()
+        }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="build a bit packed no data mask store")
+    parser.add_argument("store_path", type=str, help="output folder")
+    parser.add_argument("--masks", type=str, nargs="+", help="NoDataMask tifs of one site")
+    parser.add_argument("--stack", type=str, help="time stack, nan = missing")
+    parser.add_argument("--block_size", type=int, default=512)
+    args = parser.parse_args()
+
+    if args.masks:
+        masks = [f for pattern in args.masks for f in glob(pattern)]
+        build_from_masks(args.store_path, masks, args.block_size)
+    elif args.stack:
+        build_from_stack(args.store_path, args.stack, block_size=args.block_size)
+    else:
+        raise ValueError("Pass --masks or --stack")
+
+
+if __name__ == "__main__":
+    main()
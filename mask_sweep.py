@@ -0,0 +1,223 @@
+# Description: Sweep cloud mask parameters over cached scenes in a single pass
+# instead of tuning CLD_PRB_THRESH, NIR_DRK_THRESH, CLD_PRJ_DIST and BUFFER one
+# gee export at a time
+# author: Michael Mann mmann1123@gwu.edu
+
+# 1) cache each test scene once as .npz (probability, B8, SCL, solar azimuth)
+# python mask_sweep.py cache scene1.npz --b8 B8.tif --scl SCL.tif --probability prob.tif --azimuth 123.4
+# 2) sweep all combinations, writes one row per combination
+# python mask_sweep.py sweep scene1.npz scene2.npz --cld_prb 20 30 40 60 --nir_drk 0.1 0.15 0.2 --prj_dist 1 2 --buffer 40 50 100 --out sweep.csv
+
+# intermediate layers are shared between combinations: the cloud threshold is
+# computed once per CLD_PRB_THRESH, dark pixels once per NIR_DRK_THRESH, the
+# shadow projection once per (CLD_PRB_THRESH, CLD_PRJ_DIST) and the erosion once
+# per (CLD_PRB_THRESH, NIR_DRK_THRESH, CLD_PRJ_DIST), leaving only the dilation
+# for each BUFFER
+
+import argparse
+import csv
+import itertools
+import time
+
+from cloud_mask import (
+    buffer_mask,
+    dark_pixels,
+    erode_mask,
+    project_shadows,
+    threshold_clouds,
+)
+
+# SCL cloud shadow, cloud medium, cloud high, thin cirrus
+SCL_CLOUD_CLASSES = [3, 8, 9, 10]
+
+
+def cache_scene(outfile, b8_path, scl_path, probability_path, solar_azimuth):
+    """Save the arrays needed by the sweep for one scene
+    Args:
+        outfile (str): output .npz
+        b8_path (str): B8 surface reflectance GeoTIFF, defines the 10 m grid
+        scl_path (str): scene classification layer GeoTIFF
+        probability_path (str): s2cloudless probability GeoTIFF
+        solar_azimuth (float): MEAN_SOLAR_AZIMUTH_ANGLE in degrees
+    Returns:
+        str: outfile
+    """
+    import numpy as np
+    import rasterio
+    from rasterio.enums import Resampling
+
+    with rasterio.open(b8_path) as src:
+        b8 = src.read(1)
+    arrays = {"b8": b8, "solar_azimuth": np.float64(solar_azimuth)}
+    for name, path in [("scl", scl_path), ("probability", probability_path)]:
+        with rasterio.open(path) as src:
+            arrays[name] = src.read(1, out_shape=b8.shape, resampling=Resampling.nearest)
+    np.savez_compressed(outfile, **arrays)
+    return outfile
+
+
+def load_scene(path):
+    """Load a scene saved by cache_scene
+    Args:
+        path (str): .npz file
+    Returns:
+        dict: probability, b8, scl and solar_azimuth
+    """
+    import numpy as np
+
+    with np.load(path) as data:
+        return {
+            "probability": data["probability"],
+            "b8": data["b8"],
+            "scl": data["scl"],
+            "solar_azimuth": float(data["solar_azimuth"]),
+        }
+
+
+def _sweep_scene(scene, cld_prb, nir_drk, prj_dist, buffer, SCALE, residual_prob):
+    import numpy as np
+
+    probability = scene["probability"]
+    scl_cloud = np.isin(scene["scl"], SCL_CLOUD_CLASSES)
+    residual_cloud = probability > residual_prob
+    shape = probability.shape
+
+    darks = {nir: dark_pixels(scene["b8"], scene["scl"], nir) for nir in nir_drk}
+    counts = {}
+    for cld in cld_prb:
+        clouds = threshold_clouds(probability, cld)
+        for dist in prj_dist:
+            cld_proj = project_shadows(clouds, scene["solar_azimuth"], dist, SCALE)
+            for nir in nir_drk:
+                shadows = cld_proj & darks[nir]
+                eroded = erode_mask(clouds | shadows, SCALE)
+                for buf in buffer:
+                    clear = ~buffer_mask(eroded, shape, buf, SCALE)
+                    counts[(cld, nir, dist, buf)] = {
+                        "pixels": probability.size,
+                        "clouds": int(clouds.sum()),
+                        "shadows": int(shadows.sum()),
+                        "clear": int(clear.sum()),
+                        "residual_prob": int((clear & residual_cloud).sum()),
+                        "residual_scl": int((clear & scl_cloud).sum()),
+                    }
+    return counts
+
+
+def sweep(
+    scenes,
+    cld_prb=(30,),
+    nir_drk=(0.2,),
+    prj_dist=(2,),
+    buffer=(40,),
+    SCALE=10,
+    residual_prob=50,
+):
+    """Evaluate every parameter combination on every scene
+
+    Args:
+        scenes (list): .npz paths from cache_scene or dicts from load_scene
+        cld_prb (list): CLD_PRB_THRESH values
+        nir_drk (list): NIR_DRK_THRESH values
+        prj_dist (list): CLD_PRJ_DIST values in km
+        buffer (list): BUFFER values
+        SCALE (int): image scale in meters
+        residual_prob (float): probability above which an unmasked pixel counts as
+            residual cloud
+    Returns:
+        list: one dict per combination with the parameters and
+            masked_fraction: share of pixels masked
+            cloud_fraction: share of pixels above CLD_PRB_THRESH
+            shadow_fraction: share of pixels flagged as shadow
+            residual_prob_fraction: share of unmasked pixels with probability > residual_prob
+            residual_scl_fraction: share of unmasked pixels SCL calls cloud or shadow
+    """
+    totals = {}
+    for scene in scenes:
+        if isinstance(scene, str):
+            print("loading", scene)
+            scene = load_scene(scene)
+        start = time.perf_counter()
+        counts = _sweep_scene(
+            scene, cld_prb, nir_drk, prj_dist, buffer, SCALE, residual_prob
+        )
+        print(f"{len(counts)} combinations in {time.perf_counter() - start:.1f}s")
+        for key, count in counts.items():
+            total = totals.setdefault(key, dict.fromkeys(count, 0))
+            for name, value in count.items():
+                total[name] += value
+
+    results = []
+    for (cld, nir, dist, buf), total in sorted(totals.items()):
+        clear = max(total["clear"], 1)
+        results.append(
+            {
+                "CLD_PRB_THRESH": cld,
+                "NIR_DRK_THRESH": nir,
+                "CLD_PRJ_DIST": dist,
+                "BUFFER": buf,
+                "masked_fraction": 1 - total["clear"] / total["pixels"],
+                "cloud_fraction": total["clouds"] / total["pixels"],
+                "shadow_fraction": total["shadows"] / total["pixels"],
+                "residual_prob_fraction": total["residual_prob"] / clear,
+                "residual_scl_fraction": total["residual_scl"] / clear,
+            }
+        )
+    return results
+
+
+def write_results(results, outfile):
+    """Write sweep results to csv
+    Args:
+        results (list): output of sweep
+        outfile (str): csv path
+    """
+    with open(outfile, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(results[0].keys()))
+        writer.writeheader()
+        writer.writerows(results)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="sweep cloud mask parameters")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    cache = subparsers.add_parser("cache", help="cache the arrays of one scene")
+    cache.add_argument("outfile", type=str, help="output .npz")
+    cache.add_argument("--b8", type=str, required=True)
+    cache.add_argument("--scl", type=str, required=True)
+    cache.add_argument("--probability", type=str, required=True)
+    cache.add_argument("--azimuth", type=float, required=True)
+
+    run = subparsers.add_parser("sweep", help="sweep parameters over cached scenes")
+    run.add_argument("scenes", type=str, nargs="+", help="cached .npz scenes")
+    run.add_argument("--cld_prb", type=float, nargs="+", default=[30])
+    run.add_argument("--nir_drk", type=float, nargs="+", default=[0.2])
+    run.add_argument("--prj_dist", type=float, nargs="+", default=[2])
+    run.add_argument("--buffer", type=float, nargs="+", default=[40])
+    run.add_argument("--residual_prob", type=float, default=50)
+    run.add_argument("--out", type=str, default="mask_sweep.csv")
+    args = parser.parse_args()
+
+    if args.command == "cache":
+        cache_scene(args.outfile, args.b8, args.scl, args.probability, args.azimuth)
+        return
+
+    n_combinations = len(
+        list(itertools.product(args.cld_prb, args.nir_drk, args.prj_dist, args.buffer))
+    )
+    print(f"Sweeping {n_combinations} combinations over {len(args.scenes)} scenes")
+    results = sweep(
+        args.scenes,
+        cld_prb=args.cld_prb,
+        nir_drk=args.nir_drk,
+        prj_dist=args.prj_dist,
+        buffer=args.buffer,
+        residual_prob=args.residual_prob,
+    )
+    write_results(results, args.out)
+    print("results written to", args.out)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,721 @@
+# Description: Windowed mosaic of any number of tiles per band, replaces the
+# hard coded two tile (a/b) gw.open nesting and da.maximum of the mosaic scripts
+# author: Michael Mann mmann1123@gwu.edu
+
+# tiles are GEE exports of the same band on the same pixel grid, e.g.
+# B2_S2_SR_interp_linear_south-0000000000-0000000000.tif and
+# B2_S2_SR_interp_linear_south-0000000000-0000023296.tif. each output window is
+# read only from the tiles a spatial index says intersect it. the grid is cut
+# from the tile bounds into regions covered by one tile, copied straight from
+# that tile's single read, and the overlap strips between tiles, the only place
+# the overlap rule is computed
+
+# Example:
+# from mosaic import TileIndex, tile_grid, write_mosaic
+# grid = tile_grid(b2_tiles + b3_tiles)
+# layers = [(TileIndex(b2_tiles, grid), 5), (TileIndex(b3_tiles, grid), 5)]
+# write_mosaic(layers, "S2_SR_2021_Q01_south.tif", rule="max")
+
+import os
+import threading
+
+import numpy as np
+
+from cog import DEFAULT_CODEC, gtiff_profile, to_cog
+
+OVERLAP_RULES = ["max", "first", "mean", "weighted", "priority", "clearest"]
+# rules weighting tiles by their valid pixels before gap filling
+COUNT_RULES = ["weighted", "clearest"]
+
+
+def tile_grid(paths):
+    """Output grid covering the union of the tiles
+    Args:
+        paths (list): tile paths, all on the same pixel grid
+    Returns:
+        dict: left, top, res, width, height, crs and profile of the first tile
+    """
+    import rasterio
+
+    lefts, bottoms, rights, tops = [], [], [], []
+    for path in paths:
+        with rasterio.open(path) as src:
+            if not lefts:
+                res = src.res[0]
+                crs = src.crs
+                profile = src.profile.copy()
+            elif src.res[0] != res or src.crs != crs:
+                raise ValueError(f"Tile is not on the same grid: {path}")
+            lefts.append(src.bounds.left)
+            bottoms.append(src.bounds.bottom)
+            rights.append(src.bounds.right)
+            tops.append(src.bounds.top)
+    left, top = min(lefts), max(tops)
+    return {
+        "left": left,
+        "top": top,
+        "res": res,
+        "width": int(round((max(rights) - left) / res)),
+        "height": int(round((top - min(bottoms)) / res)),
+        "crs": crs,
+        "profile": profile,
+    }
+
+
+def tile_regions(offsets):
+    """Cut the output grid at the tile edges into regions with one set of tiles
+    Args:
+        offsets (list): (row, col, height, width) of each tile in output pixels
+    Returns:
+        list: (row0, col0, row1, col1, tiles) regions covered by at least one
+            tile, tiles in offsets order, more than one tile is an overlap
+    """
+    rows = sorted({r for row, _, h, _ in offsets for r in (row, row + h)})
+    cols = sorted({c for _, col, _, w in offsets for c in (col, col + w)})
+    regions = []
+    for row0, row1 in zip(rows, rows[1:]):
+        for col0, col1 in zip(cols, cols[1:]):
+            tiles = [
+                i
+                for i, (row, col, h, w) in enumerate(offsets)
+                if row <= row0 and row1 <= row + h and col <= col0 and col1 <= col + w
+            ]
+            if not tiles:
+                continue
+            # merge with the region to the left when the same tiles cover it
+            last = regions[-1] if regions else None
+            if last and last[0] == row0 and last[3] == col0 and last[4] == tiles:
+                regions[-1] = (row0, last[1], row1, col1, tiles)
+            else:
+                regions.append((row0, col0, row1, col1, tiles))
+    return regions
+
+
+class TileIndex:
+    """Spatial index of the tiles of one band on a shared output grid.
+
+    Args:
+        paths (list): tile paths
+        grid (dict): output grid from tile_grid, defaults to the union of paths
+        priority (list): one value per tile, higher tiles win under the
+            "priority" rule, defaults to the order of paths
+        valid_counts (list): per tile a dict of 1 based band -> valid (cloud
+            free) pixels for the "weighted" and "clearest" rules, e.g. from
+            mask_store.MaskStore.valid_counts, defaults to the pixels observed
+            before gap filling in the tiles' statistics sidecars
+    """
+
+    def __init__(self, paths, grid=None, priority=None, valid_counts=None):
+        import rasterio
+
+        self.paths = list(paths)
+        self.grid = grid or tile_grid(self.paths)
+        res = self.grid["res"]
+        self.offsets = []
+        for path in self.paths:
+            with rasterio.open(path) as src:
+                # tile position in output pixels
+                col = int(round((src.bounds.left - self.grid["left"]) / res))
+                row = int(round((self.grid["top"] - src.bounds.top) / res))
+                self.offsets.append((row, col, src.height, src.width, src.nodata))
+        if priority is None:
+            priority = [-i for i in range(len(self.paths))]
+        self.priority = list(priority)
+        self.valid_counts = valid_counts
+        self.regions = tile_regions([offset[:4] for offset in self.offsets])
+        self._build()
+
+    def _build(self):
+        from shapely import STRtree, box
+
+        self.tree = STRtree(
+            [box(col, row, col + w, row + h) for row, col, h, w, _ in self.offsets]
+        )
+        self.region_tree = STRtree(
+            [box(col0, row0, col1, row1) for row0, col0, row1, col1, _ in self.regions]
+        )
+        # rasterio datasets are not thread safe, each thread opens its own
+        self._local = threading.local()
+        self._opened = []
+        self._lock = threading.Lock()
+        self._weights = {}
+
+    def __getstate__(self):
+        # open datasets and the trees are rebuilt after pickling, e.g. on dask workers
+        state = self.__dict__.copy()
+        for key in ["tree", "region_tree", "_local", "_opened", "_lock", "_weights"]:
+            state.pop(key)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._build()
+
+    def _window_box(self, window):
+        from shapely import box
+
+        return box(
+            window.col_off,
+            window.row_off,
+            window.col_off + window.width,
+            window.row_off + window.height,
+        )
+
+    def query(self, window):
+        """Tiles intersecting an output window
+        Args:
+            window (rasterio.windows.Window): window on the output grid
+        Returns:
+            list: tile positions in self.paths order
+        """
+        hits = self.tree.query(self._window_box(window), predicate="intersects")
+        # touching edges are not an overlap
+        return sorted(i for i in hits if self._overlap(i, window) is not None)
+
+    def window_regions(self, window):
+        """Regions of the tile layout inside an output window
+        Args:
+            window (rasterio.windows.Window): window on the output grid
+        Returns:
+            list: (row0, col0, row1, col1, tiles) clipped to the window, in
+                output pixels
+        """
+        hits = self.region_tree.query(self._window_box(window), predicate="intersects")
+        regions = []
+        for j in sorted(hits):
+            row0, col0, row1, col1, tiles = self.regions[j]
+            row0 = max(row0, window.row_off)
+            col0 = max(col0, window.col_off)
+            row1 = min(row1, window.row_off + window.height)
+            col1 = min(col1, window.col_off + window.width)
+            if row0 < row1 and col0 < col1:
+                regions.append((row0, col0, row1, col1, tiles))
+        return regions
+
+    def overlap_share(self):
+        """Share of the covered output pixels where tiles overlap"""
+        pixels = [
+            ((row1 - row0) * (col1 - col0), len(tiles) > 1)
+            for row0, col0, row1, col1, tiles in self.regions
+        ]
+        total = sum(n for n, _ in pixels)
+        return sum(n for n, overlap in pixels if overlap) / total if total else 0.0
+
+    def _overlap(self, i, window):
+        row, col, height, width, _ = self.offsets[i]
+        row0 = max(row, window.row_off)
+        col0 = max(col, window.col_off)
+        row1 = min(row + height, window.row_off + window.height)
+        col1 = min(col + width, window.col_off + window.width)
+        if row0 >= row1 or col0 >= col1:
+            return None
+        return row0, col0, row1, col1
+
+    def _source(self, i):
+        import rasterio
+
+        sources = getattr(self._local, "sources", None)
+        if sources is None:
+            sources = self._local.sources = {}
+        if i not in sources:
+            sources[i] = rasterio.open(self.paths[i])
+            with self._lock:
+                self._opened.append(sources[i])
+        return sources[i]
+
+    def _read_part(self, i, window, bands):
+        """Read the part of a tile inside an output window, float64 with nan
+        where the tile has no data, and its first output row and column"""
+        from rasterio.windows import Window
+
+        row0, col0, row1, col1 = self._overlap(i, window)
+        row, col, _, _, nodata = self.offsets[i]
+        data = self._source(i).read(
+            bands, window=Window(col0 - col, row0 - row, col1 - col0, row1 - row0)
+        )
+        data = data.astype("float64")
+        if nodata is not None and not np.isnan(nodata):
+            data[data == nodata] = np.nan
+        return data, row0, col0
+
+    def read_tile(self, i, window, bands):
+        """Read the part of a tile inside an output window
+        Args:
+            i (int): tile position
+            window (rasterio.windows.Window): window on the output grid
+            bands (list): 1 based band indexes
+        Returns:
+            numpy.ndarray: float64 (bands, rows, cols) on the window, nan outside
+                the tile and where the tile has no data
+        """
+        out = np.full((len(bands), window.height, window.width), np.nan)
+        if self._overlap(i, window) is None:
+            return out
+        data, row0, col0 = self._read_part(i, window, bands)
+        out[
+            :,
+            row0 - window.row_off : row0 - window.row_off + data.shape[1],
+            col0 - window.col_off : col0 - window.col_off + data.shape[2],
+        ] = data
+        return out
+
+    def weights(self, bands):
+        """Valid (cloud free) pixels of each tile per band
+        Args:
+            bands (list): 1 based band indexes
+        Returns:
+            numpy.ndarray: (tiles, bands) valid counts from valid_counts, else
+                the pixels observed before gap filling in the statistics
+                sidecars (written by the interpolation)
+        """
+        from raster_stats import read_stats
+
+        key = tuple(bands)
+        if key not in self._weights:
+            weights = np.zeros((len(self.paths), len(bands)))
+            for i, path in enumerate(self.paths):
+                if self.valid_counts is not None:
+                    counts = self.valid_counts[i]
+                else:
+                    # the sidecar count is after gap filling, about every pixel
+                    stats = read_stats(path) or {}
+                    counts = {
+                        int(b): s["observed"]
+                        for b, s in stats.items()
+                        if "observed" in s
+                    }
+                missing = [band for band in bands if band not in counts]
+                if missing:
+                    raise ValueError(
+                        f"No valid pixel counts for bands {missing} of {path}, "
+                        "interpolate it again to record them in its statistics "
+                        "sidecar or pass valid_counts, e.g. from "
+                        "mask_store.MaskStore.valid_counts"
+                    )
+                for j, band in enumerate(bands):
+                    weights[i, j] = counts[band]
+            self._weights[key] = weights
+        return self._weights[key]
+
+    def _combine(self, stack, tiles, bands, rule):
+        """Apply the overlap rule to (tiles, bands, rows, cols) of one region"""
+        valid = ~np.isnan(stack)
+        if rule == "max":
+            return np.fmax.reduce(stack, axis=0)
+        if rule in ["mean", "weighted"]:
+            if rule == "mean":
+                weight = valid.astype("float64")
+            else:
+                weight = self.weights(bands)[tiles][:, :, None, None] * valid
+            total = (np.where(valid, stack, 0) * weight).sum(axis=0)
+            weight = weight.sum(axis=0)
+            return np.where(weight > 0, total / np.where(weight > 0, weight, 1), np.nan)
+        # first valid value in order of preference
+        if rule == "priority":
+            order = np.argsort([-self.priority[i] for i in tiles], kind="stable")
+            stack, valid = stack[order], valid[order]
+        elif rule == "clearest":
+            # per band, the tile with the largest cloud free share wins
+            pixels = np.array([self.offsets[i][2] * self.offsets[i][3] for i in tiles])
+            clear = self.weights(bands)[tiles] / pixels[:, None]
+            order = np.argsort(-clear, axis=0, kind="stable")[:, :, None, None]
+            stack = np.take_along_axis(stack, order, axis=0)
+            valid = np.take_along_axis(valid, order, axis=0)
+        first = valid.argmax(axis=0)[None]
+        return np.take_along_axis(stack, first, axis=0)[0]
+
+    def read(self, window, bands, rule="max"):
+        """Mosaic an output window
+        Args:
+            window (rasterio.windows.Window): window on the output grid
+            bands (list): 1 based band indexes, e.g. the quarters to mosaic
+            rule (str): how overlapping tiles combine
+                max: largest valid value, like da.maximum
+                first: first valid value in tile order
+                mean: mean of the valid values
+                weighted: mean of the valid values weighted by each tile's
+                    valid (cloud free) pixels in the band
+                priority: valid value of the tile with the highest priority
+                clearest: valid value of the tile with the largest cloud free
+                    share in the band
+        Returns:
+            numpy.ndarray: float64 (bands, rows, cols), nan where no tile has data
+        """
+        if rule not in OVERLAP_RULES:
+            raise ValueError(f"rule must be one of {OVERLAP_RULES}")
+        out = np.full((len(bands), window.height, window.width), np.nan)
+        regions = self.window_regions(window)
+        # one read per tile, about one window of memory whatever the tile count
+        parts = {
+            i: self._read_part(i, window, bands)
+            for i in sorted({i for *_, tiles in regions for i in tiles})
+        }
+
+        def part(i, row0, col0, row1, col1):
+            data, row, col = parts[i]
+            return data[:, row0 - row : row1 - row, col0 - col : col1 - col]
+
+        for row0, col0, row1, col1, tiles in regions:
+            rows = slice(row0 - window.row_off, row1 - window.row_off)
+            cols = slice(col0 - window.col_off, col1 - window.col_off)
+            if len(tiles) == 1:
+                out[:, rows, cols] = part(tiles[0], row0, col0, row1, col1)
+            else:
+                stack = np.stack([part(i, row0, col0, row1, col1) for i in tiles])
+                out[:, rows, cols] = self._combine(stack, tiles, bands, rule)
+        return out
+
+    def close(self):
+        with self._lock:
+            for src in self._opened:
+                src.close()
+            self._opened = []
+        self._local = threading.local()
+
+
+def window_grid(grid, window_size=512):
+    """Split the output grid into windows
+    Args:
+        grid (dict): output grid from tile_grid
+        window_size (int): window rows and columns
+    Returns:
+        list: list of rasterio.windows.Window
+    """
+    from compositor import window_grid as _window_grid
+
+    return _window_grid(grid["height"], grid["width"], window_size)
+
+
+def band_means(layers, rule="max", window_size=512):
+    """Mean of each mosaicked layer over its valid pixels, like B.mean(skipna=True)
+    Args:
+        layers (list): (TileIndex, band) pairs
+        rule (str): overlap rule, see TileIndex.read
+        window_size (int): window rows and columns
+    Returns:
+        list: one mean per layer
+    """
+    grid = layers[0][0].grid
+    totals = np.zeros(len(layers))
+    counts = np.zeros(len(layers))
+    for window in window_grid(grid, window_size):
+        for j, (index, band) in enumerate(layers):
+            data = index.read(window, [band], rule)
+            totals[j] += np.nansum(data)
+            counts[j] += np.count_nonzero(~np.isnan(data))
+    return list(totals / np.where(counts > 0, counts, np.nan))
+
+
+def layer_means(layers, rule="max", window_size=512):
+    """Fill mean of each layer from the tiles' statistics sidecars
+
+    Reads the means collected during interpolation (raster_stats) instead of a
+    full pass over the mosaic. Pixels in the overlap of two tiles count once per
+    tile, a negligible difference for the thin overlap strips of GEE exports.
+    Falls back to band_means when a tile has no sidecar.
+
+    Args:
+        layers (list): (TileIndex, band) pairs
+        rule (str): overlap rule for the fallback, see TileIndex.read
+        window_size (int): window rows and columns for the fallback
+    Returns:
+        list: one mean per layer
+    """
+    from raster_stats import pooled_mean
+
+    means = [pooled_mean(index.paths, band) for index, band in layers]
+    if any(mean is None for mean in means):
+        print("no statistics sidecar, computing band means from the tiles")
+        return band_means(layers, rule, window_size)
+    return means
+
+
+def output_profile(
+    grid, count, dtype="float32", nodata=np.nan, compress=DEFAULT_CODEC
+):
+    """Tiled GeoTIFF profile of the output grid
+    Args:
+        grid (dict): output grid from tile_grid
+        count (int): output bands
+        dtype (str): output dtype
+        nodata (float): output nodata, dropped for integer dtypes
+        compress (str): codec, see cog.CODECS, with the predictor for the dtype
+    Returns:
+        dict: rasterio profile
+    """
+    import rasterio
+
+    profile = grid["profile"].copy()
+    profile.update(
+        driver="GTiff",
+        width=grid["width"],
+        height=grid["height"],
+        count=count,
+        dtype=dtype,
+        nodata=None if np.issubdtype(np.dtype(dtype), np.integer) else nodata,
+        transform=rasterio.Affine(
+            grid["res"], 0, grid["left"], 0, -grid["res"], grid["top"]
+        ),
+        **gtiff_profile(dtype, compress),
+    )
+    return profile
+
+
+def _shared_grid(indexes):
+    grid = indexes[0].grid
+    for index in indexes[1:]:
+        if index.grid["left"] != grid["left"] or index.grid["top"] != grid["top"]:
+            raise ValueError("All layers must share the output grid, see tile_grid")
+    return grid
+
+
+def _check_counts(layers, rule):
+    """Fail before any window is written when a count rule has no counts"""
+    if rule in COUNT_RULES:
+        for index, bands in layers:
+            index.weights(bands)
+
+
+def _finish(out, fill, scale, dtype):
+    """Fill gaps with a value per band, scale and cast a (bands, rows, cols) window"""
+    if fill is not None:
+        for j, value in enumerate(fill):
+            out[j][np.isnan(out[j])] = value
+    if scale != 1:
+        out = out * scale
+    return out.astype(dtype)
+
+
+def _map_windows(context, func, windows, *args):
+    """func(window, *args) per window, on the context's workers when given"""
+    if context is None:
+        return (func(window, *args) for window in windows)
+    return context.map(func, windows, *args, label=func.__name__)
+
+
+def _read_layers(window, layers, rule):
+    return np.concatenate([index.read(window, [band], rule) for index, band in layers])
+
+
+def _read_indexes(window, indexes, bands, rule):
+    # (index, quarter, rows, cols)
+    return np.stack([index.read(window, bands, rule) for index in indexes])
+
+
+def _read_bands(window, indexes, bands, rule):
+    # band name -> (quarter, rows, cols)
+    return {b: index.read(window, bands, rule) for b, index in indexes.items()}
+
+
+def write_mosaic(
+    layers,
+    outfile,
+    rule="max",
+    fill=None,
+    scale=1,
+    dtype="float32",
+    nodata=np.nan,
+    window_size=512,
+    compress=DEFAULT_CODEC,
+    cog=True,
+    context=None,
+):
+    """Mosaic (TileIndex, band) layers into one multi band tif window by window
+
+    Args:
+        layers (list): (TileIndex, band) pairs, one per output band, all on the
+            same grid
+        outfile (str): output path
+        rule (str): overlap rule, see TileIndex.read
+        fill (list): value per layer written where no tile has data, e.g. the
+            band means, None to leave nan
+        scale (float): multiplier applied before casting, e.g. 10000 for int16
+        dtype (str): output dtype
+        nodata (float): output nodata
+        window_size (int): window rows and columns
+        compress (str): codec, see cog.CODECS
+        cog (bool): rewrite the outputs as Cloud Optimized GeoTIFFs with overviews
+        context (ExecutionContext): read and mosaic windows on its workers,
+            defaults to one window at a time
+    Returns:
+        str: outfile
+    """
+    import rasterio
+
+    grid = _shared_grid([index for index, _ in layers])
+    _check_counts([(index, [band]) for index, band in layers], rule)
+    profile = output_profile(grid, len(layers), dtype, nodata, compress)
+    windows = window_grid(grid, window_size)
+    with rasterio.open(outfile, "w", **profile) as dst:
+        results = _map_windows(context, _read_layers, windows, layers, rule)
+        for window, out in zip(windows, results):
+            dst.write(_finish(out, fill, scale, dtype), window=window)
+    if cog:
+        to_cog(outfile, codec=compress)
+    return outfile
+
+
+def write_mosaics(
+    indexes,
+    bands,
+    outfiles,
+    rule="max",
+    fill=None,
+    scale=1,
+    dtype="float32",
+    nodata=np.nan,
+    window_size=512,
+    compress=DEFAULT_CODEC,
+    cog=True,
+    context=None,
+):
+    """Mosaic every quarter in one pass over the windows
+
+    Each window of each index is read once for all quarter bands and split
+    into one output per quarter, instead of reopening and decoding the stacks
+    once per quarter. All outputs stay open while the windows are written.
+
+    Args:
+        indexes (list): TileIndex per output band, e.g. B2, B3, B4 and B8, all
+            on the same grid
+        bands (list): 1 based stack bands, one per output file, e.g. quarters
+        outfiles (list): output path per entry in bands
+        rule (str): overlap rule, see TileIndex.read
+        fill (list): per output file a list of values per index written where
+            no tile has data, None to leave nan
+        scale (float): multiplier applied before casting, e.g. 10000 for int16
+        dtype (str): output dtype
+        nodata (float): output nodata
+        window_size (int): window rows and columns
+        compress (str): codec, see cog.CODECS
+        cog (bool): rewrite the outputs as Cloud Optimized GeoTIFFs with overviews
+        context (ExecutionContext): read and mosaic windows on its workers,
+            defaults to one window at a time
+    Returns:
+        list: outfiles
+    """
+    import rasterio
+
+    if len(bands) != len(outfiles):
+        raise ValueError("Need one outfile per band")
+    grid = _shared_grid(indexes)
+    _check_counts([(index, bands) for index in indexes], rule)
+    profile = output_profile(grid, len(indexes), dtype, nodata, compress)
+    outputs = []
+    try:
+        for outfile in outfiles:
+            outputs.append(rasterio.open(outfile, "w", **profile))
+        windows = window_grid(grid, window_size)
+        results = _map_windows(context, _read_indexes, windows, indexes, bands, rule)
+        for window, data in zip(windows, results):
+            for k, dst in enumerate(outputs):
+                out_fill = None if fill is None else fill[k]
+                dst.write(_finish(data[:, k], out_fill, scale, dtype), window=window)
+    finally:
+        for dst in outputs:
+            dst.close()
+    if cog:
+        for outfile in outfiles:
+            to_cog(outfile, codec=compress)
+    return list(outfiles)
+
+
+def write_products(
+    indexes,
+    bands,
+    labels,
+    products,
+    fields=None,
+    rule="max",
+    fill=True,
+    nodata=np.nan,
+    window_size=512,
+    compress=DEFAULT_CODEC,
+    cog=True,
+    context=None,
+):
+    """Write several stack products from one read of each input window
+
+    Each window of every band needed by any product is read once for all
+    quarters, then cut into each product's outputs.
+
+    Args:
+        indexes (dict): band name -> TileIndex, all on the same grid
+        bands (list): 1 based stack bands to write, e.g. quarters
+        labels (list): label per entry in bands, fills {quarter} in the paths
+        products (list): product specs, dicts with
+            bands: band names in output order, e.g. ["B2", "B3", "B4", "B8"]
+            dtype: output dtype, e.g. "float32" or "int16"
+            scale: multiplier applied before casting, e.g. 10000
+            layout: "multiband" for one file per quarter with all bands or
+                "single_band" for one file per band and quarter
+            path: output template using {quarter}, {band} and any of fields
+            codec: optional codec of the product, defaults to compress
+        fields (dict): extra path template fields, e.g. {"zone": "south"}
+        rule (str): overlap rule, see TileIndex.read
+        fill (bool): fill gaps with the band mean, see layer_means
+        nodata (float): output nodata for float products
+        window_size (int): window rows and columns
+        compress (str): codec, see cog.CODECS
+        cog (bool): rewrite the outputs as Cloud Optimized GeoTIFFs with overviews
+        context (ExecutionContext): read and mosaic windows on its workers,
+            defaults to one window at a time
+    Returns:
+        list: written paths
+    """
+    import rasterio
+
+    fields = fields or {}
+    band_names = list(
+        dict.fromkeys(b for product in products for b in product["bands"])
+    )
+    grid = _shared_grid([indexes[b] for b in band_names])
+    _check_counts([(indexes[b], bands) for b in band_names], rule)
+    means = {}
+    if fill:
+        for b in band_names:
+            for k, band in enumerate(bands):
+                means[(b, k)] = layer_means([(indexes[b], band)], rule)[0]
+
+    # (dataset, band names, quarter position, product) per output file
+    outputs = []
+    try:
+        for product in products:
+            layout = product.get("layout", "multiband")
+            if layout not in ["multiband", "single_band"]:
+                raise ValueError(f"Unknown layout: {layout}")
+            groups = (
+                [product["bands"]]
+                if layout == "multiband"
+                else [[b] for b in product["bands"]]
+            )
+            for group in groups:
+                codec = product.get("codec", compress)
+                profile = output_profile(
+                    grid, len(group), product["dtype"], nodata, codec
+                )
+                for k, label in enumerate(labels):
+                    path = product["path"].format(
+                        quarter=label, band=group[0], **fields
+                    )
+                    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+                    outputs.append(
+                        (rasterio.open(path, "w", **profile), group, k, product)
+                    )
+
+        windows = window_grid(grid, window_size)
+        needed = {b: indexes[b] for b in band_names}
+        results = _map_windows(context, _read_bands, windows, needed, bands, rule)
+        for window, data in zip(windows, results):
+            for dst, group, k, product in outputs:
+                out = np.stack([data[b][k] for b in group])
+                out_fill = [means[(b, k)] for b in group] if fill else None
+                out = _finish(out, out_fill, product.get("scale", 1), product["dtype"])
+                dst.write(out, window=window)
+    finally:
+        for dst, _, _, _ in outputs:
+            dst.close()
+    if cog:
+        for dst, _, _, product in outputs:
+            to_cog(dst.name, codec=product.get("codec", compress))
+    return [dst.name for dst, _, _, _ in outputs]
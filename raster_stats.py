@@ -0,0 +1,228 @@
+# Description: Per band statistics sidecars (mean, std, min, max, valid count and
+# histogram) collected while a stage writes its output, so later stages can read
+# e.g. the fill mean instead of reducing the whole raster again
+# author: Michael Mann mmann1123@gwu.edu
+
+# the sidecar of B2_S2_SR_interp_linear_north.tif is
+# B2_S2_SR_interp_linear_north_stats.json with one entry per band (quarter):
+# {"file": ..., "bands": {"1": {"mean": .., "std": .., "min": .., "max": ..,
+#  "count": .., "histogram": {"edges": [..], "counts": [..]}}, ...}}
+# stages that fill gaps also record "observed", the valid pixels before filling,
+# e.g. the cloud free weights of the mosaic overlap rules
+
+# to build a sidecar for an existing raster from terminal (one read):
+# python raster_stats.py interpolated/B2_S2_SR_interp_linear_north.tif
+
+import argparse
+import json
+import os
+
+import numpy as np
+
+# surface reflectance, values outside the range go to the end bins
+HIST_BINS = 100
+HIST_RANGE = (0.0, 1.0)
+
+
+def stats_path(path):
+    """Sidecar path of a raster"""
+    return os.path.splitext(path)[0] + "_stats.json"
+
+
+class StatsAccumulator:
+    """Running per band statistics over windows, in one pass.
+
+    Args:
+        n_bands (int): bands of the raster
+        bins (int): histogram bins
+        hist_range (tuple): histogram lower and upper edge
+
+    Example:
+
+    acc = StatsAccumulator(n_bands=src.count)
+    for window in windows:
+        acc.update(src.read(window=window))
+    acc.write("B2_S2_SR_interp_linear_north.tif")
+    """
+
+    def __init__(self, n_bands, bins=HIST_BINS, hist_range=HIST_RANGE):
+        self.n_bands = n_bands
+        self.edges = np.linspace(hist_range[0], hist_range[1], bins + 1)
+        self.count = np.zeros(n_bands, dtype="int64")
+        self.total = np.zeros(n_bands)
+        self.total_sq = np.zeros(n_bands)
+        self.min = np.full(n_bands, np.inf)
+        self.max = np.full(n_bands, -np.inf)
+        self.hist = np.zeros((n_bands, bins), dtype="int64")
+        # valid pixels before gap filling, only written once observe is called
+        self.observed = None
+
+    def update(self, data, bands=None):
+        """Add a window
+        Args:
+            data (numpy.ndarray): (bands, rows, cols), nan is missing
+            bands (list): 0 based band positions of data, defaults to all bands
+        """
+        bands = range(self.n_bands) if bands is None else bands
+        for i, band in enumerate(bands):
+            values = np.asarray(data[i], dtype="float64").ravel()
+            values = values[~np.isnan(values)]
+            if values.size == 0:
+                continue
+            self.count[band] += values.size
+            self.total[band] += values.sum()
+            self.total_sq[band] += np.square(values).sum()
+            self.min[band] = min(self.min[band], values.min())
+            self.max[band] = max(self.max[band], values.max())
+            bin_ids = np.clip(
+                np.searchsorted(self.edges, values, side="right") - 1,
+                0,
+                len(self.edges) - 2,
+            )
+            self.hist[band] += np.bincount(bin_ids, minlength=len(self.edges) - 1)
+
+    def observe(self, data, bands=None, missing_value=np.nan):
+        """Count the valid pixels of a window before its gaps are filled
+        Args:
+            data (numpy.ndarray): (bands, rows, cols) before filling
+            bands (list): 0 based band positions of data, defaults to all bands
+            missing_value (float): value treated as missing besides nan
+        """
+        if self.observed is None:
+            self.observed = np.zeros(self.n_bands, dtype="int64")
+        bands = range(self.n_bands) if bands is None else bands
+        for i, band in enumerate(bands):
+            values = np.asarray(data[i], dtype="float64")
+            missing = np.isnan(values)
+            if missing_value is not None and not np.isnan(missing_value):
+                missing |= values == missing_value
+            self.observed[band] += int(missing.size - missing.sum())
+
+    def to_dict(self):
+        """Statistics per band
+        Returns:
+            dict: 1 based band number (str) -> mean, std, min, max, count,
+                histogram and observed when recorded
+        """
+        out = {}
+        for band in range(self.n_bands):
+            n = int(self.count[band])
+            mean = self.total[band] / n if n else None
+            std = (
+                float(np.sqrt(max(self.total_sq[band] / n - mean**2, 0))) if n else None
+            )
+            out[str(band + 1)] = {
+                "mean": mean,
+                "std": std,
+                "min": float(self.min[band]) if n else None,
+                "max": float(self.max[band]) if n else None,
+                "count": n,
+                "histogram": {
+                    "edges": self.edges.tolist(),
+                    "counts": self.hist[band].tolist(),
+                },
+            }
+            if self.observed is not None:
+                out[str(band + 1)]["observed"] = int(self.observed[band])
+        return out
+
+    def write(self, raster_path, labels=None):
+        """Write the sidecar next to a raster
+        Args:
+            raster_path (str): raster the statistics describe
+            labels (list): optional name per band, e.g. quarters
+        Returns:
+            str: sidecar path
+        """
+        bands = self.to_dict()
+        if labels:
+            for band, label in zip(bands.values(), labels):
+                band["label"] = label
+        path = stats_path(raster_path)
+        tmp = path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump({"file": os.path.basename(raster_path), "bands": bands}, f)
+        os.replace(tmp, path)
+        return path
+
+
+def read_stats(raster_path):
+    """Read the sidecar of a raster
+    Args:
+        raster_path (str): raster path
+    Returns:
+        dict: 1 based band number (str) -> statistics, None if there is no sidecar
+    """
+    path = stats_path(raster_path)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)["bands"]
+
+
+def pooled_mean(raster_paths, band):
+    """Mean of a band over several rasters, e.g. the tiles of a mosaic
+
+    Each tile counts with its valid pixels, pixels shared by overlapping tiles
+    count once per tile.
+
+    Args:
+        raster_paths (list): rasters with sidecars
+        band (int): 1 based band number
+    Returns:
+        float: mean, None if a sidecar is missing or there are no valid pixels
+    """
+    total = 0.0
+    count = 0
+    for path in raster_paths:
+        stats = read_stats(path)
+        if stats is None:
+            return None
+        band_stats = stats[str(band)]
+        if band_stats["count"]:
+            total += band_stats["mean"] * band_stats["count"]
+            count += band_stats["count"]
+    return total / count if count else None
+
+
+def stats_from_raster(raster_path, block_size=512):
+    """Build the sidecar of an existing raster in one windowed read
+    Args:
+        raster_path (str): raster path
+        block_size (int): rows and columns read at once
+    Returns:
+        str: sidecar path
+    """
+    import rasterio
+    from rasterio.windows import Window
+
+    with rasterio.open(raster_path) as src:
+        acc = StatsAccumulator(src.count)
+        for row_off in range(0, src.height, block_size):
+            for col_off in range(0, src.width, block_size):
+                window = Window(
+                    col_off,
+                    row_off,
+                    min(block_size, src.width - col_off),
+                    min(block_size, src.height - row_off),
+                )
+                data = src.read(window=window).astype("float64")
+                if src.nodata is not None and not np.isnan(src.nodata):
+                    data[data == src.nodata] = np.nan
+                acc.update(data)
+        labels = list(src.descriptions) if any(src.descriptions) else None
+    return acc.write(raster_path, labels)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="write per band statistics sidecars")
+    parser.add_argument("rasters", type=str, nargs="+", help="rasters to describe")
+    parser.add_argument("--block_size", type=int, default=512)
+    args = parser.parse_args()
+
+    for raster in args.rasters:
+        print("wrote", stats_from_raster(raster, args.block_size))
+
+
+if __name__ == "__main__":
+    main()
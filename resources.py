@@ -0,0 +1,212 @@
+# Description: Memory and cpu helpers shared by the processing stages
+# author: Michael Mann mmann1123@gwu.edu
+
+import os
+import re
+
+MEMORY_UNITS = {
+    "": 1,
+    "B": 1,
+    "K": 1024,
+    "KB": 1024,
+    "M": 1024**2,
+    "MB": 1024**2,
+    "G": 1024**3,
+    "GB": 1024**3,
+    "T": 1024**4,
+    "TB": 1024**4,
+}
+
+
+def parse_memory(value):
+    """Convert a memory size to bytes
+    Args:
+        value (str|int|float): e.g. "32GB", "512M", "1.5T" or a number of bytes
+    Returns:
+        int: bytes
+
+    # Example usage
+    parse_memory("32GB")  # 34359738368
+    """
+    if isinstance(value, (int, float)):
+        return int(value)
+    match = re.fullmatch(r"\s*([\d.]+)\s*([KMGT]?B?)\s*", value.upper())
+    if not match:
+        raise ValueError(f"Memory must look like 32GB or 512MB, got: {value}")
+    number, unit = match.groups()
+    return int(float(number) * MEMORY_UNITS[unit])
+
+
+def format_memory(n_bytes):
+    """Format bytes for printing
+    Args:
+        n_bytes (int): bytes
+    Returns:
+        str: e.g. "1.5GB"
+    """
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(n_bytes) < 1024:
+            return f"{n_bytes:.1f}{unit}"
+        n_bytes /= 1024
+    return f"{n_bytes:.1f}TB"
+
+
+def available_memory():
+    """Memory available to new processes in bytes
+    Returns:
+        int: bytes
+    """
+    try:
+        import psutil
+
+        return int(psutil.virtual_memory().available)
+    except ImportError:
+        return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+def fit_window(height, width, block_shape, max_pixels):
+    """Largest window of at most max_pixels made of whole internal blocks
+    Args:
+        height (int): raster rows
+        width (int): raster columns
+        block_shape (tuple): internal block rows and columns of the GeoTIFF
+        max_pixels (int): pixels one window may hold
+    Returns:
+        list: [rows, cols], never smaller than one block
+    """
+    block_rows, block_cols = block_shape
+    max_pixels = int(max_pixels)
+    if block_cols >= width:
+        # striped file, read full rows
+        rows = max(max_pixels // max(width, 1) // block_rows, 1) * block_rows
+        return [min(rows, height), width]
+    side = int(max_pixels**0.5)
+    rows = max(side // block_rows, 1) * block_rows
+    cols = max(side // block_cols, 1) * block_cols
+    rows, cols = min(rows, height), min(cols, width)
+    # give pixels left over by a narrow raster back to the rows
+    if cols == width:
+        rows = min(max(max_pixels // cols // block_rows, 1) * block_rows, height)
+    elif rows == height:
+        cols = min(max(max_pixels // rows // block_cols, 1) * block_cols, width)
+    return [rows, cols]
+
+
+def window_size_for_memory(
+    path,
+    n_times,
+    mem_budget=None,
+    n_bands=1,
+    workers=1,
+    dtype="float64",
+    copies=4,
+    base_memory=0,
+):
+    """Pick gw.series window dimensions that fit a memory budget
+
+    Each worker holds copies of a (n_bands, n_times, rows, cols) window, so the
+    budget left after base_memory per worker is split between the workers and
+    divided by the bytes of one pixel across bands, times and copies. The window
+    is then rounded down to whole GeoTIFF blocks so reads never split a
+    compressed block.
+
+    Args:
+        path (str): one input raster, provides the shape and internal tiling
+        n_times (int): length of the time series
+        mem_budget (str|int): e.g. "32GB", defaults to the available memory
+        n_bands (int): series read together, e.g. 6 for a multiband pass
+        workers (int): windows processed at once
+        dtype (str): dtype of the arrays held in memory
+        copies (int): window sized arrays alive at once per worker
+        base_memory (int): fixed bytes per worker, e.g. imported libraries
+    Returns:
+        list: [rows, cols]
+
+    # Example usage
+    window_size_for_memory("B2/S2_SR_B2_2020_Q01_north.tif", 20, "32GB", workers=4)
+    """
+    import numpy as np
+    import rasterio
+
+    budget = parse_memory(mem_budget) if mem_budget else available_memory()
+    per_worker = budget / max(workers, 1) - base_memory
+    pixel_bytes = n_times * n_bands * np.dtype(dtype).itemsize * copies
+    max_pixels = max(int(per_worker // pixel_bytes), 1)
+    with rasterio.open(path) as src:
+        window = fit_window(src.height, src.width, src.block_shapes[0], max_pixels)
+    print(
+        f"window {window[0]}x{window[1]} for {workers} workers in "
+        f"{format_memory(budget)} ({n_bands} bands x {n_times} times)"
+    )
+    return window
+
+
+def _read_first(paths):
+    for path in paths:
+        try:
+            with open(path) as f:
+                return f.read().strip()
+        except OSError:
+            continue
+    return None
+
+
+def cgroup_cpu_limit():
+    """CPU quota of the container or Slurm cgroup, cgroup v2 or v1
+    Returns:
+        float: cpus allowed, None if unlimited
+    """
+    value = _read_first(["/sys/fs/cgroup/cpu.max"])
+    if value:
+        quota, period = value.split()
+        if quota != "max":
+            return int(quota) / int(period)
+        return None
+    quota = _read_first(["/sys/fs/cgroup/cpu/cpu.cfs_quota_us"])
+    period = _read_first(["/sys/fs/cgroup/cpu/cpu.cfs_period_us"])
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+
+def cgroup_memory_limit():
+    """Memory limit of the container or Slurm cgroup, cgroup v2 or v1
+    Returns:
+        int: bytes, None if unlimited
+    """
+    value = _read_first(
+        ["/sys/fs/cgroup/memory.max", "/sys/fs/cgroup/memory/memory.limit_in_bytes"]
+    )
+    if not value or value == "max":
+        return None
+    limit = int(value)
+    # v1 reports a huge number when unlimited
+    if limit >= 2**60:
+        return None
+    return limit
+
+
+def available_cpus():
+    """Cpus this process may use: affinity (e.g. Slurm --cpus-per-task) capped by
+    the cgroup quota
+    Returns:
+        int: cpus, at least 1
+    """
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cpus = os.cpu_count() or 1
+    quota = cgroup_cpu_limit()
+    if quota:
+        cpus = min(cpus, int(quota))
+    return max(cpus, 1)
+
+
+def memory_limit():
+    """Memory this process may use, available memory capped by the cgroup limit
+    Returns:
+        int: bytes
+    """
+    memory = available_memory()
+    limit = cgroup_memory_limit()
+    return min(memory, limit) if limit else memory
@@ -0,0 +1,350 @@
+# Description: Runtime history, cost model and bin packing of spfeas tasks into
+# Slurm partitions and time limits, instead of one long time request for all
+# author: Michael Mann mmann1123@gwu.edu
+
+# every task records its runtime when it finishes (timed_command), the records
+# are collected with the task metadata (feature, scales, image pixels) into a
+# history csv. a cost model fit on the history estimates new tasks, long tasks
+# are split by scale, cheap tasks are packed into jobs of about pack_hours, and
+# each job gets the shortest partition in functions.partitions it fits
+
+# Example:
+# from scheduler import CostModel, RuntimeHistory, plan_jobs
+# history = RuntimeHistory("spfeas_runtimes.csv")
+# history.collect(old_manifests, "runtimes")
+# model = CostModel().fit(history.read())
+# jobs = plan_jobs(tasks, model, ["tiny", "short", "defq"], split_features=["gabor"])
+
+# before any history the estimates come from PRIOR_HOURS, e.g. gabor about 9 hours
+# and most other features under 2 for a zone mosaic (PRIOR_PIXELS) at three
+# scales, scaled by the task's pixels so shards get shard sized estimates
+
+import csv
+import json
+import math
+import os
+
+import numpy as np
+
+PRIOR_HOURS = {"gabor": 9.0}
+DEFAULT_PRIOR_HOURS = 2.0
+PRIOR_SCALES = 3
+# reference zone mosaic of the priors, about two 23296 px GEE export tiles
+PRIOR_PIXELS = 46592 * 23296
+
+HISTORY_FIELDS = ["name", "feature", "scales", "pixels", "seconds", "finished"]
+
+
+def slurm_seconds(limit):
+    """Seconds of a Slurm time limit
+    Args:
+        limit (str): e.g. 14-00:00:0, 4:00:00, 30:00 or infinite
+    Returns:
+        float: seconds, inf for infinite
+    """
+    if limit in ["infinite", "UNLIMITED"]:
+        return math.inf
+    days, _, rest = limit.rpartition("-")
+    parts = [int(p) for p in rest.split(":")]
+    # M:S, H:M:S
+    while len(parts) < 3:
+        parts.insert(0, 0)
+    hours, minutes, seconds = parts
+    return int(days or 0) * 86400 + hours * 3600 + minutes * 60 + seconds
+
+
+def format_time(seconds):
+    """DD-HH:MM:SS time request, as checked by functions.check_partition_time"""
+    seconds = int(math.ceil(seconds))
+    days, seconds = divmod(seconds, 86400)
+    hours, seconds = divmod(seconds, 3600)
+    minutes, seconds = divmod(seconds, 60)
+    return f"{days:02d}-{hours:02d}:{minutes:02d}:{seconds:02d}"
+
+
+def image_pixels(path):
+    """Rows x columns of an image"""
+    import rasterio
+
+    with rasterio.open(path) as src:
+        return src.width * src.height
+
+
+def timed_command(name, command, runtime_dir):
+    """Wrap a task command so a successful run writes its runtime
+    Args:
+        name (str): task name, the runtime file is {runtime_dir}/{name}.json
+        command (str): shell command
+        runtime_dir (str): folder of the runtime records
+    Returns:
+        str: shell lines
+    """
+    record = os.path.join(runtime_dir, f"{name}.json")
+    return "\n".join(
+        [
+            f"mkdir -p {runtime_dir}",
+            "start=$(date +%s)",
+            command,
+            "stop=$(date +%s)",
+            f'echo "{{\\"name\\": \\"{name}\\", \\"seconds\\": $((stop - start)), '
+            f'\\"finished\\": $stop, \\"node\\": \\"$(hostname)\\"}}" > {record}',
+        ]
+    )
+
+
+class RuntimeHistory:
+    """Csv of finished task runtimes with the metadata the cost model uses.
+
+    Args:
+        path (str): history csv, created on the first collect
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        """Runtimes recorded so far
+        Returns:
+            list: dicts with feature, scales (list of int), pixels and seconds
+        """
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path, newline="") as f:
+            rows = list(csv.DictReader(f))
+        for row in rows:
+            row["scales"] = [int(s) for s in row["scales"].split("-")]
+            row["pixels"] = int(row["pixels"])
+            row["seconds"] = float(row["seconds"])
+        return rows
+
+    def collect(self, manifests, runtime_dir):
+        """Add the runtimes of finished tasks of earlier runs
+        Args:
+            manifests (list): manifests (slurm.write_manifest) whose entries list
+                their tasks under "tasks"
+            runtime_dir (str): folder of the timed_command records
+        Returns:
+            int: records added
+        """
+        from slurm import read_manifest
+
+        seen = set()
+        if os.path.exists(self.path):
+            with open(self.path, newline="") as f:
+                seen = {(r["name"], r["finished"]) for r in csv.DictReader(f)}
+        rows = []
+        for manifest in manifests:
+            for entry in read_manifest(manifest):
+                for task in entry.get("tasks", [entry]):
+                    record_path = os.path.join(runtime_dir, f"{task['name']}.json")
+                    if not os.path.exists(record_path):
+                        continue
+                    with open(record_path) as f:
+                        record = json.load(f)
+                    if (task["name"], str(record["finished"])) in seen:
+                        continue
+                    seen.add((task["name"], str(record["finished"])))
+                    rows.append(
+                        {
+                            "name": task["name"],
+                            "feature": task["feature"],
+                            "scales": "-".join(str(s) for s in task["scales"]),
+                            "pixels": task["pixels"],
+                            "seconds": record["seconds"],
+                            "finished": record["finished"],
+                        }
+                    )
+        if rows:
+            new_file = not os.path.exists(self.path)
+            with open(self.path, "a", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=HISTORY_FIELDS)
+                if new_file:
+                    writer.writeheader()
+                writer.writerows(rows)
+        print(f"added {len(rows)} runtimes to {self.path}")
+        return len(rows)
+
+
+class CostModel:
+    """Seconds of a spfeas task per feature, linear in pixels x scales.
+
+    seconds = pixels x sum over scales of (a + b x scale), a and b fit per
+    feature by least squares on the history. Features with one distinct scale
+    set fit a alone, features without history use PRIOR_HOURS scaled by the
+    task's pixels over prior_pixels.
+
+    Args:
+        prior_hours (dict): feature -> hours of a task at PRIOR_SCALES scales
+            on prior_pixels pixels
+        default_hours (float): prior of features missing from prior_hours
+        prior_pixels (int): image pixels the prior hours were measured on
+    """
+
+    def __init__(
+        self,
+        prior_hours=None,
+        default_hours=DEFAULT_PRIOR_HOURS,
+        prior_pixels=PRIOR_PIXELS,
+    ):
+        self.prior_hours = PRIOR_HOURS if prior_hours is None else prior_hours
+        self.default_hours = default_hours
+        self.prior_pixels = prior_pixels
+        self.coefficients = {}
+
+    def fit(self, rows):
+        """Fit per feature coefficients
+        Args:
+            rows (list): RuntimeHistory.read records
+        Returns:
+            CostModel: self
+        """
+        by_feature = {}
+        for row in rows:
+            by_feature.setdefault(row["feature"], []).append(row)
+        for feature, feature_rows in by_feature.items():
+            x = np.array(
+                [
+                    [r["pixels"] * len(r["scales"]), r["pixels"] * sum(r["scales"])]
+                    for r in feature_rows
+                ],
+                dtype="float64",
+            )
+            y = np.array([r["seconds"] for r in feature_rows], dtype="float64")
+            coefficients = None
+            if np.linalg.matrix_rank(x) == 2:
+                coefficients, *_ = np.linalg.lstsq(x, y, rcond=None)
+            if coefficients is None or (coefficients < 0).any():
+                # seconds per pixel and scale
+                coefficients = np.array([y.sum() / x[:, 0].sum(), 0.0])
+            self.coefficients[feature] = coefficients
+        return self
+
+    def predict(self, feature, scales, pixels):
+        """Estimated seconds of a task
+        Args:
+            feature (str): spfeas feature
+            scales (list): scales of the task
+            pixels (int): image rows x columns
+        Returns:
+            float: seconds
+        """
+        if feature in self.coefficients:
+            a, b = self.coefficients[feature]
+            return float(pixels * (a * len(scales) + b * sum(scales)))
+        hours = self.prior_hours.get(feature, self.default_hours)
+        return hours * 3600 * len(scales) / PRIOR_SCALES * pixels / self.prior_pixels
+
+
+def split_by_scale(task):
+    """One task per scale, named {name}_sc{scale}, commands are built after
+    planning from the scales of each task"""
+    tasks = []
+    for scale in task["scales"]:
+        tasks.append(
+            {
+                **task,
+                "name": f"{task['name']}_sc{scale}",
+                "scales": [scale],
+                "split_from": task["name"],
+            }
+        )
+    return tasks
+
+
+def plan_jobs(
+    tasks,
+    model,
+    partitions,
+    split_features=(),
+    pack_hours=4.0,
+    margin=1.5,
+    overhead_minutes=10,
+    limits=None,
+):
+    """Split, estimate and bin pack tasks into jobs with a partition and time
+    Args:
+        tasks (list): dicts with name, feature, scales and pixels
+        model (CostModel): fit cost model
+        partitions (list): candidate partitions, the first one a job fits wins,
+            order them from the shortest limit
+        split_features (list): features always split into one task per scale,
+            tasks that fit no partition whole are split too
+        pack_hours (float): cheap tasks are grouped into jobs of up to this many
+            estimated hours, tasks longer than this run alone
+        margin (float): multiplier on the estimate for the time request
+        overhead_minutes (float): added to each job's time request
+        limits (dict): partition -> time limit, defaults to functions.partitions
+    Returns:
+        list: jobs, dicts with name, partition, time_request, estimate_seconds and
+            tasks (each with its estimate_seconds)
+    """
+    if limits is None:
+        from functions import partitions as limits
+    seconds = {p: slurm_seconds(limits[p]) for p in partitions}
+    longest = max(seconds.values())
+
+    def request(estimate):
+        return estimate * margin + overhead_minutes * 60
+
+    planned = []
+    for task in tasks:
+        estimate = model.predict(task["feature"], task["scales"], task["pixels"])
+        split = task["feature"] in split_features or request(estimate) >= longest
+        if split and len(task["scales"]) > 1:
+            planned.extend(split_by_scale(task))
+        else:
+            planned.append(task)
+    for task in planned:
+        task["estimate_seconds"] = round(
+            model.predict(task["feature"], task["scales"], task["pixels"]), 1
+        )
+
+    # first fit decreasing, long tasks get a bin of their own
+    bins = []
+    capacity = pack_hours * 3600
+    for task in sorted(planned, key=lambda t: t["estimate_seconds"], reverse=True):
+        for group in bins:
+            total = sum(t["estimate_seconds"] for t in group)
+            if total + task["estimate_seconds"] <= capacity:
+                group.append(task)
+                break
+        else:
+            bins.append([task])
+
+    jobs = []
+    for group in bins:
+        estimate = sum(t["estimate_seconds"] for t in group)
+        # whole hours less a minute, e.g. 00-03:59:00, so jobs share a few time
+        # requests (one array each) and fit partitions with a 4:00:00 limit
+        needed = math.ceil(request(estimate) / 3600) * 3600 - 60
+        # check_partition_time needs the request below the limit
+        fits = [p for p in partitions if needed < seconds[p]]
+        if not fits:
+            names = [t["name"] for t in group]
+            raise ValueError(f"No partition fits {format_time(needed)}: {names}")
+        jobs.append(
+            {
+                "name": group[0]["name"] if len(group) == 1 else f"pack_{len(jobs)}",
+                "partition": fits[0],
+                "time_request": format_time(needed),
+                "estimate_seconds": round(estimate, 1),
+                "tasks": group,
+            }
+        )
+    return jobs
+
+
+def job_arrays(jobs):
+    """Group jobs that share a partition and time request, one array each
+    Returns:
+        dict: (partition, time_request) -> jobs
+    """
+    arrays = {}
+    for job in jobs:
+        arrays.setdefault((job["partition"], job["time_request"]), []).append(job)
+    return arrays
+
+
+def array_label(partition, time_request):
+    """File name safe label of an array, e.g. short_6h for 00-05:59:00"""
+    return f"{partition}_{round(slurm_seconds(time_request) / 3600)}h"
@@ -0,0 +1,325 @@
+# Description: Submit a pipeline stage as one Slurm job array driven by a task
+# manifest, and chain stages with dependencies, instead of one sbatch script and
+# one submission per task
+# author: Michael Mann mmann1123@gwu.edu
+
+# the manifest is a JSON lines file, one task per line with at least a name and
+# the shell command to run, plus any metadata (image, feature, scales). array
+# element i runs the command on line i + 1, so a stage is a single submission
+# whatever the number of tasks
+
+# Example:
+# from slurm import (SbatchBackend, run_folder, submit_stages, write_array_script,
+#                    write_manifest)
+# run = run_folder("spfeas_batch_scripts")
+# write_manifest(f"{run}/spfeas_manifest.jsonl", tasks)
+# write_array_script(f"{run}/spfeas_array.sh", f"{run}/spfeas_manifest.jsonl",
+#                    "spfeas", "defq", "04-12:35:00", email, run, setup=spfeas_env)
+# job_ids = submit_stages(
+#     [{"name": "spfeas", "script": f"{run}/spfeas_array.sh"},
+#      {"name": "vrt2tif", "script": f"{run}/vrt2tif_array.sh", "after": "spfeas",
+#       "dependency": "aftercorr"}],
+#     backend=SbatchBackend(),
+# )
+
+# dependencies: afterok waits for every element of the earlier array, aftercorr
+# starts element i once element i of the earlier array finished ok, e.g. the
+# VRT to tif conversion of one feature as soon as spfeas wrote it
+
+# elements read their command from the manifest when they start, hours or days
+# after submission, so a manifest must not change while its array is queued.
+# each submission writes its manifests and scripts to a new run_folder and
+# earlier runs are left in place
+
+# print the sbatch calls without submitting with backend=DryRunBackend(), or run
+# the arrays locally in order with backend=FakeSbatch(run=True)
+
+import json
+import os
+import re
+import subprocess
+import time
+import uuid
+
+DEPENDENCY_TYPES = ["afterok", "aftercorr", "afterany", "afternotok"]
+
+
+def run_folder(parent, prefix="run"):
+    """Create a new folder for the manifests, scripts and logs of one submission
+    Args:
+        parent (str): folder holding the runs
+        prefix (str): e.g. "dry_run" to tell runs that were never submitted apart
+    Returns:
+        str: path, e.g. {parent}/run_20240131_142501_3fa2c1
+    """
+    name = f"{prefix}_{time.strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
+    path = os.path.join(parent, name)
+    os.makedirs(path)
+    return path
+
+
+def write_manifest(path, tasks, overwrite=False):
+    """Write a task manifest
+    Args:
+        path (str): output .jsonl path
+        tasks (list): dicts with name and command, other keys are kept as metadata
+        overwrite (bool): replace an existing manifest, unsafe while an array
+            reading it may still be queued, see run_folder
+    Returns:
+        str: path
+    """
+    for task in tasks:
+        if "name" not in task or "command" not in task:
+            raise ValueError(f"Task needs a name and a command: {task}")
+    if os.path.exists(path) and not overwrite:
+        raise FileExistsError(f"{path} exists, write each run to a new run_folder")
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        for task in tasks:
+            f.write(json.dumps(task, sort_keys=True) + "\n")
+    os.replace(tmp_path, path)
+    return path
+
+
+def read_manifest(path):
+    """Read a task manifest
+    Args:
+        path (str): .jsonl path
+    Returns:
+        list: task dicts in array index order
+    """
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def array_script(
+    manifest,
+    job_name,
+    partition,
+    time_request,
+    email=None,
+    log_dir=".",
+    setup="",
+    max_parallel=None,
+    n_tasks=None,
+    cpus_per_task=None,
+    memory=None,
+):
+    """sbatch script running one manifest task per array element
+    Args:
+        manifest (str): manifest path
+        job_name (str): Slurm job name
+        partition (str): Slurm partition
+        time_request (str): time limit per element DD-HH:MM:SS
+        email (str): address for Slurm notifications
+        log_dir (str): folder of the .out and .err files, one pair per element
+        setup (str): shell lines run before the task, e.g. activating an env
+        max_parallel (int): elements running at once, defaults to no limit
+        n_tasks (int): array size, defaults to the number of manifest tasks
+        cpus_per_task (int): cpus per element, defaults to the partition default
+        memory (str): memory per element, e.g. 64G, defaults to the partition
+            default
+    Returns:
+        str: script text
+    """
+    n_tasks = len(read_manifest(manifest)) if n_tasks is None else n_tasks
+    if n_tasks == 0:
+        raise ValueError(f"No tasks in {manifest}")
+    array = f"0-{n_tasks - 1}" + (f"%{max_parallel}" if max_parallel else "")
+    options = (
+        f"#SBATCH --mail-type=ALL\n#SBATCH --mail-user={email}\n" if email else ""
+    )
+    if cpus_per_task:
+        options += f"#SBATCH --cpus-per-task={cpus_per_task}\n"
+    if memory:
+        options += f"#SBATCH --mem={memory}\n"
+    manifest = os.path.abspath(manifest)
+    # python 2 and 3, the spfeas env runs python 2.7
+    read_command = (
+        "import json, sys; "
+        "line = open(sys.argv[1]).readlines()[int(sys.argv[2])]; "
+        "sys.stdout.write(json.loads(line)['command'])"
+    )
+    return f"""#!/bin/bash
+#SBATCH -p {partition}
+#SBATCH -J {job_name}
+#SBATCH --export=NONE
+#SBATCH -t {time_request}
+#SBATCH --array={array}
+{options}#SBATCH -e {log_dir}/{job_name}_%A_%a.err
+#SBATCH -o {log_dir}/{job_name}_%A_%a.out
+
+{setup}
+
+set -eo pipefail
+# command on line SLURM_ARRAY_TASK_ID + 1 of the manifest
+command=$(python -c "{read_command}" {manifest} "$SLURM_ARRAY_TASK_ID")
+echo "task $SLURM_ARRAY_TASK_ID of {manifest}"
+echo "$command"
+bash -e -c "$command"
+"""
+
+
+def write_array_script(path, manifest, job_name, partition, time_request, **kwargs):
+    """Write an array script, see array_script
+    Returns:
+        str: path
+    """
+    with open(path, "w") as f:
+        f.write(array_script(manifest, job_name, partition, time_request, **kwargs))
+    return path
+
+
+def array_range(script):
+    """Array indexes of an sbatch script from its #SBATCH --array line"""
+    with open(script) as f:
+        match = re.search(r"#SBATCH --array=(\d+)-(\d+)", f.read())
+    if not match:
+        return [0]
+    return list(range(int(match.group(1)), int(match.group(2)) + 1))
+
+
+class SbatchBackend:
+    """Submit scripts with sbatch.
+
+    Args:
+        sbatch (str): sbatch executable
+    """
+
+    def __init__(self, sbatch="sbatch"):
+        self.sbatch = sbatch
+
+    def submit(self, script, dependency=None):
+        """Submit a script
+        Args:
+            script (str): sbatch script path
+            dependency (str): e.g. afterok:1234, None for no dependency
+        Returns:
+            str: job id
+        """
+        command = [self.sbatch, "--parsable"]
+        if dependency:
+            command.append(f"--dependency={dependency}")
+        command.append(script)
+        result = subprocess.run(command, capture_output=True, text=True, check=True)
+        # --parsable prints jobid or jobid;cluster
+        return result.stdout.strip().split(";")[0]
+
+
+class DryRunBackend:
+    """Print the sbatch calls instead of submitting, job ids are placeholders."""
+
+    def __init__(self):
+        self.calls = []
+
+    def submit(self, script, dependency=None):
+        job_id = f"${{JOB_{len(self.calls)}}}"
+        command = "sbatch --parsable"
+        if dependency:
+            command += f" --dependency={dependency}"
+        print(f"JOB_{len(self.calls)}=$({command} {script})")
+        self.calls.append({"script": script, "dependency": dependency})
+        return job_id
+
+
+class FakeSbatch:
+    """Local stand in for sbatch that records submissions and, with run=True,
+    runs every array element in order with SLURM_ARRAY_TASK_ID set.
+
+    afterok and aftercorr are honoured from the recorded exit codes, elements
+    whose dependency failed are skipped like Slurm's DependencyNeverSatisfied.
+
+    Args:
+        run (bool): run the scripts with bash
+        env (dict): extra environment variables for the runs
+    """
+
+    def __init__(self, run=False, env=None):
+        self.run = run
+        self.env = env or {}
+        self.calls = []
+        # job id -> {array index: exit code}
+        self.results = {}
+
+    def _satisfied(self, dependency, index):
+        if not dependency:
+            return True
+        for condition in dependency.split(","):
+            kind, *job_ids = condition.split(":")
+            for job_id in job_ids:
+                codes = self.results.get(job_id, {})
+                if kind == "aftercorr":
+                    codes = {index: codes.get(index, 1)}
+                if kind in ["afterok", "aftercorr"] and any(codes.values()):
+                    return False
+                if kind == "afternotok" and not any(codes.values()):
+                    return False
+        return True
+
+    def submit(self, script, dependency=None):
+        job_id = str(1000 + len(self.calls))
+        self.calls.append(
+            {"script": script, "dependency": dependency, "job_id": job_id}
+        )
+        self.results[job_id] = {}
+        for index in array_range(script):
+            if not self.run:
+                self.results[job_id][index] = 0
+                continue
+            if not self._satisfied(dependency, index):
+                self.results[job_id][index] = None
+                continue
+            env = {
+                **os.environ,
+                **self.env,
+                "SLURM_JOB_ID": job_id,
+                "SLURM_ARRAY_JOB_ID": job_id,
+                "SLURM_ARRAY_TASK_ID": str(index),
+            }
+            run = subprocess.run(["bash", script], env=env)
+            self.results[job_id][index] = run.returncode
+        # skipped elements count as failed for later dependencies
+        self.results[job_id] = {
+            i: 1 if code is None else code for i, code in self.results[job_id].items()
+        }
+        return job_id
+
+
+def submit_stages(stages, backend=None):
+    """Submit stages in order, each after the stage it depends on
+    Args:
+        stages (list): dicts with
+            name: stage name
+            script: array script path
+            job_id: instead of script, a job submitted elsewhere to wait for
+            after: optional name of an earlier stage, or a list of names to
+                wait for all of them
+            dependency: optional dependency type, one of DEPENDENCY_TYPES,
+                defaults to afterok
+        backend: object with submit(script, dependency), defaults to SbatchBackend,
+            see DryRunBackend and FakeSbatch
+    Returns:
+        dict: stage name -> job id
+    """
+    backend = backend or SbatchBackend()
+    job_ids = {}
+    for stage in stages:
+        if "job_id" in stage:
+            job_ids[stage["name"]] = stage["job_id"]
+            continue
+        dependency = None
+        after = stage.get("after") or []
+        if isinstance(after, str):
+            after = [after]
+        if after:
+            for name in after:
+                if name not in job_ids:
+                    raise ValueError(f"Unknown stage: {name}")
+            kind = stage.get("dependency", "afterok")
+            if kind not in DEPENDENCY_TYPES:
+                raise ValueError(f"dependency must be one of {DEPENDENCY_TYPES}")
+            # e.g. afterany:1234:1235 waits for both arrays
+            dependency = f"{kind}:" + ":".join(job_ids[name] for name in after)
+        job_ids[stage["name"]] = backend.submit(stage["script"], dependency)
+        print(f"submitted {stage['name']}: job {job_ids[stage['name']]}")
+    return job_ids
@@ -0,0 +1,111 @@
+# Description: Parity of the local cloud mask with the ee graph steps and of the
+# blockwise dask mask with the whole scene mask, on small synthetic scenes
+# to run from terminal: python -m pytest tests
+
+import numpy as np
+import pytest
+
+from cloud_mask import (
+    buffer_mask,
+    cloud_mask,
+    cloud_mask_dask,
+    disk,
+    project_shadows,
+    threshold_clouds,
+)
+
+# disk(2), the ee focal circle of radius 2
+DISK_2 = np.array(
+    [
+        [0, 0, 1, 0, 0],
+        [0, 1, 1, 1, 0],
+        [1, 1, 1, 1, 1],
+        [0, 1, 1, 1, 0],
+        [0, 0, 1, 0, 0],
+    ],
+    dtype=bool,
+)
+
+
+def synthetic_scene(size=300, seed=0):
+    """Cloud probability with a few round clouds, dark patches and water"""
+    rng = np.random.default_rng(seed)
+    y, x = np.mgrid[:size, :size]
+    probability = rng.uniform(0, 20, (size, size))
+    for row, col, radius in rng.integers([0, 0, 5], [size, size, 25], (6, 3)):
+        probability[(y - row) ** 2 + (x - col) ** 2 <= radius**2] = 90
+    b8 = rng.uniform(2500, 4000, (size, size))
+    b8[rng.random((size, size)) < 0.3] = 1000
+    scl = np.full((size, size), 4)
+    scl[: size // 6] = 6
+    return probability, b8, scl
+
+
+def test_disk():
+    np.testing.assert_array_equal(disk(2), DISK_2)
+
+
+def test_threshold_clouds():
+    probability = np.array([[10, 30, 31], [100, 0, 50]])
+    expected = np.array([[False, False, True], [True, False, True]])
+    np.testing.assert_array_equal(threshold_clouds(probability, 30), expected)
+
+
+def test_project_shadows_toward_the_sun():
+    # one 100 m cloud cell at coarse (2, 4) of a 5 x 5 projection grid
+    clouds = np.zeros((50, 50), dtype=bool)
+    clouds[20:30, 40:50] = True
+
+    # sun in the east: cells up to 200 m west of the cloud see it
+    projected = project_shadows(clouds, 90, CLD_PRJ_DIST=0.2)
+    expected = np.zeros((50, 50), dtype=bool)
+    expected[20:30, 20:50] = True
+    np.testing.assert_array_equal(projected, expected)
+
+    # sun in the south: cells up to 200 m north of the cloud see it
+    clouds = np.zeros((50, 50), dtype=bool)
+    clouds[40:50, 20:30] = True
+    projected = project_shadows(clouds, 180, CLD_PRJ_DIST=0.2)
+    expected = np.zeros((50, 50), dtype=bool)
+    expected[20:50, 20:30] = True
+    np.testing.assert_array_equal(projected, expected)
+
+
+def test_buffer_mask():
+    # BUFFER * 2 / SCALE = 2 cells of the 20 m grid, repeated onto the 10 m grid
+    eroded = np.zeros((11, 11), dtype=bool)
+    eroded[5, 5] = True
+    expected_coarse = np.zeros((11, 11), dtype=bool)
+    expected_coarse[3:8, 3:8] = DISK_2
+    expected = expected_coarse.repeat(2, axis=0).repeat(2, axis=1)[:21, :21]
+    np.testing.assert_array_equal(
+        buffer_mask(eroded, (21, 21), BUFFER=10, SCALE=10), expected
+    )
+
+
+@pytest.mark.parametrize("chunks", [60, 100, 150])
+@pytest.mark.parametrize("solar_azimuth", [35.0, 147.5, 290.0])
+def test_dask_matches_whole_scene(chunks, solar_azimuth):
+    da = pytest.importorskip("dask.array")
+    probability, b8, scl = synthetic_scene()
+    expected = cloud_mask(probability, b8, scl, solar_azimuth)
+    mask = cloud_mask_dask(
+        da.from_array(probability, chunks=chunks),
+        da.from_array(b8, chunks=chunks),
+        da.from_array(scl, chunks=chunks),
+        solar_azimuth,
+    ).compute(scheduler="synchronous")
+    assert expected.any() and not expected.all()
+    np.testing.assert_array_equal(mask, expected)
+
+
+def test_dask_rejects_chunks_off_the_projection_grid():
+    da = pytest.importorskip("dask.array")
+    probability, b8, scl = synthetic_scene(size=100)
+    with pytest.raises(ValueError):
+        cloud_mask_dask(
+            da.from_array(probability, chunks=45),
+            da.from_array(b8, chunks=45),
+            da.from_array(scl, chunks=45),
+            120.0,
+        )
@@ -0,0 +1,180 @@
+# Description: The composite planner against a stubbed ee module, each
+# (site, quarter) composite graph is built once and its band and mask exports
+# fan out from it
+# to run from terminal: python -m pytest tests
+
+import sys
+import types
+
+import pytest
+
+from helpers import plan_composite_exports, submit_composite_exports
+
+pytest.importorskip("pendulum")
+
+REGIONS = {
+    "north": {"type": "Polygon", "coordinates": [[[33, -10], [34, -10], [34, -9]]]},
+    "south": {"type": "Polygon", "coordinates": [[[35, -16], [36, -16], [36, -15]]]},
+}
+
+
+class Node:
+    """Stand in for any ee object, records the call that made it"""
+
+    def __init__(self, stub, op, parent=None, args=(), kwargs=None):
+        self.op = op
+        self.parent = parent
+        self.args = args
+        self.kwargs = kwargs or {}
+        stub.nodes.append(self)
+        self._stub = stub
+
+    def __getattr__(self, op):
+        if op.startswith("__"):
+            raise AttributeError(op)
+        return lambda *args, **kwargs: Node(self._stub, op, self, args, kwargs)
+
+    def lineage(self):
+        node = self
+        while node is not None:
+            yield node
+            node = node.parent
+
+
+class Task:
+    def __init__(self, stub, image, name, **options):
+        self.image = image
+        self.name = name
+        self.options = options
+        self._stub = stub
+
+    def start(self):
+        self._stub.started.append(self)
+
+
+class ImageExport:
+    """ee.batch.Export.image(...) and ee.batch.Export.image.toDrive(...)"""
+
+    def __init__(self, stub):
+        self.stub = stub
+
+    def __call__(self, image, description, config):
+        return Task(self.stub, image, description, **config)
+
+    def toDrive(self, image, description, **options):
+        return Task(self.stub, image, description, **options)
+
+
+def stub_ee():
+    stub = types.ModuleType("ee")
+    stub.nodes = []
+    stub.started = []
+
+    def constructor(name):
+        return lambda *args, **kwargs: Node(stub, name, None, args, kwargs)
+
+    for name in ["ImageCollection", "Image", "Number", "Geometry"]:
+        setattr(stub, name, constructor(name))
+    stub.Filter = Node(stub, "Filter")
+    stub.Join = Node(stub, "Join")
+    stub.batch = types.SimpleNamespace(
+        Export=types.SimpleNamespace(image=ImageExport(stub))
+    )
+    return stub
+
+
+@pytest.fixture
+def ee(monkeypatch):
+    stub = stub_ee()
+    monkeypatch.setitem(sys.modules, "ee", stub)
+    return stub
+
+
+@pytest.fixture
+def plan(ee):
+    sites = {name: ee.Geometry(region) for name, region in REGIONS.items()}
+    return plan_composite_exports(
+        sites,
+        [2021],
+        bands=["B2", "B3"],
+        mask_band="B2",
+        regions=REGIONS,
+    )
+
+
+def test_plan_has_one_entry_per_site_and_quarter(plan):
+    assert len(plan) == 2 * 4
+    for entry in plan:
+        kinds = [export["kind"] for export in entry["exports"]]
+        assert kinds == ["band", "band", "mask"]
+        assert entry["bands"] == ["B2", "B3"]
+    names = [export["name"] for entry in plan for export in entry["exports"]]
+    assert "B3_S2_SR_2021_Q02_north" in names
+    assert "NoDataMask_2021_Q04_south" in names
+    assert len(set(names)) == len(names)
+
+
+def test_dry_run_counts_without_touching_ee(ee, plan):
+    n_nodes = len(ee.nodes)
+    assert submit_composite_exports(plan, dry_run=True) == {
+        "composites": 8,
+        "exports": 24,
+    }
+    assert len(ee.nodes) == n_nodes
+    assert not ee.started
+
+
+def test_each_composite_is_built_once(ee, plan):
+    assert submit_composite_exports(plan) == {"composites": 8, "exports": 24}
+    medians = [node for node in ee.nodes if node.op == "median"]
+    sr_collections = [
+        node
+        for node in ee.nodes
+        if node.op == "ImageCollection" and node.args == ("COPERNICUS/S2_SR",)
+    ]
+    assert len(medians) == len(sr_collections) == 8
+    assert len(ee.started) == 24
+
+    # the band and mask exports of a site and quarter share one median
+    by_composite = {}
+    for task in ee.started:
+        (median,) = [node for node in task.image.lineage() if node.op == "median"]
+        by_composite.setdefault(id(median), []).append(task.name)
+    assert len(by_composite) == 8
+    for names in by_composite.values():
+        period_site = {name.split("_S2_SR_")[-1] for name in names if "_S2_SR_" in name}
+        assert len(names) == 3 and len(period_site) == 1
+        (period,) = period_site
+        assert f"NoDataMask_{period}" in names
+
+
+def test_mask_region_is_the_cached_coordinates(ee, plan):
+    submit_composite_exports(plan)
+    masks = [task for task in ee.started if task.name.startswith("NoDataMask")]
+    assert masks
+    for task in masks:
+        site = task.name.split("_")[-1]
+        assert task.options["region"] == REGIONS[site]["coordinates"]
+
+
+def test_completed_exports_are_skipped(ee, plan):
+    class Manager:
+        def __init__(self):
+            self.added = {}
+
+        def is_complete(self, name):
+            return "north" in name or name.startswith("B3")
+
+        def add(self, name, make_task):
+            self.added[name] = make_task
+
+    manager = Manager()
+    # north is done, south still needs B2 and the mask
+    assert submit_composite_exports(plan, task_manager=manager) == {
+        "composites": 4,
+        "exports": 8,
+    }
+    assert not ee.started
+    assert all(name.endswith("south") for name in manager.added)
+    manager.added["NoDataMask_2021_Q01_south"]().start()
+    assert [task.name for task in ee.started] == ["NoDataMask_2021_Q01_south"]
@@ -0,0 +1,106 @@
+# Description: Run small task manifests through LocalExecutor and check the
+# Slurm style dependencies, the exit code summary and the dry run
+# to run from terminal: python -m pytest tests
+
+import os
+
+import pytest
+
+from executors import LocalExecutor
+from slurm import write_manifest
+
+
+def make_stage(tmp_path, name, commands, **options):
+    """Stage whose tasks run the commands and then touch {name}_{index}.done"""
+    tasks = [
+        {
+            "name": f"{name}_{i}",
+            "command": f"{command}\ntouch {tmp_path}/{name}_{i}.done",
+        }
+        for i, command in enumerate(commands)
+    ]
+    manifest = write_manifest(str(tmp_path / f"{name}_manifest.jsonl"), tasks)
+    return {"name": name, "manifest": manifest, **options}
+
+
+def ran(tmp_path, name, index):
+    return os.path.exists(tmp_path / f"{name}_{index}.done")
+
+
+@pytest.fixture
+def executor(tmp_path):
+    return LocalExecutor(workers=2, cpus_per_task=1, log_dir=str(tmp_path / "logs"))
+
+
+def test_exit_code_summary(tmp_path, executor):
+    stages = [make_stage(tmp_path, "a", ["true", "exit 3", "true"])]
+    assert executor.run(stages) == {"a": [0, 3, 0]}
+    assert ran(tmp_path, "a", 0) and not ran(tmp_path, "a", 1)
+    assert (tmp_path / "logs" / "a_1.err").exists()
+
+
+def test_afterok_skips_everything_after_a_failure(tmp_path, executor):
+    stages = [
+        make_stage(tmp_path, "a", ["true", "false"]),
+        make_stage(tmp_path, "b", ["true", "true"], after="a"),
+    ]
+    assert executor.run(stages) == {"a": [0, 1], "b": [None, None]}
+    assert not ran(tmp_path, "b", 0) and not ran(tmp_path, "b", 1)
+
+
+def test_afterany_runs_after_a_failure(tmp_path, executor):
+    stages = [
+        make_stage(tmp_path, "a", ["false"]),
+        make_stage(tmp_path, "b", ["true"], after="a", dependency="afterany"),
+    ]
+    assert executor.run(stages) == {"a": [1], "b": [0]}
+
+
+def test_aftercorr_pairs_tasks_by_index(tmp_path, executor):
+    stages = [
+        make_stage(tmp_path, "a", ["true", "false", "true"]),
+        make_stage(
+            tmp_path,
+            "b",
+            [f"test -e {tmp_path}/a_$LOCAL_TASK_ID.done"] * 3,
+            after="a",
+            dependency="aftercorr",
+        ),
+    ]
+    assert executor.run(stages) == {"a": [0, 1, 0], "b": [0, None, 0]}
+
+
+def test_aftercorr_without_a_matching_index_is_skipped(tmp_path, executor):
+    stages = [
+        make_stage(tmp_path, "a", ["true"]),
+        make_stage(tmp_path, "b", ["true", "true"], after="a", dependency="aftercorr"),
+    ]
+    assert executor.run(stages) == {"a": [0], "b": [0, None]}
+
+
+def test_waits_for_several_stages(tmp_path, executor):
+    stages = [
+        make_stage(tmp_path, "a", ["true"]),
+        make_stage(tmp_path, "b", ["false"]),
+        make_stage(tmp_path, "c", ["true"], after=["a", "b"]),
+    ]
+    assert executor.run(stages)["c"] == [None]
+
+
+def test_unknown_stage(tmp_path, executor):
+    stages = [make_stage(tmp_path, "b", ["true"], after="a")]
+    with pytest.raises(ValueError):
+        executor.run(stages)
+
+
+def test_dry_run_runs_nothing(tmp_path, executor, capsys):
+    stages = [
+        make_stage(tmp_path, "a", ["true", "true"], memory="1GB"),
+        make_stage(tmp_path, "b", ["true"], after="a"),
+    ]
+    assert executor.run(stages, dry_run=True) == {}
+    out = capsys.readouterr().out
+    assert "a: 2 tasks, 1 cpus" in out and "b: 1 tasks" in out
+    assert "a_1" in out
+    assert not any(ran(tmp_path, name, 0) for name in "ab")
+    assert not (tmp_path / "logs").exists()
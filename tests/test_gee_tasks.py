@@ -0,0 +1,157 @@
+# Description: ExportTaskManager against the fake backend and clock, bounded
+# concurrency, retries with backoff and resuming from the state file
+# to run from terminal: python -m pytest tests
+
+import json
+
+import pytest
+
+from gee_tasks import ExportTaskManager, FakeBackend, FakeClock
+
+
+class CountingBackend(FakeBackend):
+    """FakeBackend that tracks the most tasks running at once"""
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.running = set()
+        self.peak = 0
+
+    def start(self, task):
+        task_id = super().start(task)
+        self.running.add(task_id)
+        self.peak = max(self.peak, len(self.running))
+        return task_id
+
+    def status(self, task_id):
+        state, error = super().status(task_id)
+        if state != "RUNNING":
+            self.running.discard(task_id)
+        return state, error
+
+
+class ScriptedBackend:
+    """Fails the first failures starts, later starts complete on the first poll"""
+
+    def __init__(self, clock, failures=0):
+        self.clock = clock
+        self.failures = failures
+        self.started = []
+        self.start_times = []
+
+    def start(self, task):
+        self.started.append(task)
+        self.start_times.append(self.clock())
+        return f"T{len(self.started) - 1}"
+
+    def status(self, task_id):
+        if int(task_id[1:]) < self.failures:
+            return "FAILED", "simulated failure"
+        return "COMPLETED", None
+
+
+def manager_for(tmp_path, backend, clock, **options):
+    return ExportTaskManager(
+        str(tmp_path / "state.json"),
+        backend=backend,
+        clock=clock.time,
+        sleep=clock.sleep,
+        **{"poll_interval": 1, **options},
+    )
+
+
+class Factory:
+    """make_task that counts its calls and returns a new object each time"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return object()
+
+
+def test_max_in_flight(tmp_path):
+    clock = FakeClock()
+    backend = CountingBackend(latency=(5, 50), clock=clock.time, seed=0)
+    manager = manager_for(tmp_path, backend, clock, max_in_flight=4)
+    for i in range(30):
+        manager.add(f"export_{i}", Factory())
+    assert manager.run() == {"COMPLETED": 30}
+    assert backend.peak == 4
+    assert len(backend.started) == 30
+
+
+def test_retries_back_off_doubling(tmp_path):
+    clock = FakeClock()
+    backend = ScriptedBackend(clock.time, failures=3)
+    manager = manager_for(tmp_path, backend, clock, backoff=10, max_retries=3)
+    make_task = Factory()
+    manager.add("export", make_task)
+    assert manager.run() == {"COMPLETED": 1}
+    # each failure is seen one poll after the start, then waits the backoff
+    times = backend.start_times
+    gaps = [later - earlier - 1 for earlier, later in zip(times, times[1:])]
+    assert gaps == [10, 20, 40]
+    assert manager.state["export"]["attempts"] == 4
+
+
+def test_gives_up_after_max_retries(tmp_path):
+    clock = FakeClock()
+    backend = ScriptedBackend(clock.time, failures=100)
+    manager = manager_for(tmp_path, backend, clock, backoff=1, max_retries=2)
+    manager.add("export", Factory())
+    assert manager.run() == {"FAILED": 1}
+    assert len(backend.started) == 3
+    state = json.loads((tmp_path / "state.json").read_text())
+    assert state["export"]["state"] == "FAILED"
+    assert state["export"]["error"] == "simulated failure"
+
+
+def test_every_attempt_builds_a_new_task(tmp_path):
+    clock = FakeClock()
+    backend = ScriptedBackend(clock.time, failures=2)
+    manager = manager_for(tmp_path, backend, clock, backoff=1)
+    make_task = Factory()
+    manager.add("export", make_task)
+    manager.run()
+    assert make_task.calls == len(backend.started) == 3
+    assert len({id(task) for task in backend.started}) == 3
+
+
+def test_add_needs_a_factory(tmp_path):
+    clock = FakeClock()
+    manager = manager_for(tmp_path, ScriptedBackend(clock.time), clock)
+    with pytest.raises(TypeError):
+        manager.add("export", object())
+
+
+def test_resume_from_state_file(tmp_path):
+    clock = FakeClock()
+    (tmp_path / "state.json").write_text(
+        json.dumps(
+            {
+                "done": {"state": "COMPLETED", "attempts": 1, "task_id": "OLD_0"},
+                "running": {"state": "RUNNING", "attempts": 1, "task_id": "OLD_1"},
+                "failed": {"state": "FAILED", "attempts": 4, "task_id": "OLD_2"},
+            }
+        )
+    )
+    backend = FakeBackend(latency=(3, 3), clock=clock.time)
+    # the task started by the earlier run finishes in 10 seconds
+    backend.tasks["OLD_1"] = (10, False)
+    manager = manager_for(tmp_path, backend, clock, max_retries=1)
+    factories = {name: Factory() for name in ["done", "running", "failed", "new"]}
+    assert manager.is_complete("done")
+    queued = {name: manager.add(name, factory) for name, factory in factories.items()}
+    assert queued == {"done": False, "running": True, "failed": True, "new": True}
+    assert manager.run() == {"COMPLETED": 3}
+
+    # re-attached to the running task instead of starting it again
+    assert factories["running"].calls == 0
+    assert manager.state["running"]["task_id"] == "OLD_1"
+    assert factories["done"].calls == 0
+    # a task that failed in an earlier run gets its retries back
+    assert factories["failed"].calls == 1
+    assert manager.state["failed"]["attempts"] == 1
+    assert factories["new"].calls == 1
@@ -0,0 +1,125 @@
+# Description: The interpolation tasks run in the process pool write the same
+# stacks, byte for byte, as the same tasks run one after the other
+# to run from terminal: python -m pytest tests
+
+import os
+
+import numpy as np
+import pytest
+
+from interpolation import (
+    build_interpolation_tasks,
+    check_serial_outputs,
+    group_by_grid,
+    run_tasks,
+)
+
+rasterio = pytest.importorskip("rasterio")
+
+
+def write_quarters(folder, bands, grids, n_quarters=5, size=40, seed=0):
+    """Quarterly tifs {band}/S2_SR_{band}_{year}_Q{qq}_{grid}.tif with cloud gaps
+    shared across bands"""
+    from rasterio.transform import from_origin
+
+    rng = np.random.default_rng(seed)
+    profile = {
+        "driver": "GTiff",
+        "height": size,
+        "width": size,
+        "count": 1,
+        "dtype": "float32",
+        "crs": "EPSG:32736",
+        "transform": from_origin(500000, 8500000, 10, 10),
+    }
+    for grid in grids:
+        clouds = rng.random((n_quarters, size, size)) < 0.3
+        for band in bands:
+            os.makedirs(os.path.join(folder, band), exist_ok=True)
+            for q in range(n_quarters):
+                data = rng.uniform(0, 1, (size, size)).astype("float32")
+                data[clouds[q]] = np.nan
+                path = os.path.join(
+                    folder, band, f"S2_SR_{band}_2020_Q{q + 1:02d}_{grid}.tif"
+                )
+                with rasterio.open(path, "w", **profile) as dst:
+                    dst.write(data, 1)
+
+
+def pooled_matches_serial(tmp_path, tasks):
+    results = run_tasks(tasks, max_workers=2, mem_budget="16GB")
+    assert len(results) == len(tasks)
+    matches = check_serial_outputs(tasks, str(tmp_path / "serial"))
+    assert matches and all(matches.values())
+
+
+@pytest.mark.parametrize("codec", [None, "zstd"])
+def test_multiband_pool_matches_serial(tmp_path, codec):
+    bands, grids = ["B2", "B3"], ["north", "south"]
+    write_quarters(str(tmp_path), bands, grids)
+    tasks = build_interpolation_tasks(
+        bands,
+        grids,
+        input_dir=str(tmp_path),
+        output_dir=str(tmp_path),
+        kernel="numba",
+        window_size=(16, 16),
+        codec=codec,
+    )
+    pooled_matches_serial(tmp_path, group_by_grid(tasks))
+
+
+def test_band_pool_matches_serial(tmp_path):
+    pytest.importorskip("geowombat")
+    pytest.importorskip("xr_fresh")
+    bands, grids = ["B2", "B3"], ["north", "south"]
+    write_quarters(str(tmp_path), bands, grids)
+    tasks = build_interpolation_tasks(
+        bands,
+        grids,
+        input_dir=str(tmp_path),
+        output_dir=str(tmp_path),
+        window_size=(16, 16),
+        codec=None,
+    )
+    pooled_matches_serial(tmp_path, tasks)
+
+
+def test_append_tasks_cannot_be_checked(tmp_path):
+    task = {"band": "B2", "grid": "north", "outfile": "x.tif", "mode": "append"}
+    with pytest.raises(ValueError):
+        check_serial_outputs([task], str(tmp_path))
+
+
+def test_multiband_tasks_use_numpy(tmp_path):
+    write_quarters(str(tmp_path), ["B2", "B3"], ["north"], n_quarters=2, size=8)
+    tasks = build_interpolation_tasks(
+        ["B2", "B3"], ["north"], input_dir=str(tmp_path), transfer_lib="jax"
+    )
+    assert {task["transfer_lib"] for task in tasks} == {"jax"}
+    (task,) = group_by_grid(tasks)
+    assert task["mode"] == "multiband" and task["transfer_lib"] == "numpy"
+
+
+def test_multiband_rejects_bands_on_other_grids(tmp_path):
+    from affine import Affine
+
+    from interpolation import run_multiband_task
+
+    write_quarters(str(tmp_path), ["B2", "B3"], ["north"], n_quarters=2, size=8)
+    # shift one quarter of B3 by a pixel
+    path = str(tmp_path / "B3" / "S2_SR_B3_2020_Q02_north.tif")
+    with rasterio.open(path) as src:
+        profile, data = src.profile, src.read()
+    profile["transform"] = profile["transform"] * Affine.translation(1, 0)
+    with rasterio.open(path, "w", **profile) as dst:
+        dst.write(data)
+    tasks = build_interpolation_tasks(
+        ["B2", "B3"],
+        ["north"],
+        input_dir=str(tmp_path),
+        output_dir=str(tmp_path),
+        kernel="numba",
+    )
+    with pytest.raises(ValueError, match="not on the grid"):
+        run_multiband_task(group_by_grid(tasks)[0])
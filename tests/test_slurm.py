@@ -0,0 +1,168 @@
+# Description: Job array scripts, stage dependencies and the fake sbatch that
+# runs the arrays locally
+# to run from terminal: python -m pytest tests
+
+import os
+
+import pytest
+
+from slurm import (
+    DryRunBackend,
+    FakeSbatch,
+    array_range,
+    array_script,
+    read_manifest,
+    submit_stages,
+    write_array_script,
+    write_manifest,
+)
+
+
+def manifest_of(tmp_path, name, commands):
+    """Manifest whose task i runs commands[i] and then touches {name}_{i}.done"""
+    tasks = [
+        {
+            "name": f"{name}_{i}",
+            "command": f"{command}\ntouch {tmp_path}/{name}_{i}.done",
+        }
+        for i, command in enumerate(commands)
+    ]
+    return write_manifest(str(tmp_path / f"{name}_manifest.jsonl"), tasks)
+
+
+def stage_of(tmp_path, name, commands, **options):
+    manifest = manifest_of(tmp_path, name, commands)
+    script = write_array_script(
+        str(tmp_path / f"{name}.sh"),
+        manifest,
+        name,
+        "defq",
+        "00-01:00:00",
+        log_dir=str(tmp_path),
+    )
+    return {"name": name, "script": script, **options}
+
+
+def ran(tmp_path, name, index):
+    return os.path.exists(tmp_path / f"{name}_{index}.done")
+
+
+def test_array_range_and_max_parallel(tmp_path):
+    manifest = manifest_of(tmp_path, "a", ["true"] * 5)
+    script = array_script(manifest, "a", "defq", "00-01:00:00", max_parallel=2)
+    assert "#SBATCH --array=0-4%2\n" in script
+    script = array_script(manifest, "a", "defq", "00-01:00:00")
+    assert "#SBATCH --array=0-4\n" in script
+    assert "--cpus-per-task" not in script and "--mem" not in script
+
+    path = write_array_script(
+        str(tmp_path / "a.sh"),
+        manifest,
+        "a",
+        "defq",
+        "00-01:00:00",
+        cpus_per_task=4,
+        memory="8192M",
+    )
+    assert array_range(path) == [0, 1, 2, 3, 4]
+    with open(path) as f:
+        text = f.read()
+    assert "#SBATCH --cpus-per-task=4\n" in text and "#SBATCH --mem=8192M\n" in text
+
+
+def test_empty_manifest(tmp_path):
+    manifest = manifest_of(tmp_path, "a", [])
+    with pytest.raises(ValueError):
+        array_script(manifest, "a", "defq", "00-01:00:00")
+
+
+def test_each_element_runs_its_own_command(tmp_path):
+    # element i writes the word of line i + 1
+    words = ["zero", "one", "two"]
+    commands = [f"echo {word} > {tmp_path}/{word}" for word in words]
+    stage = stage_of(tmp_path, "a", commands)
+    backend = FakeSbatch(run=True)
+    job_ids = submit_stages([stage], backend)
+    assert backend.results[job_ids["a"]] == {0: 0, 1: 0, 2: 0}
+    for i, word in enumerate(words):
+        assert ran(tmp_path, "a", i)
+        assert (tmp_path / word).read_text() == f"{word}\n"
+
+
+def test_dependency_strings(tmp_path):
+    stages = [
+        stage_of(tmp_path, "a", ["true"]),
+        stage_of(tmp_path, "b", ["true"], after="a"),
+        stage_of(tmp_path, "c", ["true"], after="b", dependency="aftercorr"),
+        stage_of(tmp_path, "d", ["true"], after=["a", "c"], dependency="afterany"),
+        {"name": "external", "job_id": "42"},
+        stage_of(tmp_path, "e", ["true"], after="external"),
+    ]
+    backend = DryRunBackend()
+    job_ids = submit_stages(stages, backend)
+    assert [call["dependency"] for call in backend.calls] == [
+        None,
+        "afterok:${JOB_0}",
+        "aftercorr:${JOB_1}",
+        "afterany:${JOB_0}:${JOB_2}",
+        "afterok:42",
+    ]
+    assert job_ids["external"] == "42"
+
+
+def test_unknown_stage_and_dependency(tmp_path):
+    with pytest.raises(ValueError):
+        submit_stages([stage_of(tmp_path, "b", ["true"], after="a")], DryRunBackend())
+    stages = [
+        stage_of(tmp_path, "a", ["true"]),
+        stage_of(tmp_path, "c", ["true"], after="a", dependency="afterwards"),
+    ]
+    with pytest.raises(ValueError):
+        submit_stages(stages, DryRunBackend())
+
+
+def test_fake_sbatch_skips_failed_dependencies(tmp_path):
+    stages = [
+        stage_of(tmp_path, "a", ["true", "false", "true"]),
+        stage_of(tmp_path, "corr", ["true"] * 4, after="a", dependency="aftercorr"),
+        stage_of(tmp_path, "ok", ["true"], after="a"),
+        stage_of(tmp_path, "any", ["true"], after="a", dependency="afterany"),
+    ]
+    backend = FakeSbatch(run=True)
+    job_ids = submit_stages(stages, backend)
+    results = {name: backend.results[job_id] for name, job_id in job_ids.items()}
+    assert results["a"] == {0: 0, 1: 1, 2: 0}
+    # index 1 failed and index 3 has no element to wait for
+    assert results["corr"] == {0: 0, 1: 1, 2: 0, 3: 1}
+    assert [ran(tmp_path, "corr", i) for i in range(4)] == [True, False, True, False]
+    assert results["ok"] == {0: 1} and not ran(tmp_path, "ok", 0)
+    assert results["any"] == {0: 0} and ran(tmp_path, "any", 0)
+
+
+def test_fake_sbatch_without_run_records_the_calls(tmp_path):
+    stages = [
+        stage_of(tmp_path, "a", ["true", "true"]),
+        stage_of(tmp_path, "b", ["true"], after="a"),
+    ]
+    backend = FakeSbatch()
+    job_ids = submit_stages(stages, backend)
+    assert [call["dependency"] for call in backend.calls] == [
+        None,
+        f"afterok:{job_ids['a']}",
+    ]
+    assert not ran(tmp_path, "a", 0)
+
+
+def test_write_manifest_refuses_to_overwrite(tmp_path):
+    path = str(tmp_path / "manifest.jsonl")
+    write_manifest(path, [{"name": "a", "command": "true"}])
+    with pytest.raises(FileExistsError):
+        write_manifest(path, [{"name": "b", "command": "true"}])
+    assert read_manifest(path) == [{"name": "a", "command": "true"}]
+    write_manifest(path, [{"name": "b", "command": "true"}], overwrite=True)
+    assert read_manifest(path) == [{"name": "b", "command": "true"}]
+
+
+def test_manifest_tasks_need_a_name_and_command(tmp_path):
+    with pytest.raises(ValueError):
+        write_manifest(str(tmp_path / "manifest.jsonl"), [{"name": "a"}])
@@ -0,0 +1,259 @@
+# Description: Plan a 2D grid of tiles over an area of interest sized by a pixel
+# or memory budget, aligned to the pixel grid, with an optional halo
+# author: Michael Mann mmann1123@gwu.edu
+
+# the same tiling can be shared by the gee downloads, mosaics and focal features
+# Example:
+# from tiling import plan_tiles, write_tiles
+# tiles = plan_tiles("./data/south_adm2.geojson", resolution=10, max_bytes=2e9, bands=6)
+# write_tiles(tiles, "./data/south_adm2_tiles.geojson")
+
+# rasters that are already mosaicked are sharded in pixels, e.g. spfeas inputs
+# with a halo of the largest focal window (3_run_spfeas.py shard_size):
+# shards = raster_shards("../mosaic/S2_SR_2020_Q01_south.tif", 4096, halo=71)
+
+import json
+import math
+
+# UTM zone 36S covers Malawi
+DEFAULT_CRS = "EPSG:32736"
+
+
+def tile_budget(max_pixels=None, max_bytes=None, dtype="float32", bands=1):
+    """Get the maximum number of pixels per tile from a pixel or byte budget
+    Args:
+        max_pixels (int): maximum pixels per tile
+        max_bytes (int): maximum bytes per tile across all bands
+        dtype (str): data type used with max_bytes
+        bands (int): number of bands used with max_bytes
+    Returns:
+        int: maximum pixels per tile
+    """
+    import numpy as np
+
+    if max_pixels is None and max_bytes is None:
+        raise ValueError("One of max_pixels or max_bytes is required")
+
+    budget = []
+    if max_pixels is not None:
+        budget.append(int(max_pixels))
+    if max_bytes is not None:
+        budget.append(int(max_bytes // (np.dtype(dtype).itemsize * bands)))
+    return min(budget)
+
+
+def plan_tiles(
+    aoi,
+    resolution=10,
+    max_pixels=None,
+    max_bytes=None,
+    dtype="float32",
+    bands=1,
+    halo=0,
+    crs=DEFAULT_CRS,
+):
+    """Split an area of interest into a 2D grid of tiles that fit a pixel budget
+
+    Tile edges fall on multiples of resolution in crs, so every tile lines up
+    with the same pixel grid. The budget applies to a tile including its halo.
+    Tiles that do not intersect the aoi are dropped.
+
+    Args:
+        aoi: path to a vector file, GeoDataFrame, GeoSeries or shapely geometry in EPSG:4326
+        resolution (float): pixel size in crs units
+        max_pixels (int): maximum pixels per tile including the halo
+        max_bytes (int): maximum bytes per tile including the halo across all bands
+        dtype (str): data type used with max_bytes
+        bands (int): number of bands used with max_bytes
+        halo (int): pixels added on each side of a tile
+        crs (str): projected crs of the pixel grid
+    Returns:
+        GeoDataFrame: one row per tile with tile_id, row, col, width, height, halo
+            and the tile geometry without halo in crs
+    """
+    import geopandas as gpd
+    from shapely.geometry import box
+
+    if isinstance(aoi, str):
+        aoi = gpd.read_file(aoi)
+    elif not isinstance(aoi, (gpd.GeoDataFrame, gpd.GeoSeries)):
+        aoi = gpd.GeoSeries([aoi], crs="EPSG:4326")
+    geometry = aoi.to_crs(crs).unary_union
+
+    side = math.isqrt(tile_budget(max_pixels, max_bytes, dtype, bands)) - 2 * halo
+    if side < 1:
+        raise ValueError("Pixel budget is too small for the requested halo")
+
+    # snap the bounds outwards to the pixel grid
+    minx, miny, maxx, maxy = geometry.bounds
+    minx = math.floor(minx / resolution) * resolution
+    miny = math.floor(miny / resolution) * resolution
+    maxx = math.ceil(maxx / resolution) * resolution
+    maxy = math.ceil(maxy / resolution) * resolution
+    cols = int(round((maxx - minx) / resolution))
+    rows = int(round((maxy - miny) / resolution))
+
+    # spread the pixels evenly over the fewest tiles that fit the budget
+    n_cols = math.ceil(cols / side)
+    n_rows = math.ceil(rows / side)
+    tile_cols = math.ceil(cols / n_cols)
+    tile_rows = math.ceil(rows / n_rows)
+    print(f"Tiling {rows} x {cols} pixels into {n_rows} x {n_cols} tiles")
+
+    records = []
+    for row in range(n_rows):
+        for col in range(n_cols):
+            col_off = col * tile_cols
+            row_off = row * tile_rows
+            width = min(tile_cols, cols - col_off)
+            height = min(tile_rows, rows - row_off)
+            if width < 1 or height < 1:
+                continue
+            x0 = minx + col_off * resolution
+            y1 = maxy - row_off * resolution
+            core = box(x0, y1 - height * resolution, x0 + width * resolution, y1)
+            if not core.intersects(geometry):
+                continue
+            records.append(
+                {
+                    "tile_id": len(records) + 1,
+                    "row": row,
+                    "col": col,
+                    "width": width,
+                    "height": height,
+                    "resolution": resolution,
+                    "halo": halo,
+                    "geometry": core,
+                }
+            )
+
+    return gpd.GeoDataFrame(records, geometry="geometry", crs=crs)
+
+
+def tile_bounds(tiles, halo=True, crs=None):
+    """List the bounds of each tile
+    Args:
+        tiles (GeoDataFrame): output of plan_tiles
+        halo (bool): include the halo in the bounds
+        crs (str): return bounds in this crs instead of the tiling crs
+    Returns:
+        list: list of [minx, miny, maxx, maxy]
+    """
+    geometries = tiles.geometry
+    if halo:
+        geometries = geometries.buffer(
+            (tiles["halo"] * tiles["resolution"]).values, join_style="mitre"
+        )
+    if crs is not None:
+        geometries = geometries.to_crs(crs)
+    return [list(geometry.bounds) for geometry in geometries]
+
+
+def write_tiles(tiles, geojson_path, bounds_path=None, crs="EPSG:4326"):
+    """Write tiles to GeoJSON and their bounds to a JSON list
+
+    Args:
+        tiles (GeoDataFrame): output of plan_tiles
+        geojson_path (str): output GeoJSON with tile polygons in crs
+        bounds_path (str): output JSON with the core and halo bounds of each tile
+            in the tiling crs, defaults to geojson_path with _bounds.json
+        crs (str): crs of the GeoJSON
+    Returns:
+        str: path to the bounds JSON
+    """
+    tiles.to_crs(crs).to_file(geojson_path, driver="GeoJSON")
+
+    if bounds_path is None:
+        bounds_path = geojson_path.rsplit(".", 1)[0] + "_bounds.json"
+    core_bounds = tile_bounds(tiles, halo=False)
+    halo_bounds = tile_bounds(tiles, halo=True)
+    with open(bounds_path, "w") as f:
+        json.dump(
+            {
+                "crs": tiles.crs.to_string(),
+                "tiles": [
+                    {
+                        "tile_id": int(tile_id),
+                        "bounds": core,
+                        "halo_bounds": with_halo,
+                    }
+                    for tile_id, core, with_halo in zip(
+                        tiles["tile_id"], core_bounds, halo_bounds
+                    )
+                ],
+            },
+            f,
+            indent=2,
+        )
+    return bounds_path
+
+
+def read_tile_bounds(bounds_path, halo=True):
+    """Read the bounds list written by write_tiles
+    Args:
+        bounds_path (str): JSON written by write_tiles
+        halo (bool): return the bounds including the halo
+    Returns:
+        tuple: (crs, list of [minx, miny, maxx, maxy])
+    """
+    with open(bounds_path) as f:
+        data = json.load(f)
+    key = "halo_bounds" if halo else "bounds"
+    return data["crs"], [tile[key] for tile in data["tiles"]]
+
+
+def plan_shards(height, width, shard_size, halo=0):
+    """Split a raster into square shards in pixels, each read with a halo
+
+    The halo is clipped to the raster, so edge shards see the same image edge as
+    the whole raster. A focal feature whose window fits in the halo gives the
+    same core pixels on a shard as on the whole raster, so cropping the halos
+    and mosaicking the cores reproduces the unsharded output.
+
+    Windows are [col_off, row_off, width, height] lists, the order of
+    gdal_translate -srcwin, so shards can be written to task manifests.
+
+    Args:
+        height (int): raster rows
+        width (int): raster columns
+        shard_size (int): core rows and columns, the last row and column of
+            shards are smaller
+        halo (int): pixels read on each side of the core
+    Returns:
+        list: dicts with shard_id, row, col, core (window in the raster), window
+            (core plus halo in the raster) and crop (core within window)
+    """
+    if shard_size < 1:
+        raise ValueError("shard_size must be at least 1 pixel")
+
+    shards = []
+    for row, row_off in enumerate(range(0, height, shard_size)):
+        for col, col_off in enumerate(range(0, width, shard_size)):
+            core_width = min(shard_size, width - col_off)
+            core_height = min(shard_size, height - row_off)
+            x0 = max(col_off - halo, 0)
+            y0 = max(row_off - halo, 0)
+            x1 = min(col_off + core_width + halo, width)
+            y1 = min(row_off + core_height + halo, height)
+            shards.append(
+                {
+                    "shard_id": len(shards) + 1,
+                    "row": row,
+                    "col": col,
+                    "core": [col_off, row_off, core_width, core_height],
+                    "window": [x0, y0, x1 - x0, y1 - y0],
+                    "crop": [col_off - x0, row_off - y0, core_width, core_height],
+                }
+            )
+    return shards
+
+
+def raster_shards(path, shard_size, halo=0):
+    """plan_shards for the size of a raster, see plan_shards"""
+    import rasterio
+
+    with rasterio.open(path) as src:
+        height, width = src.height, src.width
+    shards = plan_shards(height, width, shard_size, halo)
+    print(f"Sharding {height} x {width} pixels into {len(shards)} shards")
+    return shards